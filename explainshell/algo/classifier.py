@@ -1,16 +1,27 @@
 import itertools
 import collections
+import hashlib
 import logging
+import os
+import pickle
 
 import nltk
 import nltk.metrics
 import nltk.classify
 import nltk.classify.maxent
 
-from explainshell import algo, config
+from explainshell import algo, cache, config
 
 logger = logging.getLogger(__name__)
 
+# bump when get_features or the way a model is trained changes, so models
+# saved by an older version are trained again
+MODEL_VERSION = 1
+
+# the models trained or loaded by this process by key (see Classifier.key),
+# so building a Classifier doesn't read the file every time
+_models = cache.LRUCache(maxsize=4)
+
 
 def get_features(paragraph):
     features = {}
@@ -35,18 +46,89 @@ def get_features(paragraph):
 
 class Classifier:
     """classify the paragraphs of a man page as having command line options
-    or not"""
+    or not
 
-    def __init__(self, store, algo, **classifier_args):
+    the trained model is saved to model_path (CLASSIFIER_MODEL_PATH unless
+    given, empty to not save it) along with the key of the training set and
+    settings it was trained with, and loaded from there as long as they don't
+    change"""
+
+    def __init__(self, store, algo, model_path=None, **classifier_args):
         self.store = store
         self.algo = algo
         self.classifier_args = classifier_args
         self.classifier = None
+        self.test_feats = []
+        if model_path is None:
+            model_path = config.CLASSIFIER_MODEL_PATH
+        self.model_path = model_path
+
+    def key(self):
+        """identify the model trained on the current training set with the
+        settings of this classifier"""
+        h = hashlib.sha1()
+        settings = (MODEL_VERSION, self.algo, sorted(self.classifier_args.items()))
+        h.update(repr(settings).encode("utf-8"))
+        h.update(self.store.training_set_fingerprint().encode("utf-8"))
+        return h.hexdigest()
+
+    def _load(self, key):
+        if not self.model_path:
+            return None
+        try:
+            with open(self.model_path, "rb") as f:
+                d = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # a file that is corrupt or from another version of nltk is
+            # trained over
+            logger.warning(
+                "couldn't load the classifier from %s", self.model_path, exc_info=True
+            )
+            return None
+
+        if not isinstance(d, dict) or d.get("key") != key:
+            logger.info("the classifier in %s is out of date", self.model_path)
+            return None
+        return d["classifier"], d["test_feats"]
+
+    def _save(self, key, model):
+        if not self.model_path:
+            return
+        d = {
+            "version": MODEL_VERSION,
+            "key": key,
+            "algo": self.algo,
+            "classifier": model[0],
+            "test_feats": model[1],
+        }
+        tmp = f"{self.model_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                pickle.dump(d, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.model_path)
+        except OSError:
+            logger.warning(
+                "couldn't save the classifier to %s", self.model_path, exc_info=True
+            )
+            return
+        logger.info("saved the classifier to %s", self.model_path)
 
-    def train(self):
-        if self.classifier:
+    def train(self, force=False):
+        """train the classifier, unless a model trained on the same training
+        set can be loaded. force trains it either way"""
+        if self.classifier and not force:
             return
 
+        key = self.key()
+        if not force:
+            model = _models.get(key) or self._load(key)
+            if model is not None:
+                self.classifier, self.test_feats = model
+                _models.put(key, model)
+                return
+
         man_pages = self.store.training_set()
 
         # flatten the manpages so we get a list of (manpage-name, paragraph)
@@ -82,6 +164,10 @@ class Classifier:
 
         self.classifier = c.train(train_feats, **self.classifier_args)
 
+        model = (self.classifier, self.test_feats)
+        _models.put(key, model)
+        self._save(key, model)
+
     def evaluate(self):
         self.train()
         ref_sets = collections.defaultdict(set)
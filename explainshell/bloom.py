@@ -0,0 +1,72 @@
+"""
+a bloom filter, used to reject lookups of names that aren't in the store
+without asking the database
+"""
+
+import hashlib
+import math
+
+
+class BloomFilter:
+    """a set membership filter with no false negatives
+
+    `x in f` is always True if x was added, and True with a probability of
+    about error_rate if it wasn't
+
+    capacity - the number of items the filter is sized for
+    error_rate - the false positive rate at capacity
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(capacity, 1)
+        self.nbits = max(
+            8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.nhashes = max(1, round(self.nbits / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.nbits + 7) // 8)
+
+    @classmethod
+    def from_iterable(cls, items, capacity, error_rate=0.001):
+        f = cls(capacity, error_rate)
+        for item in items:
+            f.add(item)
+        return f
+
+    def _positions(self, item):
+        # double hashing, see Kirsch and Mitzenmacher, "less hashing, same
+        # performance: building a better bloom filter"
+        digest = hashlib.blake2b(item.encode("utf8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.nhashes):
+            yield (h1 + i * h2) % self.nbits
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        return len(self._bits)
+
+    @property
+    def false_positive_rate(self):
+        """the expected false positive rate given the items added so far"""
+        return (1 - math.exp(-self.nhashes * self.count / self.nbits)) ** self.nhashes
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "nbytes": self.nbytes,
+            "nhashes": self.nhashes,
+            "false_positive_rate": self.false_positive_rate,
+        }
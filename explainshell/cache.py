@@ -0,0 +1,194 @@
+"""
+in-process caches used to keep the store off the hot path
+"""
+
+import collections
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """a thread safe cache that holds at most maxsize entries, evicting the
+    least recently used one first
+
+    maxsize - the maximum number of entries kept
+    ttl - number of seconds an entry is valid for, None means forever
+    maxcost - the maximum total cost of the entries kept, None means no limit.
+        each entry has a cost given to put (e.g. its size in bytes)
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, clock=time.monotonic, maxcost=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxcost = maxcost
+        self.cost = 0
+        self._clock = clock
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires, cost = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires <= self._clock():
+                del self._data[key]
+                self.cost -= cost
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, cost=1):
+        """add value under key, an entry that costs more than maxcost on its
+        own isn't added"""
+        expires = None
+        if self.ttl is not None:
+            expires = self._clock() + self.ttl
+
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.cost -= old[2]
+            if self.maxcost is not None and cost > self.maxcost:
+                return
+
+            self._data[key] = (value, expires, cost)
+            self.cost += cost
+            while len(self._data) > self.maxsize or (
+                self.maxcost is not None and self.cost > self.maxcost
+            ):
+                _, (_, _, evicted_cost) = self._data.popitem(last=False)
+                self.cost -= evicted_cost
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.cost = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "cost": self.cost,
+            "maxcost": self.maxcost,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class DiskCache:
+    """a cache of bytes in an sqlite database, shared by every process that
+    opens the same path and kept across restarts
+
+    keys are strings, values are bytes (e.g. pickled objects). once there are
+    more than maxsize entries the oldest written ones are dropped
+    """
+
+    # how many writes go by between checks for entries over maxsize
+    PRUNE_EVERY = 64
+
+    def __init__(self, path, maxsize=100000):
+        self.path = path
+        self.maxsize = maxsize
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._writes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def _connection(self):
+        # sqlite connections must not be used across a fork
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None, check_same_thread=False
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB)"
+            )
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                row = (
+                    self._connection()
+                    .execute("SELECT value FROM cache WHERE key = ?", (key,))
+                    .fetchone()
+                )
+            except sqlite3.Error:
+                logger.warning("couldn't read from %s", self.path, exc_info=True)
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+        return row[0]
+
+    def put(self, key, value):
+        with self._lock:
+            try:
+                conn = self._connection()
+                # replacing gives the row a new rowid, so rowids are in write
+                # order
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)",
+                    (key, value),
+                )
+                self._writes += 1
+                if self._writes % self.PRUNE_EVERY == 0:
+                    conn.execute(
+                        "DELETE FROM cache WHERE rowid <= "
+                        "(SELECT max(rowid) FROM cache) - ?",
+                        (self.maxsize,),
+                    )
+            except sqlite3.Error:
+                logger.warning("couldn't write to %s", self.path, exc_info=True)
+
+    def clear(self):
+        with self._lock:
+            self._connection().execute("DELETE FROM cache")
+
+    def __len__(self):
+        with self._lock:
+            return (
+                self._connection().execute("SELECT count(*) FROM cache").fetchone()[0]
+            )
+
+    def stats(self):
+        return {
+            "size": len(self),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -11,4 +11,71 @@ MAN2HTML = os.path.join(TOOLS_DIR, "w3mman2html.cgi")
 # host to pass into Flask's app.run.
 HOST_IP = os.getenv("HOST_IP", "")
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost")
+# maximum number of connections each process keeps open to mongodb
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "10"))
+# number of find_man_page results each process caches, and for how long (seconds)
+MANPAGE_CACHE_SIZE = int(os.getenv("MANPAGE_CACHE_SIZE", "512"))
+MANPAGE_CACHE_TTL = float(os.getenv("MANPAGE_CACHE_TTL", "3600"))
+# number of man pages written per bulk operation by Store.add_manpages
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+# serve man pages from this file (see manager.py --export-snapshot) instead
+# of mongodb
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "")
+# false positive rate of the filter of mapped names that lets the store reject
+# unknown programs without a query, 0 turns it off
+MAPPING_FILTER_ERROR_RATE = float(os.getenv("MAPPING_FILTER_ERROR_RATE", "0.001"))
+# how often (seconds) a process checks if another process wrote to the store
+STORE_GENERATION_TTL = float(os.getenv("STORE_GENERATION_TTL", "30"))
+# number of explained commands each process caches, and their total size in bytes
+EXPLAIN_CACHE_SIZE = int(os.getenv("EXPLAIN_CACHE_SIZE", "1024"))
+EXPLAIN_CACHE_MAXCOST = int(os.getenv("EXPLAIN_CACHE_MAXCOST", str(64 * 1024 * 1024)))
+# an sqlite database that keeps explained commands across restarts and shares
+# them between processes, and the number of commands it keeps
+EXPLAIN_CACHE_PATH = os.getenv("EXPLAIN_CACHE_PATH", "")
+EXPLAIN_CACHE_DISK_SIZE = int(os.getenv("EXPLAIN_CACHE_DISK_SIZE", "100000"))
+# the longest script (in characters) and the most statements /explain takes
+# in script mode, when the input has several lines
+SCRIPT_MAX_LENGTH = int(os.getenv("SCRIPT_MAX_LENGTH", "100000"))
+SCRIPT_MAX_STATEMENTS = int(os.getenv("SCRIPT_MAX_STATEMENTS", "500"))
+# limits on the work done to explain a single command: the number of AST
+# nodes, how deep they're nested, the number of commands looked up and the
+# seconds spent matching. past any of them the rest of the command is left
+# unexplained and the page says so. 0 turns a limit off
+MATCH_MAX_NODES = int(os.getenv("MATCH_MAX_NODES", "20000"))
+MATCH_MAX_DEPTH = int(os.getenv("MATCH_MAX_DEPTH", "100"))
+MATCH_MAX_LOOKUPS = int(os.getenv("MATCH_MAX_LOOKUPS", "200"))
+MATCH_MAX_SECONDS = float(os.getenv("MATCH_MAX_SECONDS", "2"))
+# the number of threads a request may use to look up commands in the store
+# at the same time, 0 looks them up one after another on the request thread.
+# the threads come from a pool of LOOKUP_POOL_SIZE shared by the process
+LOOKUP_CONCURRENCY = int(os.getenv("LOOKUP_CONCURRENCY", "0"))
+LOOKUP_POOL_SIZE = int(os.getenv("LOOKUP_POOL_SIZE", "8"))
+# how long (seconds) clients and caches in between may keep /api/explain
+# responses without revalidating them
+API_CACHE_MAX_AGE = int(os.getenv("API_CACHE_MAX_AGE", "3600"))
+# the most commands /api/explain/batch takes in one request, and the number
+# of distinct commands it remembers to answer repeats without explaining them
+API_BATCH_MAX_ITEMS = int(os.getenv("API_BATCH_MAX_ITEMS", "100000"))
+API_BATCH_DEDUPE_SIZE = int(os.getenv("API_BATCH_DEDUPE_SIZE", "10000"))
+# number of rendered /explain/<program> pages each process caches, and their
+# total size in bytes. with PAGE_CACHE_PATH set they're kept in an sqlite
+# database too, which manager.py --prewarm fills
+PAGE_CACHE_SIZE = int(os.getenv("PAGE_CACHE_SIZE", "256"))
+PAGE_CACHE_MAXCOST = int(os.getenv("PAGE_CACHE_MAXCOST", str(64 * 1024 * 1024)))
+PAGE_CACHE_PATH = os.getenv("PAGE_CACHE_PATH", "")
+PAGE_CACHE_DISK_SIZE = int(os.getenv("PAGE_CACHE_DISK_SIZE", "10000"))
+# a directory where every web process writes its metrics for /metrics to sum
+# them, at most once every METRICS_FLUSH_INTERVAL seconds. empty it when the
+# workers are restarted. without it /metrics reports the process it reaches
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "1"))
+# time the phases of explaining a command and send them back in a
+# Server-Timing header, and log them as a json line per request too
+TIMING = os.getenv("TIMING", "1") != "0"
+TIMING_LOG = os.getenv("TIMING_LOG", "0") != "0"
+# where the trained classifier is kept, it's trained again when the training
+# set changes. empty trains it on every start
+CLASSIFIER_MODEL_PATH = os.getenv(
+    "CLASSIFIER_MODEL_PATH", os.path.join(_curr_dir, "classifier.pickle")
+)
 DEBUG = True
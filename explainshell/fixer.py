@@ -83,10 +83,13 @@ class Runner:
     def post_option_extraction(self):
         for f in self._fixers():
             f.post_option_extraction()
+        # fixers edit the paragraphs in place
+        self.mctx.manpage.invalidate()
 
     def pre_add_manpage(self):
         for f in self._fixers():
             f.pre_add_manpage()
+        self.mctx.manpage.invalidate()
 
 
 def register(fixer_cls):
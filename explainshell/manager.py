@@ -1,10 +1,12 @@
 import argparse
+import concurrent.futures
+import json
 import os
 import sys
 import logging
 import glob
 
-from explainshell import options, store, fixer, manpage, errors, config
+from explainshell import options, store, fixer, manpage, errors, config, snapshot
 from explainshell.algo import classifier
 
 logger = logging.getLogger("explainshell.manager")
@@ -23,15 +25,44 @@ class ManagerCtx:
         self.aliases = None
 
 
+# the classifier of a worker process of Manager.run, see _init_worker
+_worker_classifier = None
+
+
+def _init_worker(model):
+    global _worker_classifier
+    _worker_classifier = classifier.Classifier(None, "bayes", model_path="")
+    _worker_classifier.classifier = model
+
+
+def _prepare_page(path):
+    """prepare the man page at path in a worker process, returns (path,
+    store.ManPage, None) or (path, None, error) if it failed"""
+    try:
+        m = manpage.ManPage(path)
+        return path, Manager.prepare(ManagerCtx(_worker_classifier, None, m)), None
+    except errors.EmptyManpage as e:
+        return path, None, f"manpage {e.args[0]!r} is empty"
+    except Exception as e:
+        logger.debug("couldn't prepare manpage %s", path, exc_info=True)
+        return path, None, f"{type(e).__name__}: {e}"
+
+
 class Manager:
     """the manager uses all parts of the system to read, classify, parse, extract
-    and write a man page to the database"""
+    and write a man page to the database
+
+    with jobs > 1, man pages are read, classified and extracted by that many
+    worker processes and written by this one in batches"""
 
-    def __init__(self, db_host, dbname, paths, overwrite=False, drop=False):
+    def __init__(self, db_host, dbname, paths, overwrite=False, drop=False, jobs=1):
         self.paths = paths
         self.overwrite = overwrite
+        self.jobs = jobs
+        # (path, error) of each man page run couldn't add
+        self.failed = []
 
-        self.store = store.Store(dbname, db_host)
+        self.store = store.get_store(dbname, db_host, snapshot=False)
 
         self.classifier = classifier.Classifier(self.store, "bayes")
         self.classifier.train()
@@ -42,7 +73,8 @@ class Manager:
     def ctx(self, m):
         return ManagerCtx(self.classifier, self.store, m)
 
-    def _read(self, ctx, f_runner):
+    @staticmethod
+    def _read(ctx, f_runner):
         f_runner.pre_get_raw_manpage()
         ctx.manpage.read()
         ctx.manpage.parse()
@@ -57,7 +89,8 @@ class Manager:
         )
         f_runner.post_parse_manpage()
 
-    def _classify(self, ctx, fr_runner):
+    @staticmethod
+    def _classify(ctx, fr_runner):
         ctx.classifiermanpage = store.ClassifierManpage(
             ctx.name, ctx.manpage.paragraphs
         )
@@ -65,29 +98,32 @@ class Manager:
         _ = list(ctx.classifier.classify(ctx.classifiermanpage))
         fr_runner.post_classify()
 
-    def _extract(self, ctx, f_runner):
+    @staticmethod
+    def _extract(ctx, f_runner):
         options.extract(ctx.manpage)
         f_runner.post_option_extraction()
         if not ctx.manpage.options:
             logger.warning("couldn't find any options for manpage %s", ctx.manpage.name)
 
-    def _write(self, ctx, f_runner):
-        f_runner.pre_add_manpage()
-        return ctx.store.add_manpage(ctx.manpage)
-
     def _update(self, ctx, f_runner):
         f_runner.pre_add_manpage()
         return ctx.store.updatemanpage(ctx.manpage)
 
-    def process(self, ctx):
+    @staticmethod
+    def prepare(ctx):
+        """read, classify and extract the options of ctx.manpage, everything
+        but writing it. ctx.store isn't used"""
         f_runner = fixer.Runner(ctx)
 
-        self._read(ctx, f_runner)
-        self._classify(ctx, f_runner)
-        self._extract(ctx, f_runner)
+        Manager._read(ctx, f_runner)
+        Manager._classify(ctx, f_runner)
+        Manager._extract(ctx, f_runner)
 
-        m = self._write(ctx, f_runner)
-        return m
+        f_runner.pre_add_manpage()
+        return ctx.manpage
+
+    def process(self, ctx):
+        return ctx.store.add_manpage(self.prepare(ctx))
 
     def edit(self, m, paragraphs=None):
         ctx = self.ctx(m)
@@ -102,28 +138,94 @@ class Manager:
         m = self._update(ctx, f_runner)
         return m
 
+    def _exists(self, m):
+        """tell if m is in the store already and shouldn't be overwritten"""
+        try:
+            mps = self.store.find_man_page(m.short_path[:-3])
+        except errors.ProgramDoesNotExist:
+            return False
+        mps = [mp for mp in mps if m.short_path == mp.source]
+        if mps:
+            assert len(mps) == 1
+            mp = mps[0]
+            if not self.overwrite or mp.updated:
+                logger.info(
+                    "manpage %r already in the data store, not overwriting it",
+                    m.name,
+                )
+                return True
+        return False
+
     def run(self):
+        """add the man pages in paths to the store, in the order of their
+        paths. returns the added man pages and the ones that already exist,
+        the ones that failed are in failed"""
+        self.failed = []
+        self.store.ensure_indexes()
+        paths = sorted(self.paths)
+        if self.jobs > 1:
+            added, exists = self._run_pool(paths)
+        else:
+            added, exists = self._run_serial(paths)
+
+        if not added:
+            logger.warning("no manpages added")
+        else:
+            self.findmulti_cmds()
+
+        return added, exists
+
+    def _run_pool(self, paths):
+        exists = []
+        pending = []
+        for path in paths:
+            m = manpage.ManPage(path)
+            if self._exists(m):
+                exists.append(m)
+            else:
+                pending.append(path)
+
+        prepared = []
+
+        def results():
+            with concurrent.futures.ProcessPoolExecutor(
+                self.jobs,
+                initializer=_init_worker,
+                initargs=(self.classifier.classifier,),
+            ) as pool:
+                # map yields in the order of pending, however the workers
+                # finish
+                for path, m, error in pool.map(_prepare_page, pending):
+                    if error is None:
+                        logger.info("prepared manpage %s (from %s)", m.name, path)
+                        prepared.append((path, m))
+                        yield m
+                    else:
+                        logger.error("couldn't prepare manpage %s: %s", path, error)
+                        self.failed.append((path, error))
+
+        added = []
+        # add_manpages writes while the workers prepare the rest, and returns
+        # once results is exhausted so prepared is complete
+        written = self.store.add_manpages(results())
+        for (path, m), result in zip(prepared, written):
+            if result.error:
+                logger.error("couldn't write manpage %s: %s", path, result.error)
+                self.failed.append((path, result.error))
+            else:
+                added.append(m)
+        return added, exists
+
+    def _run_serial(self, paths):
         added = []
         exists = []
-        for path in self.paths:
+        for path in paths:
             try:
                 m = manpage.ManPage(path)
                 logger.info("handling manpage %s (from %s)", m.name, path)
-                try:
-                    mps = self.store.find_man_page(m.short_path[:-3])
-                    mps = [mp for mp in mps if m.short_path == mp.source]
-                    if mps:
-                        assert len(mps) == 1
-                        mp = mps[0]
-                        if not self.overwrite or mp.updated:
-                            logger.info(
-                                "manpage %r already in the data store, not overwriting it",
-                                m.name,
-                            )
-                            exists.append(m)
-                            continue
-                except errors.ProgramDoesNotExist:
-                    pass
+                if self._exists(m):
+                    exists.append(m)
+                    continue
 
                 # the manpage is not in the data store; process and add it
                 ctx = self.ctx(m)
@@ -132,24 +234,23 @@ class Manager:
                     added.append(m)
             except errors.EmptyManpage as e:
                 logger.error("manpage %r is empty!", e.args[0])
-            except ValueError:
+                self.failed.append((path, f"manpage {e.args[0]!r} is empty"))
+            except ValueError as e:
                 logger.fatal("uncaught exception when handling manpage %s", path)
+                self.failed.append((path, f"{type(e).__name__}: {e}"))
             except KeyboardInterrupt:
                 raise
             except Exception as error_msg:
                 logger.fatal(f"uncaught exception when handling manpage '{path}' -> error: {error_msg}")
                 raise
-        if not added:
-            logger.warning("no manpages added")
-        else:
-            self.findmulti_cmds()
-
         return added, exists
 
     def findmulti_cmds(self):
         manpages = {}
         potential = []
-        for _id, m in self.store.names():
+        # sorted so the mappings are added in the same order whatever order
+        # the pages were written in
+        for _id, m in sorted(self.store.names(), key=lambda x: (x[1], x[0])):
             if "-" in m:
                 potential.append((m.split("-"), _id))
             else:
@@ -177,11 +278,116 @@ class Manager:
         return mappings_to_a, multi_cmds
 
 
-def main(files, dbname, db_host, overwrite, drop, verify):
+def explain_queries(s):
+    """print the winning plan of each lookup query, return False if one of
+    them isn't using an index"""
+    ok = True
+    for description, stages, covered in s.explain_queries():
+        print(f"{'ok' if covered else 'NOT COVERED'}: {description} ({' <- '.join(stages)})")
+        ok = ok and covered
+    return ok
+
+
+def export_snapshot(s, path):
+    n = snapshot.write_snapshot(path, s.manpage.find(), s.mapping.find(), s.generation)
+    print(f"exported {n} manpages to '{path}'")
+
+
+def verify_report(s, as_json=False):
+    """print the problems found in the store, return True if there are none"""
+    report = s.verify_report()
+    if as_json:
+        json.dump(report._asdict(), sys.stdout, default=str, indent=2)
+        print()
+        return report.ok
+
+    for d in report.dangling_mappings:
+        print(f"dangling mapping: {d['src']!r} -> {d['dst']}")
+    for d in report.orphaned_pages:
+        print(f"orphaned manpage: {d['name']!r} ({d['source']})")
+    for d in report.duplicate_sources:
+        print(f"duplicate source: {d['source']!r} ({len(d['ids'])} copies)")
+    if report.ok:
+        print("ok")
+    return report.ok
+
+
+def prewarm(s, n):
+    """render the pages of the n largest man pages into the page cache on
+    disk (PAGE_CACHE_PATH) that the web processes share, in every theme"""
+    from explainshell.web import app, views
+
+    if views.pages_disk is None:
+        print("PAGE_CACHE_PATH isn't set, there's no page cache to prewarm")
+        return False
+
+    count = 0
+    for source in s.largest_sources(n):
+        # the name /explain/<section>/<name> links look up
+        program = source[:-3]
+        for theme in views.PAGE_THEMES:
+            with app.test_request_context(headers={"Cookie": f"theme={theme}"}):
+                try:
+                    views.cached_program_page(program, s, theme)
+                except errors.ProgramDoesNotExist:
+                    print(f"no man page found for '{program}'")
+                    break
+        else:
+            count += 1
+    print(f"prewarmed {count} pages")
+    return True
+
+
+def retrain_classifier(s):
+    """train the classifier again and save it to CLASSIFIER_MODEL_PATH, even
+    if the training set didn't change"""
+    c = classifier.Classifier(s, "bayes")
+    c.train(force=True)
+    if c.model_path:
+        print(f"trained the classifier and saved it to '{c.model_path}'")
+    else:
+        print("trained the classifier, CLASSIFIER_MODEL_PATH isn't set to save it")
+    return True
+
+
+def main(
+    files,
+    dbname,
+    db_host,
+    overwrite,
+    drop,
+    verify,
+    explain=False,
+    snapshot_path=None,
+    as_json=False,
+    prewarm_count=0,
+    retrain=False,
+    jobs=1,
+    indexes=False,
+):
+    if snapshot_path:
+        export_snapshot(store.Store(dbname, db_host), snapshot_path)
+        return 0
+
     if verify:
         s = store.Store(dbname, db_host)
-        ok = s.verify()
-        return 0 if ok else 1
+        return 0 if verify_report(s, as_json) else 1
+
+    if explain:
+        s = store.get_store(dbname, db_host, snapshot=False)
+        return 0 if explain_queries(s) else 1
+
+    if prewarm_count:
+        s = store.Store(dbname, db_host)
+        return 0 if prewarm(s, prewarm_count) else 1
+
+    if retrain:
+        s = store.Store(dbname, db_host)
+        return 0 if retrain_classifier(s) else 1
+
+    if indexes:
+        store.Store(dbname, db_host).ensure_indexes()
+        return 0
 
     if drop:
         if input("really drop db (y/n)? ").strip().lower() != "y":
@@ -199,10 +405,12 @@ def main(files, dbname, db_host, overwrite, drop, verify):
         else:
             gzs.add(os.path.abspath(path))
 
-    m = Manager(db_host, dbname, gzs, overwrite, drop)
+    m = Manager(db_host, dbname, gzs, overwrite, drop, jobs)
     added, exists = m.run()
     for mp in added:
         print(f"successfully added '{mp.source}'")
+    for path, error in m.failed:
+        print(f"failed to add '{path}': {error}")
     if exists:
         print(
             "these manpages already existed and were not overwritten: \n\n%s"
@@ -234,10 +442,70 @@ if __name__ == "__main__":
     parser.add_argument(
         "--verify", action="store_true", default=False, help="verify db integrity"
     )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        default=False,
+        help="print the --verify report as json",
+    )
+    parser.add_argument(
+        "--explain-queries",
+        action="store_true",
+        default=False,
+        help="report which lookup queries are not covered by an index",
+    )
+    parser.add_argument(
+        "--export-snapshot",
+        metavar="PATH",
+        help="write the man pages to a snapshot file that can be served with "
+        "SNAPSHOT_PATH=PATH instead of mongodb",
+    )
+    parser.add_argument(
+        "--prewarm",
+        metavar="N",
+        type=int,
+        default=0,
+        help="render the pages of the N largest man pages into the page cache "
+        "at PAGE_CACHE_PATH",
+    )
+    parser.add_argument(
+        "--retrain-classifier",
+        action="store_true",
+        default=False,
+        help="train the classifier again and save it to CLASSIFIER_MODEL_PATH",
+    )
+    parser.add_argument(
+        "--ensure-indexes",
+        action="store_true",
+        default=False,
+        help="create the indexes the lookups need, adding man pages does it "
+        "too. run it when deploying a restored db, the web tier doesn't",
+    )
+    parser.add_argument(
+        "--jobs",
+        metavar="N",
+        type=int,
+        default=1,
+        help="read, classify and extract man pages in N processes",
+    )
     parser.add_argument("files", nargs="*")
 
     args = parser.parse_args()
     logging.basicConfig(level=getattr(logging, args.log.upper()))
     sys.exit(
-        main(args.files, args.db, args.host, args.overwrite, args.drop, args.verify)
+        main(
+            args.files,
+            args.db,
+            args.host,
+            args.overwrite,
+            args.drop,
+            args.verify,
+            args.explain_queries,
+            args.export_snapshot,
+            args.json,
+            args.prewarm,
+            args.retrain_classifier,
+            args.jobs,
+            args.ensure_indexes,
+        )
     )
@@ -1,11 +1,15 @@
 import collections
+import concurrent.futures
 import logging
 import itertools
+import os
+import threading
+import time
 
 import bashlex.parser
 import bashlex.ast
 
-from explainshell import errors, help_constants, util
+from explainshell import config, errors, help_constants, metrics, timing, util
 
 
 class MatchGroup:
@@ -32,15 +36,130 @@ match_word_exp = collections.namedtuple("match_word_exp", "start end kind")
 
 logger = logging.getLogger(__name__)
 
+class Budget(collections.namedtuple("Budget", "nodes depth lookups seconds")):
+    """limits on the work Matcher.match does for a single command, 0 means
+    no limit
+
+    nodes - the number of AST nodes visited
+    depth - how deep nodes are nested
+    lookups - the number of commands looked up in the store, a name that was
+              prefetched counts when it's used, like it would if it was
+              looked up then
+    seconds - wall time spent visiting the AST
+    """
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            config.MATCH_MAX_NODES,
+            config.MATCH_MAX_DEPTH,
+            config.MATCH_MAX_LOOKUPS,
+            config.MATCH_MAX_SECONDS,
+        )
+
+
+class _BudgetExceeded(Exception):
+    """raised inside the visitor to unwind it when a budget runs out, the
+    argument is the name of the budget"""
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _lookup_executor():
+    """the thread pool shared by every Matcher in the process that resolves
+    names concurrently, see Matcher._prefetch"""
+    global _executor, _executor_pid
+    with _executor_lock:
+        # threads don't survive a fork
+        if _executor_pid != os.getpid():
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                config.LOOKUP_POOL_SIZE, thread_name_prefix="lookup"
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+class _CommandWords(bashlex.ast.nodevisitor):
+    """collect the names Matcher may look up in the store, see
+    Matcher._prefetch
+
+    the walk is held to the nodes and depth of budget: it stops after as many
+    nodes as the Matcher may visit and doesn't go deeper than it may"""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.names = {}
+        self.starts = {}
+        self.nodes = 0
+        self._depth = 0
+
+    @classmethod
+    def collect(cls, ast, budget):
+        """return (names, starts): the names, and the first word of every
+        command"""
+        v = cls(budget)
+        try:
+            v.visit(ast)
+        except _BudgetExceeded:
+            logger.info("stopped collecting names after %d nodes", v.nodes)
+        return list(v.names), list(v.starts)
+
+    def visit(self, node):
+        self.nodes += 1
+        if self.budget.nodes and self.nodes > self.budget.nodes:
+            raise _BudgetExceeded("nodes")
+        if self.budget.depth and self._depth >= self.budget.depth:
+            return
+
+        self._depth += 1
+        try:
+            super().visit(node)
+        finally:
+            self._depth -= 1
+
+    def visitcommand(self, node, parts):
+        # the words Matcher.startcommand looks up: the first one, it with the
+        # one after it if it turns out to be a multi command, and the one
+        # after it alone if it's a command nested in this one (sudo X,
+        # xargs X)
+        words = [p for p in parts if p.kind == "word"]
+        if not words or words[0].parts:
+            return
+        word = words[0].word
+        self.starts[word] = None
+        self.names[word] = None
+        if len(words) > 1 and not words[1].parts:
+            self.names[f"{word} {words[1].word}"] = None
+            if not words[1].word.startswith("-"):
+                self.names[words[1].word] = None
+
 
 class Matcher(bashlex.ast.nodevisitor):
     """parse a command line and return a list of `MatchResult`s describing
     each token.
+
+    the time spent in each phase of match() and the number of store calls are
+    recorded in `timings`, a timing.Timings
+
+    match() gives up once it goes over `budget` (Budget.from_config() by
+    default), the rest of the input is then marked unknown and `truncated`
+    is set to the name of the budget that ran out
     """
 
-    def __init__(self, s, store):
+    def __init__(self, s, store, timings=timing.NULL, budget=None, concurrency=None):
         self.s = s
         self.store = store
+        self.timings = timings
+        self.budget = budget or Budget.from_config()
+        if concurrency is None:
+            concurrency = config.LOOKUP_CONCURRENCY
+        self.concurrency = concurrency
+        self.truncated = None
+        self._nodes = self._depth = self._lookups = 0
+        self._deadline = None
         self._prev_option = self._current_option = None
         self.groups = [MatchGroup("shell")]
 
@@ -67,9 +186,13 @@ class Matcher(bashlex.ast.nodevisitor):
         # show up as unknown or be taken from the db
         self.functions = set()
 
+        # name -> man pages (None if it doesn't exist) of every name resolved
+        # up front by _prefetch
+        self._man_pages = {}
+
     def _generate_cmd_group_name(self):
-        existing = len([g for g in self.groups if g.name.startswith("command")])
-        return f"command{existing}"
+        # every group but the first (shell) one is a command group
+        return f"command{len(self.groups) - 1}"
 
     @property
     def matches(self):
@@ -95,11 +218,120 @@ class Matcher(bashlex.ast.nodevisitor):
         return self._current_option
 
     def find_man_pages(self, prog):
-        logger.info("looking up %r in store", prog)
-        man_pages = self.store.find_man_page(prog)
+        if prog in self._man_pages:
+            self._charge()
+            man_pages = self._man_pages[prog]
+            if man_pages is None:
+                raise errors.ProgramDoesNotExist(prog)
+            if isinstance(man_pages, errors.ProgramDoesNotExist):
+                raise errors.ProgramDoesNotExist(*man_pages.args)
+        else:
+            logger.info("looking up %r in store", prog)
+            self._lookup()
+            with self.timings.phase("lookup"):
+                man_pages = self.store.find_man_page(prog, lazy=True)
         logger.info("found %r in store, got: %r, using %r", prog, man_pages, man_pages[0])
         return man_pages
 
+    def _prefetch(self):
+        """resolve the names the visitor looks up in a single store call: the
+        first word of every command, and it with the word after it for multi
+        commands (git commit). nested commands (sudo git commit) are looked
+        up when they're reached
+
+        names with a section (see util.split_section) are left to
+        find_man_pages, unless concurrency is set: then the commands that
+        start with one are looked up on the lookup pool, at the same time as
+        the other names
+
+        nothing is charged against the lookups budget here: every name is
+        charged when find_man_pages uses it, so the budget runs out at the
+        same command with or without prefetching and concurrency"""
+        words, starts = _CommandWords.collect(self.ast, self.budget)
+        names = [name for name in words if util.split_section(name)[1] is None]
+        sectioned = []
+        if self.concurrency > 0:
+            sectioned = [
+                name for name in starts if util.split_section(name)[1] is not None
+            ]
+        if not names and not sectioned:
+            return
+
+        if names:
+            self._count_store_calls()
+        with self.timings.phase("prefetch"):
+            if sectioned:
+                self._count_store_calls(len(sectioned))
+                found = self._resolve_concurrently(names, sectioned)
+            else:
+                found = self.store.find_man_pages(names, lazy=True)
+        logger.info("prefetched %d of %d names", len(found), len(names))
+        self._man_pages = {name: found.get(name) for name in names + sectioned}
+
+    def _resolve_concurrently(self, names, sectioned):
+        """resolve names with one find_man_pages call and every name in
+        sectioned with its own find_man_page call, spread over at most
+        `concurrency` threads of the lookup pool
+
+        returns find_man_pages' dict, with the ProgramDoesNotExist raised
+        for a name in sectioned as its value"""
+
+        def resolve(name):
+            try:
+                return self.store.find_man_page(name, lazy=True)
+            except errors.ProgramDoesNotExist as e:
+                return e
+
+        def run(tasks):
+            return [task() for task in tasks]
+
+        tasks = [lambda name=name: (name, resolve(name)) for name in sectioned]
+        if names:
+            tasks.insert(0, lambda: self.store.find_man_pages(names, lazy=True))
+
+        n = min(self.concurrency, len(tasks))
+        executor = _lookup_executor()
+        futures = [executor.submit(run, tasks[i::n]) for i in range(n)]
+
+        found = {}
+        results = itertools.chain.from_iterable(f.result() for f in futures)
+        for result in results:
+            if isinstance(result, dict):
+                found.update(result)
+            else:
+                found[result[0]] = result[1]
+        return found
+
+    def _count_store_calls(self, n=1):
+        self.timings.count("store", n)
+        metrics.REGISTRY.inc("explainshell_store_calls_total", n)
+
+    def _lookup(self):
+        """account for a store call"""
+        self._count_store_calls()
+        self._charge()
+
+    def _charge(self):
+        """charge a lookup against the budget"""
+        self._lookups += 1
+        if self.budget.lookups and self._lookups > self.budget.lookups:
+            raise _BudgetExceeded("lookups")
+
+    def visit(self, node):
+        self._nodes += 1
+        if self.budget.nodes and self._nodes > self.budget.nodes:
+            raise _BudgetExceeded("nodes")
+        if self.budget.depth and self._depth >= self.budget.depth:
+            raise _BudgetExceeded("depth")
+        if self._deadline is not None and time.monotonic() > self._deadline:
+            raise _BudgetExceeded("seconds")
+
+        self._depth += 1
+        try:
+            super().visit(node)
+        finally:
+            self._depth -= 1
+
     def unknown(self, token, start, end):
         logger.debug("nothing to do with token %r", token)
         return MatchResult(start, end, None, None)
@@ -622,11 +854,36 @@ class Matcher(bashlex.ast.nodevisitor):
         logger.info(f"matching string {self.s}")
 
         # limit recursive parsing to a depth of 1
-        self.ast = bashlex.parser.parsesingle(
-            self.s, expansionlimit=1, strictmode=False
-        )
+        with self.timings.phase("parse"):
+            self.ast = bashlex.parser.parsesingle(
+                self.s, expansionlimit=1, strictmode=False
+            )
         if self.ast:
-            self.visit(self.ast)
+            if self.budget.seconds:
+                self._deadline = time.monotonic() + self.budget.seconds
+            try:
+                self._prefetch()
+                with self.timings.phase("visit"):
+                    self.visit(self.ast)
+            except _BudgetExceeded as e:
+                self.truncated = e.args[0]
+                metrics.REGISTRY.inc(
+                    "explainshell_match_truncated_total", budget=self.truncated
+                )
+                self.timings.count("truncated")
+                logger.warning(
+                    "%s budget exceeded after %d nodes matching %r",
+                    self.truncated,
+                    self._nodes,
+                    self.s[:100],
+                )
+                # the visitor was unwound half way, whatever wasn't matched
+                # is marked unknown by _mark_unparsed_unknown
+                del self.group_stack[1:]
+                self.compound_stack.clear()
+                # a command group started just before the budget ran out may
+                # have nothing in it yet
+                self.groups[1:] = [g for g in self.groups[1:] if g.results]
             assert (
                 len(self.group_stack) == 1
             ), "groupstack should contain only shell group after matching"
@@ -634,7 +891,8 @@ class Matcher(bashlex.ast.nodevisitor):
             # if we only have one command in there and no shell results/expansions,
             # reraise the original exception
             if (
-                len(self.groups) == 2
+                not self.truncated
+                and len(self.groups) == 2
                 and not self.groups[0].results
                 and self.groups[1].manpage is None
                 and not self.expansions
@@ -652,8 +910,25 @@ class Matcher(bashlex.ast.nodevisitor):
             )
             return s
 
+        with self.timings.phase("merge"):
+            self._fix_groups()
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%r matches:\n%s", self.s, debug_match())
+
+        # not strictly needed, but doesn't hurt
+        self.expansions.sort()
+
+        return self.groups
+
+    def _fix_groups(self):
         self._mark_unparsed_unknown()
 
+        # merging a group replaces a run of its results with a single result
+        # that starts where the run started, which doesn't change the order of
+        # anything else, so the index is computed once for all groups
+        result_index = self._result_index()
+
         # fix each MatchGroup separately
         for group in self.groups:
             if group.results:
@@ -662,7 +937,7 @@ class Matcher(bashlex.ast.nodevisitor):
                     # something as its synopsis)
                     assert not group.results[0].unknown
 
-                group.results = self._merge_adjacent(group.results)
+                group.results = self._merge_adjacent(group.results, result_index)
 
                 # add MatchResult.match to existing matches
                 for i, m in enumerate(group.results):
@@ -671,44 +946,41 @@ class Matcher(bashlex.ast.nodevisitor):
                     portion = self.s[m.start: m.end]
                     group.results[i] = MatchResult(m.start, m.end, m.text, portion)
 
-        logger.debug("%r matches:\n%s", self.s, debug_match())
-
-        # not strictly needed, but doesn't hurt
-        self.expansions.sort()
-
-        return self.groups
-
     def _mark_unparsed_unknown(self):
         """the parser may leave a remainder at the end of the string if it doesn't
         match any of the rules, mark them as unknowns"""
-        parsed = [False] * len(self.s)
-
-        # go over all existing matches to see if we've covered the
-        # current position
-        for start, end, _, _ in self.all_matches:
-            for i in range(start, end):
-                parsed[i] = True
-
-        for i, parsed_i in enumerate(parsed):
-            c = self.s[i]
-            # whitespace is always 'unparsed'
-            if c.isspace():
-                parsed[i] = True
-
-            # the parser ignores comments but we can use a trick to see if this
-            # starts a comment and is beyond the ending index of the parsed
-            # portion of the input
-            if (not self.ast or i > self.ast.pos[1]) and c == "#":
-                comment = MatchResult(i, len(parsed), help_constants.COMMENT, None)
-                self.groups[0].results.append(comment)
-                break
-
-            if not parsed[i]:
-                # add unparsed results to the 'shell' group
-                self.groups[0].results.append(self.unknown(c, i, i + 1))
+        # the parser ignores comments but we can use a trick to see if this
+        # starts a comment and is beyond the ending index of the parsed
+        # portion of the input
+        comment = self.s.find("#", self.ast.pos[1] + 1 if self.ast else 0)
+        end = comment if comment != -1 else len(self.s)
+
+        # sweep over the existing matches sorted by their start to find the
+        # gaps between them
+        gaps = []
+        pos = 0
+        for start, stop in sorted((m.start, m.end) for m in self.all_matches):
+            if start > pos:
+                gaps.append((pos, start))
+            pos = max(pos, stop)
+        gaps.append((pos, len(self.s)))
+
+        results = self.groups[0].results
+        for start, stop in gaps:
+            for i in range(start, min(stop, end)):
+                c = self.s[i]
+                # whitespace is always 'unparsed'
+                if not c.isspace():
+                    # add unparsed results to the 'shell' group
+                    results.append(self.unknown(c, i, i + 1))
+
+        if comment != -1:
+            results.append(
+                MatchResult(comment, len(self.s), help_constants.COMMENT, None)
+            )
 
         # there are no overlaps, so sorting by the start is enough
-        self.groups[0].results.sort(key=lambda mr: mr.start)
+        results.sort(key=lambda mr: mr.start)
 
     def _result_index(self):
         """return a mapping of `MatchResult`s to their index among all
@@ -720,22 +992,17 @@ class Matcher(bashlex.ast.nodevisitor):
             i += 1
         return d
 
-    def _merge_adjacent(self, matches):
+    def _merge_adjacent(self, matches, result_index):
+        """merge consecutive results with the same text, result_index is the
+        mapping returned by _result_index"""
         merged = []
-        result_index = self._result_index()
         same_text = itertools.groupby(matches, lambda m: m.text)
         for text, ll in same_text:
             for l_group in util.group_continuous(ll, key=lambda m: result_index[m]):
-                l_group = list(l_group)
-
                 if len(l_group) == 1:
                     merged.append(l_group[0])
                 else:
                     start = l_group[0].start
                     end = l_group[-1].end
-                    end_index = result_index[l_group[-1]]
-                    for mr in l_group:
-                        del result_index[mr]
                     merged.append(MatchResult(start, end, text, None))
-                    result_index[merged[-1]] = end_index
         return merged
@@ -0,0 +1,260 @@
+"""
+counters and histograms of what the web tier does, exposed in the prometheus
+text format on /metrics
+
+uwsgi and gunicorn run several worker processes and a scrape only reaches one
+of them, so with METRICS_DIR set every process writes its values to a file of
+its own in that directory and /metrics sums the files of all of them. the
+directory should be emptied when the workers are (re)started as a whole, the
+files of exited workers are kept so counters never go backwards.
+"""
+
+import atexit
+import collections
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from explainshell import config
+
+logger = logging.getLogger(__name__)
+
+# upper bounds (seconds) of the request duration histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# name -> (type, help) of every series
+DEFINITIONS = {
+    "explainshell_requests_total": ("counter", "requests by endpoint and status"),
+    "explainshell_request_duration_seconds": (
+        "histogram",
+        "time to produce a response by endpoint, streamed bodies excluded",
+    ),
+    "explainshell_store_calls_total": ("counter", "store calls made by the matcher"),
+    "explainshell_cache_requests_total": (
+        "counter",
+        "cache lookups by cache and result (hit or miss)",
+    ),
+    "explainshell_explain_errors_total": (
+        "counter",
+        "commands that couldn't be explained by exception type",
+    ),
+    "explainshell_match_truncated_total": (
+        "counter",
+        "commands only partly explained by the budget that ran out",
+    ),
+}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Registry:
+    """the series of this process
+
+    counters are added to with inc(), histograms with observe(). values kept
+    elsewhere (e.g. the hit counts of a cache) are read when a snapshot is
+    taken from the collectors added with add_collector: functions that return
+    (name, labels, value) tuples of counters
+
+    path - the directory shared by the processes, None to only report this one
+    interval - the least number of seconds between two writes of this
+        process' file, see flush
+    """
+
+    def __init__(self, path=None, interval=1.0, clock=time.monotonic):
+        self.path = path
+        self.interval = interval
+        self._clock = clock
+        self._counters = collections.defaultdict(float)
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._flushed = None
+        self._pid = None
+        self._filename = None
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[_key(name, labels)] += value
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            key = _key(name, labels)
+            h = self._histograms.get(key)
+            if h is None:
+                # a count per bucket, the +Inf one last, and the sum
+                h = self._histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    break
+            else:
+                i = len(BUCKETS)
+            h[i] += 1
+            h[-1] += value
+
+    def add_collector(self, f):
+        self._collectors.append(f)
+        return f
+
+    def snapshot(self):
+        """the values of this process as a json serializable dict"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+        for f in self._collectors:
+            for name, labels, value in f():
+                key = _key(name, labels)
+                counters[key] = counters.get(key, 0) + value
+        return {
+            "counters": [[n, list(l), v] for (n, l), v in counters.items()],
+            "histograms": [[n, list(l), v] for (n, l), v in histograms.items()],
+        }
+
+    def _file(self):
+        # a forked worker starts a file of its own, and so does a process
+        # that got the pid of an exited one
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._filename = os.path.join(
+                self.path, f"{self._pid}-{uuid.uuid4().hex}.json"
+            )
+            self._flushed = None
+        return self._filename
+
+    def flush(self, force=False):
+        """write this process' values to its file in path, at most once every
+        interval seconds unless force is set"""
+        if not self.path:
+            return
+        now = self._clock()
+        filename = self._file()
+        if not force and self._flushed is not None:
+            if now - self._flushed < self.interval:
+                return
+        self._flushed = now
+
+        tmp = f"{filename}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp, filename)
+        except OSError:
+            logger.warning("couldn't write metrics to %s", filename, exc_info=True)
+
+    def collect(self):
+        """the values of every process, summed"""
+        snapshots = [self.snapshot()]
+        if self.path:
+            self.flush(force=True)
+            own = self._file()
+            for filename in glob.glob(os.path.join(self.path, "*.json")):
+                if filename == own:
+                    continue
+                try:
+                    with open(filename) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    logger.warning("couldn't read metrics from %s", filename)
+
+        counters = collections.defaultdict(float)
+        histograms = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot["counters"]:
+                counters[name, tuple(map(tuple, labels))] += value
+            for name, labels, value in snapshot["histograms"]:
+                key = name, tuple(map(tuple, labels))
+                if key in histograms:
+                    histograms[key] = [a + b for a, b in zip(histograms[key], value)]
+                else:
+                    histograms[key] = value
+        return counters, histograms
+
+    def exposition(self):
+        """the values of every process in the prometheus text format"""
+        counters, histograms = self.collect()
+
+        series = collections.defaultdict(list)
+        for (name, labels), value in sorted(counters.items()):
+            series[name].append(f"{name}{_labels(labels)} {_value(value)}")
+        for (name, labels), h in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), h):
+                cumulative += count
+                le = labels + (("le", str(bound)),)
+                series[name].append(f"{name}_bucket{_labels(le)} {cumulative}")
+            series[name].append(f"{name}_sum{_labels(labels)} {_value(h[-1])}")
+            series[name].append(f"{name}_count{_labels(labels)} {cumulative}")
+
+        lines = []
+        for name in sorted(series):
+            kind, help_ = DEFINITIONS.get(name, ("untyped", name))
+            lines.append(f"# HELP {name} {help_}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(series[name])
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    """
+    >>> _labels((('a', 'x'), ('b', 'say "hi"')))
+    '{a="x",b="say \\\\"hi\\\\""}'
+    >>> _labels(())
+    ''
+    """
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _value(v):
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+
+REGISTRY = Registry(config.METRICS_DIR or None, config.METRICS_FLUSH_INTERVAL)
+
+
+def init_app(app, registry=REGISTRY):
+    """count the requests app serves and how long they take, and serve the
+    values of registry on /metrics"""
+    import flask
+
+    # the last requests of an exiting worker
+    atexit.register(registry.flush, force=True)
+
+    @app.before_request
+    def start_request_timer():
+        flask.g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def count_request(response):
+        start = flask.g.get("metrics_start")
+        rule = flask.request.url_rule
+        endpoint = rule.rule if rule is not None else "unmatched"
+        registry.inc(
+            "explainshell_requests_total",
+            endpoint=endpoint,
+            status=str(response.status_code),
+        )
+        if start is not None:
+            registry.observe(
+                "explainshell_request_duration_seconds",
+                time.perf_counter() - start,
+                endpoint=endpoint,
+            )
+        registry.flush()
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        return app.response_class(
+            registry.exposition(), content_type="text/plain; version=0.0.4"
+        )
@@ -22,6 +22,7 @@ def extract(manpage):
                 manpage.paragraphs[i] = store.Option(p, s, ln, expects_arg)
             else:
                 logger.error("no options could be extracted from paragraph %r", p)
+    manpage.invalidate()
 
 
 opt_regex = re.compile(
@@ -0,0 +1,116 @@
+"""
+split a multi line script into its top level statements so each one can be
+explained (and cached) on its own
+"""
+
+import collections
+import logging
+
+import bashlex.ast
+import bashlex.errors
+import bashlex.parser
+
+logger = logging.getLogger(__name__)
+
+
+class Statement(collections.namedtuple("Statement", "start end line text")):
+    """a top level statement of a script
+
+    start, end - the span of the statement in the script
+    line - the line the statement starts at, counting from 1
+    text - the statement itself, heredocs included
+    """
+
+
+class _Extent(bashlex.ast.nodevisitor):
+    """find where a node really ends, the position of a command doesn't
+    include the heredocs of its redirects"""
+
+    def __init__(self):
+        self.end = 0
+
+    def visitnode(self, node):
+        self.end = max(self.end, node.pos[1])
+
+
+def _end(node):
+    v = _Extent()
+    v.visit(node)
+    return v.end
+
+
+def _lines(script, start, end):
+    """return the spans of script[start:end] split by lines, joining lines
+    that end with a backslash, and skip empty lines and comments"""
+    while start < end:
+        stop = start
+        while True:
+            stop = script.find("\n", stop, end)
+            if stop == -1:
+                stop = end
+                break
+            if script[stop - 1] != "\\":
+                break
+            stop += 1
+
+        line = script[start:stop]
+        stripped = line.strip()
+        if stripped and not stripped.startswith("#"):
+            offset = start + line.index(stripped)
+            yield offset, offset + len(stripped)
+        start = stop + 1
+
+
+def _parse(script, start, end):
+    """return the spans of the statements in script[start:end], raises if it
+    doesn't parse"""
+    # bashlex fails on input that has nothing but blank lines and comments
+    if not any(_lines(script, start, end)):
+        return []
+    nodes = bashlex.parser.parse(script[start:end])
+    return [(start + node.pos[0], start + _end(node)) for node in nodes]
+
+
+def split(script):
+    """return the top level statements of script as a list of Statement
+
+    if a statement doesn't parse, the lines from where it starts up to the
+    error are split by lines, so the statements around it can still be
+    explained"""
+    script = script.replace("\r\n", "\n")
+    spans = []
+    start = 0
+    while start < len(script):
+        try:
+            spans += _parse(script, start, len(script))
+            break
+        except bashlex.errors.ParsingError as e:
+            # e.s is the input from the statement that failed to parse, and
+            # e.position is relative to it
+            rest = len(script) - start
+            failed = start + rest - len(e.s) if len(e.s) <= rest else start
+            error = min(failed + e.position, len(script))
+        except NotImplementedError:
+            logger.info("couldn't parse script, splitting it by lines")
+            spans += _lines(script, start, len(script))
+            break
+
+        end = script.find("\n", error)
+        if end == -1:
+            end = len(script)
+        logger.info("couldn't parse %r, splitting it by lines", script[failed:end])
+
+        try:
+            spans += _parse(script, start, failed)
+        except (bashlex.errors.ParsingError, NotImplementedError):
+            spans += _lines(script, start, failed)
+        spans += _lines(script, failed, end)
+        start = end + 1
+
+    statements = []
+    line, pos = 1, 0
+    for start, end in spans:
+        line += script.count("\n", pos, start)
+        pos = start
+        statements.append(Statement(start, end, line, script[start:end]))
+    return statements
@@ -0,0 +1,377 @@
+"""
+a read only, single file snapshot of the manpage and mapping collections that
+can serve the web tier without a mongodb
+
+the file layout is:
+
+    header | manpage documents | pages | mappings | indexes | strings
+
+- header - MAGIC, the store generation, the number of pages, of mappings and
+  of mappings to pages in the snapshot, and the offset of every section after
+  the documents
+- manpage documents - every man page, BSON encoded, back to back
+- pages - a PAGE record for every man page in the collection's order
+- mappings - a MAPPING record for every mapping in the collection's order
+- indexes - arrays of record numbers (native unsigned ints): the pages sorted
+  by source, the pages sorted by name and _id, the mappings sorted by src and
+  the mappings sorted by the page they point to
+- strings - the names, sources and srcs the records point to, utf-8 encoded
+
+everything is looked up in the mapped file by bisecting the indexes, so the
+tables are never loaded into python objects
+"""
+
+import array
+import bisect
+import logging
+import mmap
+import os
+import struct
+
+import bson
+
+from explainshell import cache, config, errors, util
+from explainshell.store import ManPage, manpage_index_entry
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"ESSNAP02"
+# magic, generation, the number of pages, of mappings and of mappings to
+# pages in the snapshot, and the offsets of the pages, mappings, the four
+# indexes and the strings
+HEADER = struct.Struct(f"<{len(MAGIC)}sqIII7Q")
+# _id, name and source (offset and length in strings), offset and length of
+# the document
+PAGE = struct.Struct("<12sIIIIQI")
+# _id, src (offset and length in strings), dst, the number of the page dst
+# is (-1 if it's not in the snapshot) and score
+MAPPING = struct.Struct("<12sII12sid")
+# the item type of the indexes
+INDEX_TYPE = "I"
+
+
+def _align(f):
+    """pad f to a multiple of 8 bytes so the indexes can be cast in place"""
+    f.write(b"\0" * (-f.tell() % 8))
+    return f.tell()
+
+
+def write_snapshot(path, manpages, mappings, generation=0):
+    """write the documents of the manpage and mapping collections to path
+
+    the snapshot is written to a temporary file first and moved into place,
+    so a SnapshotStore never sees a partially written file"""
+    tmp = f"{path}.tmp"
+    strings = bytearray()
+
+    def string(s):
+        data = s.encode("utf-8")
+        strings.extend(data)
+        return len(strings) - len(data), len(data)
+
+    pages = []
+    with open(tmp, "wb") as f:
+        f.write(b"\0" * HEADER.size)
+        for d in manpages:
+            data = bson.encode(d)
+            pages.append((d["_id"], d["name"], d["source"], f.tell(), len(data)))
+            f.write(data)
+
+        pages_offset = _align(f)
+        ordinals = {}
+        for i, (oid, name, source, offset, length) in enumerate(pages):
+            ordinals[oid] = i
+            f.write(
+                PAGE.pack(oid.binary, *string(name), *string(source), offset, length)
+            )
+
+        maps_offset = _align(f)
+        maps = []
+        for d in mappings:
+            dst = ordinals.get(d["dst"], -1)
+            maps.append((d["src"].encode("utf-8"), dst))
+            f.write(
+                MAPPING.pack(
+                    d["_id"].binary, *string(d["src"]), d["dst"].binary, dst, d["score"]
+                )
+            )
+
+        def index(keys):
+            return array.array(
+                INDEX_TYPE, sorted(range(len(keys)), key=keys.__getitem__)
+            )
+
+        indexes = [
+            index([p[2].encode("utf-8") for p in pages]),
+            index([(p[1].encode("utf-8"), p[0].binary) for p in pages]),
+            index([(src, j) for j, (src, _) in enumerate(maps)]),
+            array.array(
+                INDEX_TYPE,
+                sorted(
+                    (j for j, (_, dst) in enumerate(maps) if dst != -1),
+                    key=lambda j: (maps[j][1], j),
+                ),
+            ),
+        ]
+        offsets = []
+        for a in indexes:
+            offsets.append(_align(f))
+            a.tofile(f)
+
+        strings_offset = _align(f)
+        f.write(strings)
+
+        f.seek(0)
+        f.write(
+            HEADER.pack(
+                MAGIC,
+                generation,
+                len(pages),
+                len(maps),
+                len(indexes[3]),
+                pages_offset,
+                maps_offset,
+                *offsets,
+                strings_offset,
+            )
+        )
+    os.replace(tmp, path)
+    logger.info("wrote snapshot of %d manpages to %s", len(pages), path)
+    return len(pages)
+
+
+class SnapshotStore:
+    """a read only store that serves man pages from a file written by
+    write_snapshot
+
+    the file is memory mapped: man pages are decoded from it on demand and
+    names are looked up by bisecting the indexes in it, so every process
+    that maps the same file shares it through the page cache and pre-forked
+    workers don't each hold a copy of the data. only the find_man_page cache
+    is kept per process"""
+
+    def __init__(self, path):
+        logger.info("opening snapshot %r", path)
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[: len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not an explainshell snapshot")
+        (
+            _,
+            self.generation,
+            self._npages,
+            self._nmappings,
+            nmapped,
+            self._pages_offset,
+            self._maps_offset,
+            by_source,
+            by_name,
+            by_src,
+            by_dst,
+            self._strings_offset,
+        ) = HEADER.unpack_from(self._mmap, 0)
+
+        view = memoryview(self._mmap)
+        self._views = [view]
+
+        def index(offset, n):
+            size = array.array(INDEX_TYPE).itemsize
+            a = view[offset : offset + n * size].cast(INDEX_TYPE)
+            self._views.append(a)
+            return a
+
+        self._by_source = index(by_source, self._npages)
+        self._by_name = index(by_name, self._npages)
+        self._by_src = index(by_src, self._nmappings)
+        self._by_dst = index(by_dst, nmapped)
+
+        self.cache = cache.LRUCache(config.MANPAGE_CACHE_SIZE, config.MANPAGE_CACHE_TTL)
+
+    def close(self):
+        for v in reversed(getattr(self, "_views", [])):
+            v.release()
+        self._views = []
+        self._mmap.close()
+        self._file.close()
+
+    def _string(self, offset, length):
+        start = self._strings_offset + offset
+        return self._mmap[start : start + length]
+
+    def _page(self, i):
+        """(oid, name, source, offset, length) of page number i, name and
+        source as utf-8 bytes"""
+        oid, name_o, name_l, source_o, source_l, offset, length = PAGE.unpack_from(
+            self._mmap, self._pages_offset + i * PAGE.size
+        )
+        return (
+            oid,
+            self._string(name_o, name_l),
+            self._string(source_o, source_l),
+            offset,
+            length,
+        )
+
+    def _mapping(self, j):
+        """(_id, src, dst, page number of dst, score) of mapping number j, src
+        as utf-8 bytes"""
+        _id, src_o, src_l, dst, page, score = MAPPING.unpack_from(
+            self._mmap, self._maps_offset + j * MAPPING.size
+        )
+        return _id, self._string(src_o, src_l), dst, page, score
+
+    def _document(self, i):
+        _, _, _, offset, length = self._page(i)
+        return bson.decode(self._mmap[offset : offset + length])
+
+    def _load(self, i):
+        return ManPage.from_store(self._document(i))
+
+    def _name_only(self, i):
+        _, name, source, _, _ = self._page(i)
+        return ManPage.from_store_name_only(
+            name.decode("utf-8"), source.decode("utf-8")
+        )
+
+    def _section(self, i):
+        return util.name_section(self._page(i)[2].decode("utf-8")[:-3])[1]
+
+    def _src_range(self, src):
+        """the mapping numbers whose src is src, in the collection's order"""
+        src = src.encode("utf-8")
+        key = lambda j: self._mapping(j)[1]  # noqa: E731
+        lo = bisect.bisect_left(self._by_src, src, key=key)
+        hi = bisect.bisect_right(self._by_src, src, lo=lo, key=key)
+        return self._by_src[lo:hi].tolist()
+
+    def _dst_range(self, i):
+        """the mapping numbers that point to page number i"""
+        key = lambda j: self._mapping(j)[3]  # noqa: E731
+        lo = bisect.bisect_left(self._by_dst, i, key=key)
+        hi = bisect.bisect_right(self._by_dst, i, lo=lo, key=key)
+        return self._by_dst[lo:hi].tolist()
+
+    def __contains__(self, name):
+        return len(self._src_range(name)) > 0
+
+    def __iter__(self):
+        for i in range(self._npages):
+            yield self._load(i)
+
+    def names(self):
+        for i in range(self._npages):
+            oid, name, _, _, _ = self._page(i)
+            yield bson.ObjectId(oid), name.decode("utf-8")
+
+    def manpage_index(self, prefix="", after=None, limit=100):
+        """see store.Store.manpage_index, only the pages listed are decoded"""
+
+        def key(i):
+            oid, name, _, _, _ = self._page(i)
+            return name, oid
+
+        prefix_b = prefix.encode("utf-8")
+        if after is None:
+            start = bisect.bisect_left(self._by_name, (prefix_b, b""), key=key)
+        else:
+            name, oid = after
+            after_key = (name.encode("utf-8"), bson.ObjectId(oid).binary)
+            start = bisect.bisect_right(self._by_name, after_key, key=key)
+            start = max(
+                start, bisect.bisect_left(self._by_name, (prefix_b, b""), key=key)
+            )
+
+        entries = []
+        last = None
+        for i in self._by_name[start : start + limit + 1].tolist():
+            oid, name, _, _, _ = self._page(i)
+            if not name.startswith(prefix_b):
+                break
+            if len(entries) == limit:
+                return entries, last
+            entries.append(manpage_index_entry(self._document(i)))
+            last = name.decode("utf-8"), bson.ObjectId(oid)
+        return entries, None
+
+    def mappings(self):
+        for j in range(self._nmappings):
+            _id, src, _, _, _ = self._mapping(j)
+            yield src.decode("utf-8"), bson.ObjectId(_id)
+
+    def find_man_page(self, name, lazy=False):
+        """find a man page by its name, see store.Store.find_man_page
+
+        pages are decoded from the mapped file so there's nothing to gain
+        from loading them lazily, `lazy` is accepted for compatibility"""
+        if name.endswith(".gz"):
+            source = name.encode("utf-8")
+            key = lambda i: self._page(i)[2]  # noqa: E731
+            lo = bisect.bisect_left(self._by_source, source, key=key)
+            if lo == self._npages or key(self._by_source[lo]) != source:
+                raise errors.ProgramDoesNotExist(name)
+            return [self._load(self._by_source[lo])]
+
+        key = (name, self.generation)
+        mps = self.cache.get(key)
+        if mps is None:
+            mps = self._resolve(name)
+            self.cache.put(key, mps)
+        return list(mps)
+
+    def find_man_pages(self, names, lazy=False):
+        """see store.Store.find_man_pages"""
+        found = {}
+        for name in names:
+            try:
+                found[name] = self.find_man_page(name, lazy)
+            except errors.ProgramDoesNotExist:
+                pass
+        return found
+
+    def _resolve(self, name):
+        orig_name = name
+        name, section = util.split_section(name)
+
+        # dst -> (page number, score), the last mapping wins like a dict of
+        # them would
+        dsts = {}
+        for j in self._src_range(name):
+            _, _, dst, page, score = self._mapping(j)
+            dsts[dst] = (page, score)
+        if not dsts:
+            raise errors.ProgramDoesNotExist(name)
+
+        scores = {page: score for page, score in dsts.values() if page != -1}
+        results = sorted(scores)
+        if len(results) != len(dsts):
+            logger.error(
+                "%d of %d mappings for %r are missing in the snapshot",
+                len(dsts) - len(results),
+                len(dsts),
+                name,
+            )
+        if not results:
+            raise errors.ProgramDoesNotExist(name)
+
+        results.sort(key=lambda i: scores[i], reverse=True)
+        if section is not None:
+            results.sort(key=lambda i: self._section(i) == section, reverse=True)
+            if self._section(results[0]) != section:
+                raise errors.ProgramDoesNotExist(orig_name)
+
+            # suggestions are pages that share an alias with the one we found
+            skip = set(results)
+            suggestions = set()
+            for j in self._dst_range(results[0]):
+                src = self._mapping(j)[1].decode("utf-8")
+                suggestions.update(
+                    self._mapping(k)[3]
+                    for k in self._src_range(src)
+                    if self._mapping(k)[3] != -1
+                )
+            results.extend(sorted(suggestions - skip))
+
+        return [self._load(results[0])] + [self._name_only(i) for i in results[1:]]
@@ -2,19 +2,76 @@
 data objects to save processed man pages to mongodb
 """
 
+import atexit
 import collections
+import functools
+import os
 import re
 import logging
+import threading
+import time
 
 # from pprint import pprint
 
 import pymongo
+import pymongo.errors
 from bson import ObjectId
 
-from explainshell import errors, help_constants, util, config
+from explainshell import bloom, cache, errors, help_constants, util, config
 
 logger = logging.getLogger(__name__)
 
+# an aggregation expression that keeps only the paragraphs of a man page
+# that ManPage.from_store turns into an Option
+_OPTION_PARAGRAPHS = {
+    "$filter": {
+        "input": "$paragraphs",
+        "cond": {
+            "$and": [
+                {"$eq": ["$$this.is_option", True]},
+                {"$ne": [{"$type": "$$this.short"}, "missing"]},
+            ]
+        },
+    }
+}
+
+# the indexes our lookups rely on, by collection. see Store.ensure_indexes
+INDEXES = {
+    "mapping": [[("src", pymongo.ASCENDING)], [("dst", pymongo.ASCENDING)]],
+    "manpage": [
+        [("source", pymongo.ASCENDING)],
+        # manpage_index
+        [("name", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
+    ],
+}
+
+# the oldest server _resolve_pipeline runs on: $lookup with both localField
+# and a pipeline is new in mongodb 5.0. see Store.single_aggregation
+AGGREGATION_MIN_VERSION = (5, 0)
+
+# the fields of a manpage document manpage_index_entry needs
+MANPAGE_INDEX_FIELDS = {
+    "name": 1,
+    "synopsis": 1,
+    "paragraphs.is_option": 1,
+    "paragraphs.short": 1,
+    "paragraphs.long": 1,
+}
+
+
+def manpage_index_entry(d):
+    """the name, synopsis and option flags (a list per option) of the manpage
+    document d, which may only have MANPAGE_INDEX_FIELDS"""
+    return {
+        "name": d["name"],
+        "synopsis": d.get("synopsis") or "",
+        "options": [
+            p.get("short", []) + p.get("long", [])
+            for p in d.get("paragraphs", [])
+            if p.get("is_option") is True and "short" in p
+        ],
+    }
+
 
 class ClassifierManpage(collections.namedtuple("ClassifierManpage", "name paragraphs")):
     """a man page that had its paragraphs manually tagged as containing options
@@ -54,9 +111,7 @@ class Paragraph:
 
     @staticmethod
     def from_store(d):
-        p = Paragraph(
-            d.get("idx", 0), d["text"].encode("utf8"), d["section"], d["is_option"]
-        )
+        p = Paragraph(d.get("idx", 0), d["text"], d["section"], d["is_option"])
         return p
 
     def to_store(self):
@@ -152,6 +207,13 @@ class ManPage:
     updated - whether this man page was manually updated
     nested_cmd - specifies if positional arguments to this program can start a nested command,
         e.g. sudo, xargs
+
+    a man page loaded with only its option paragraphs (see from_store) fetches
+    the rest the first time `paragraphs` is accessed
+
+    options, arguments and the flags used by find_option are indexed the first
+    time one of them is needed. assigning paragraphs resets the index, code
+    that changes paragraphs in place must call invalidate
     """
 
     def __init__(
@@ -170,18 +232,65 @@ class ManPage:
         self.name = name
         self.synopsis = synopsis
         self.paragraphs = paragraphs
+        self._load_paragraphs = None
         self.aliases = aliases
         self.partial_match = partial_match
         self.multi_cmd = multi_cmd
         self.updated = updated
         self.nested_cmd = nested_cmd
 
+    @property
+    def paragraphs(self):
+        if self._load_paragraphs is not None:
+            logger.info("loading remaining paragraphs of %s", self.source)
+            self._paragraphs = self._load_paragraphs()
+            self._load_paragraphs = None
+            self._index = None
+        return self._paragraphs
+
+    @paragraphs.setter
+    def paragraphs(self, paragraphs):
+        self._paragraphs = paragraphs
+        self._load_paragraphs = None
+        self._index = None
+
+    def invalidate(self):
+        """drop the option index, it's rebuilt from paragraphs when next needed"""
+        self._index = None
+
+    def _option_index(self):
+        if self._index is None:
+            # this doesn't need to load the remaining paragraphs of a lazy page
+            options = [p for p in self._paragraphs if isinstance(p, Option)]
+
+            # the first option that has a flag wins
+            flags = {}
+            for o in options:
+                for flag in o.opts:
+                    flags.setdefault(flag, o)
+
+            # go over all paragraphs and look for those with the same
+            # 'argument' field
+            groups = collections.OrderedDict()
+            for opt in options:
+                if opt.argument:
+                    groups.setdefault(opt.argument, []).append(opt)
+
+            # merge all the paragraphs under the same argument to a single
+            # string
+            for k, ln in groups.items():
+                groups[k] = "\n\n".join([p.text for p in ln])
+
+            self._index = (options, flags, groups)
+        return self._index
+
     def remove_option(self, idx):
         for i, p in self.paragraphs:
             if p.idx == idx:
                 if not isinstance(p, Option):
                     raise ValueError(f"paragraph {idx} isn't an option")
                 self.paragraphs[i] = Paragraph(p.idx, p.text, p.section, False)
+                self.invalidate()
                 return
         raise ValueError(f"idx {idx} not found")
 
@@ -197,38 +306,27 @@ class ManPage:
 
     @property
     def options(self):
-        return [p for p in self.paragraphs if isinstance(p, Option)]
+        return self._option_index()[0]
 
     @property
     def arguments(self):
-        # go over all paragraphs and look for those with the same 'argument'
-        # field
-        groups = collections.OrderedDict()
-        for opt in self.options:
-            if opt.argument:
-                groups.setdefault(opt.argument, []).append(opt)
-
-        # merge all the paragraphs under the same argument to a single string
-        for k, ln in groups.items():
-            groups[k] = "\n\n".join([p.text for p in ln])
-
-        return groups
+        return self._option_index()[2]
 
     @property
     def synopsis_no_name(self):
         return re.match(r"[\w|-]+ - (.*)$", self.synopsis).group(1)
 
     def find_option(self, flag):
-        for o_tmp in self.options:
-            for o in o_tmp.opts:
-                if o == flag:
-                    return o_tmp
+        return self._option_index()[1].get(flag)
 
     def to_store(self):
+        synopsis = self.synopsis
+        if isinstance(synopsis, bytes):
+            synopsis = synopsis.decode("utf-8")
         return {
             "source": self.source,
             "name": self.name,
-            "synopsis": self.synopsis,
+            "synopsis": synopsis,
             "paragraphs": [p.to_store() for p in self.paragraphs],
             "aliases": self.aliases,
             "partial_match": self.partial_match,
@@ -238,13 +336,23 @@ class ManPage:
         }
 
     @staticmethod
-    def from_store(d):
-        paragraphs = []
-        for pd in d.get("paragraphs", []):
+    def paragraphs_from_store(paragraphs):
+        p_list = []
+        for pd in paragraphs:
             pp = Paragraph.from_store(pd)
             if pp.is_option is True and "short" in pd:
                 pp = Option.from_store(pd)
-            paragraphs.append(pp)
+            p_list.append(pp)
+        return p_list
+
+    @staticmethod
+    def from_store(d, load_paragraphs=None):
+        """create a man page from its document in the manpage collection
+
+        if load_paragraphs is given, d may contain just the option paragraphs
+        and the complete list of paragraphs is taken from load_paragraphs()
+        when it's first needed"""
+        paragraphs = ManPage.paragraphs_from_store(d.get("paragraphs", []))
 
         synopsis = d["synopsis"]
         if synopsis:
@@ -270,7 +378,7 @@ class ManPage:
         elif "nested_cmd" in d:
             nested_cmd = d["nested_cmd"]
 
-        return ManPage(
+        m = ManPage(
             d["source"],
             d["name"],
             synopsis,
@@ -281,6 +389,8 @@ class ManPage:
             d["updated"],
             nested_cmd,
         )
+        m._load_paragraphs = load_paragraphs
+        return m
 
     @staticmethod
     def from_store_name_only(name, source):
@@ -290,26 +400,211 @@ class ManPage:
         return f"<manpage {self.name}({self.section}), {len(self.options)} options>"
 
 
+class AddResult(collections.namedtuple("AddResult", "source id replaced error")):
+    """the outcome of writing a single man page with Store.add_manpages
+
+    id is the ObjectId of the new page (None if it failed), replaced tells if
+    it replaced a page with the same source and error is the error message of
+    a failed write"""
+
+
+class VerifyReport(
+    collections.namedtuple(
+        "VerifyReport", "dangling_mappings orphaned_pages duplicate_sources"
+    )
+):
+    """the problems found by Store.verify_report
+
+    dangling_mappings - mappings ({_id, src, dst}) whose dst doesn't exist
+    orphaned_pages - man pages ({_id, name, source}) that nothing maps to
+    duplicate_sources - sources ({source, ids}) stored more than once"""
+
+    @property
+    def ok(self):
+        return not any(self)
+
+
 class Store:
     """read/write processed man pages from mongodb
 
-    we use three collections:
+    we use four collections:
     1) classifier - contains manually tagged paragraphs from man pages
     2) manpage - contains a processed man page
     3) mapping - contains (name, manpageid, score) tuples
+    4) meta - bookkeeping, currently the generation counter (see generation)
+
+    lookups done by find_man_page are cached in `cache` until the generation
+    changes or they expire. names that aren't mapped to anything are rejected
+    by `mapping_filter` without a query
     """
 
-    def __init__(self, db="explainshell", host=config.MONGO_URI):
+    def __init__(
+        self,
+        db="explainshell",
+        host=config.MONGO_URI,
+        max_pool_size=config.MONGO_MAX_POOL_SIZE,
+    ):
         logger.info("creating store, db = %r, host = %r", db, host)
-        self.connection = pymongo.MongoClient(host)
+        # connect=False defers the connection (and pymongo's monitor threads)
+        # until the first operation, so creating a store is cheap and safe to
+        # do before a pre-fork server forks its workers
+        self.connection = pymongo.MongoClient(
+            host, maxPoolSize=max_pool_size, connect=False
+        )
         self.db = self.connection[db]
         self.classifier = self.db["classifier"]
         self.manpage = self.db["manpage"]
         self.mapping = self.db["mapping"]
+        self.meta = self.db["meta"]
+
+        self.cache = cache.LRUCache(config.MANPAGE_CACHE_SIZE, config.MANPAGE_CACHE_TTL)
+        self._generation = None
+        self._generation_read = None
+        self._filter = None
+        self._filter_generation = None
+        self._filter_lock = threading.Lock()
+        self._single_aggregation = None
+
+    @property
+    def generation(self):
+        """a counter that is incremented whenever man pages are written, by any
+        process. we re-read it at most every config.STORE_GENERATION_TTL
+        seconds, so writes from other processes take that long to show up"""
+        now = time.monotonic()
+        if (
+            self._generation_read is None
+            or now - self._generation_read >= config.STORE_GENERATION_TTL
+        ):
+            d = self.meta.find_one({"_id": "generation"})
+            self._generation = d["value"] if d else 0
+            self._generation_read = now
+        return self._generation
+
+    @property
+    def single_aggregation(self):
+        """True if the server is AGGREGATION_MIN_VERSION or newer and can
+        resolve names with _resolve_pipeline, asked once per store. on older
+        servers find_man_page falls back to _find_man_page_queries"""
+        if self._single_aggregation is None:
+            version = self.connection.server_info()["versionArray"]
+            self._single_aggregation = tuple(version[:2]) >= AGGREGATION_MIN_VERSION
+            if not self._single_aggregation:
+                logger.warning(
+                    "mongodb %s is older than %s, resolving man pages with "
+                    "several queries",
+                    ".".join(map(str, version)),
+                    ".".join(map(str, AGGREGATION_MIN_VERSION)),
+                )
+        return self._single_aggregation
+
+    @property
+    def mapping_filter(self):
+        """a bloom.BloomFilter of every mapping src, None if it's turned off
+        (config.MAPPING_FILTER_ERROR_RATE is 0)
+
+        the mappings this process writes are added to it directly and the
+        generation it bumps for them doesn't rebuild it, it's rebuilt when
+        another process bumped the generation or once it has grown past its
+        capacity (twice the configured false positive rate)"""
+        if not config.MAPPING_FILTER_ERROR_RATE:
+            return None
+        generation = self.generation
+        if self._filter_generation != generation:
+            with self._filter_lock:
+                if self._filter_generation != generation:
+                    self._filter = self._build_filter()
+                    self._filter_generation = generation
+        return self._filter
+
+    def _build_filter(self):
+        srcs = self.mapping.aggregate([{"$group": {"_id": "$src"}}])
+        # with room for the mappings this process adds, so ingesting doesn't
+        # outgrow it at every page (see _bump_generation)
+        f = bloom.BloomFilter.from_iterable(
+            (d["_id"] for d in srcs),
+            2 * self.mapping.estimated_document_count(),
+            config.MAPPING_FILTER_ERROR_RATE,
+        )
+        logger.info(
+            "built mapping filter of %d names: %d bytes, %.5f false positive rate",
+            len(f),
+            f.nbytes,
+            f.false_positive_rate,
+        )
+        return f
+
+    def _filter_add(self, srcs):
+        with self._filter_lock:
+            if self._filter is not None:
+                for src in srcs:
+                    self._filter.add(src)
+
+    def _bump_generation(self, filter_current=True):
+        """start a new generation after writing to the store
+
+        filter_current - the writes were added to the mapping filter (see
+            _filter_add), so it stays current unless another process bumped
+            the generation since it was built"""
+        d = self.meta.find_one_and_update(
+            {"_id": "generation"},
+            {"$inc": {"value": 1}},
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+        self._generation = d["value"]
+        self._generation_read = time.monotonic()
+        logger.info("store generation is now %d", self._generation)
+
+        with self._filter_lock:
+            f = self._filter
+            if (
+                filter_current
+                and f is not None
+                and self._filter_generation == self._generation - 1
+                and f.false_positive_rate <= 2 * config.MAPPING_FILTER_ERROR_RATE
+            ):
+                self._filter_generation = self._generation
+
+    def ensure_indexes(self):
+        """create the indexes in INDEXES, indexes that already exist are left
+        untouched so this is safe to call on every startup"""
+        for name, indexes in INDEXES.items():
+            for keys in indexes:
+                logger.info("ensuring index %r on %s", keys, name)
+                self.db[name].create_index(keys)
+
+    def explain_queries(self):
+        """run the queries we use to look up man pages through explain, using
+        values that exist in the data
+
+        yields (description, stages, covered) for each query where stages are
+        the stage names of the winning plan and covered is False if the plan
+        scans the whole collection"""
+        mapping = self.mapping.find_one() or {}
+        page = self.manpage.find_one(projection={"source": 1}) or {}
+        src, dst = mapping.get("src"), mapping.get("dst")
+
+        queries = [
+            ("mapping by src", self.mapping.find({"src": src})),
+            ("mapping by dst", self.mapping.find({"dst": dst})),
+            (
+                "mapping by src $in",
+                self.mapping.find({"src": {"$in": [src]}}, {"dst": 1}),
+            ),
+            ("manpage by source", self.manpage.find({"source": page.get("source")})),
+            (
+                "manpage by _id $in",
+                self.manpage.find({"_id": {"$in": [dst]}}, {"name": 1, "source": 1}),
+            ),
+        ]
+        for description, cursor in queries:
+            plan = cursor.explain()["queryPlanner"]["winningPlan"]
+            stages = list(_plan_stages(plan))
+            yield description, stages, "COLLSCAN" not in stages
 
     def close(self):
-        self.connection.disconnect()
-        self.classifier = self.manpage = self.mapping = self.db = None
+        self.connection.close()
+        self.classifier = self.manpage = self.mapping = self.meta = self.db = None
 
     def drop(self, confirm=False):
         if not confirm:
@@ -318,12 +613,30 @@ class Store:
         logger.info("dropping mapping, manpage, collections")
         self.mapping.drop()
         self.manpage.drop()
+        self._bump_generation(filter_current=False)
 
     def training_set(self):
         for d in self.classifier.find():
             yield ClassifierManpage.from_store(d)
 
+    def training_set_fingerprint(self):
+        """a string that changes when documents are added to or removed from
+        the classifier collection: its size and largest _id, two cheap
+        queries that don't read the training set
+
+        nothing here writes the collection, it comes with the db dump. a
+        document edited in place keeps the fingerprint, retrain with
+        manager.py --retrain-classifier after doing that"""
+        count = self.classifier.estimated_document_count()
+        last = self.classifier.find_one(
+            {}, {"_id": 1}, sort=[("_id", pymongo.DESCENDING)]
+        )
+        return f"{count}:{last['_id'] if last else ''}"
+
     def __contains__(self, name):
+        f = self.mapping_filter
+        if f is not None and name not in f:
+            return False
         c = self.mapping.count_documents({"src": name})
         return c > 0
 
@@ -331,31 +644,302 @@ class Store:
         for d in self.manpage.find():
             yield ManPage.from_store(d)
 
-    def find_man_page(self, name):
+    def manpage_index(self, prefix="", after=None, limit=100):
+        """list the man pages whose name starts with prefix, sorted by name,
+        a page of up to limit at a time. returns (entries, after): the
+        manpage_index_entry of each man page, and the after to pass to get
+        the next page, None on the last one
+
+        the sort and the paging are done by the index on (name, _id), and
+        only the fields the entries need are fetched"""
+        query = {}
+        if prefix:
+            query["name"] = {"$regex": f"^{re.escape(prefix)}"}
+        if after is not None:
+            name, oid = after
+            query["$or"] = [
+                {"name": {"$gt": name}},
+                {"name": name, "_id": {"$gt": oid}},
+            ]
+        cursor = (
+            self.manpage.find(query, MANPAGE_INDEX_FIELDS)
+            .sort([("name", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)])
+            .limit(limit + 1)
+        )
+        docs = list(cursor)
+        after = None
+        if len(docs) > limit:
+            docs = docs[:limit]
+            after = docs[-1]["name"], docs[-1]["_id"]
+        return [manpage_index_entry(d) for d in docs], after
+
+    def find_man_page(self, name, lazy=False):
         """find a man page by its name, everything following the last dot (.) in name,
         is taken as the section of the man page
 
         we return the man page found with the highest score, and a list of
         suggestions that also matched the given name (only the first item
-        is prepopulated with the option data)"""
+        is prepopulated with the option data)
+
+        with lazy set, only the option paragraphs of the first man page are
+        fetched, which is all the matcher needs. the rest are fetched if
+        its `paragraphs` are accessed
+
+        the candidates, the winning page and its suggestions are all fetched
+        in a single aggregation, see _resolve_pipeline (on servers older than
+        AGGREGATION_MIN_VERSION they take several queries, `lazy` is ignored
+        and the whole page is fetched). results are cached per
+        name and generation; the returned list is a copy but the man pages in
+        it are shared, don't modify them"""
         if name.endswith(".gz"):
-            logger.info("name ends with .gz, looking up an exact match by source")
-            d = self.manpage.find_one({"source": name})
-            if not d:
-                raise errors.ProgramDoesNotExist(name)
-            m = ManPage.from_store(d)
-            logger.info("returning %s", m)
-            return [m]
+            # not cached, this is how the tagger fetches a page to edit it
+            return self._find_by_source(name)
+
+        f = self.mapping_filter
+        if f is not None:
+            src = util.split_section(name)[0]
+            if src not in f:
+                raise errors.ProgramDoesNotExist(src)
+
+        key = (name, lazy, self.generation)
+        mps = self.cache.get(key)
+        if mps is None:
+            mps = self._resolve(name, lazy)
+            self.cache.put(key, mps)
+        return list(mps)
+
+    def find_man_pages(self, names, lazy=False):
+        """resolve many names at once, returns a dict of name -> the list
+        find_man_page(name, lazy) returns, names that don't exist are left out
+
+        names without a section are resolved by a single aggregation (the one
+        find_man_page uses, matching all of them), the rest are looked up one
+        by one, as are all of them on servers too old for the aggregation"""
+        found = {}
+        pending = []
+        generation = self.generation
+        f = self.mapping_filter
+        for name in dict.fromkeys(names):
+            if name.endswith(".gz") or util.split_section(name)[1] is not None:
+                try:
+                    found[name] = self.find_man_page(name, lazy)
+                except errors.ProgramDoesNotExist:
+                    pass
+            elif f is None or name in f:
+                mps = self.cache.get((name, lazy, generation))
+                if mps is None:
+                    pending.append(name)
+                else:
+                    found[name] = list(mps)
+
+        if pending and not self.single_aggregation:
+            for name in pending:
+                try:
+                    found[name] = self.find_man_page(name, lazy)
+                except errors.ProgramDoesNotExist:
+                    pass
+            pending = []
+
+        if pending:
+            logger.info("resolving manpages with src in %r", pending)
+            pipeline = self._resolve_pipeline({"src": {"$in": pending}}, lazy=lazy)
+            for d in self.mapping.aggregate(pipeline):
+                try:
+                    mps = self._resolved(d, d["_id"], None, lazy)
+                except errors.ProgramDoesNotExist:
+                    continue
+                self.cache.put((d["_id"], lazy, generation), mps)
+                found[d["_id"]] = list(mps)
+        return found
+
+    def _load_paragraphs(self, oid):
+        d = self.manpage.find_one({"_id": oid}, {"paragraphs": 1})
+        return ManPage.paragraphs_from_store(d["paragraphs"] if d else [])
+
+    def _resolve(self, name, lazy=False):
+        if not self.single_aggregation:
+            return self._find_man_page_queries(name)
 
-        section = None
         orig_name = name
+        name, section = util.split_section(name)
 
-        # don't try to look for a section if it's . (source)
-        if name != ".":
-            splitted = name.rsplit(".", 1)
-            name = splitted[0]
-            if len(splitted) > 1:
-                section = splitted[1]
+        logger.info("resolving manpage with src %r", name)
+        pipeline = self._resolve_pipeline(
+            {"src": name}, section, suggestions=section is not None, lazy=lazy
+        )
+        docs = list(self.mapping.aggregate(pipeline))
+        if not docs:
+            raise errors.ProgramDoesNotExist(name)
+        return self._resolved(docs[0], orig_name, section, lazy)
+
+    def _find_by_source(self, source):
+        logger.info("name ends with .gz, looking up an exact match by source")
+        d = self.manpage.find_one({"source": source})
+        if not d:
+            raise errors.ProgramDoesNotExist(source)
+        m = ManPage.from_store(d)
+        logger.info("returning %s", m)
+        return [m]
+
+    def _resolve_pipeline(self, match, section=None, suggestions=False, lazy=False):
+        """return an aggregation on mapping that resolves every src matched by
+        `match` in one round trip
+
+        it yields a document per src with:
+        - mappings: the number of distinct man pages src maps to
+        - candidates: name and source of those pages, ranked the way
+          _find_man_page_queries ranks them (None for mappings to missing pages)
+        - page: a list with the winning man page, with only its option
+          paragraphs if `lazy` is set
+        - suggestions: if `suggestions` is set, name and source of the pages
+          reachable through the aliases of the winning page
+        """
+        project_name = [{"$project": {"name": 1, "source": 1}}]
+        pipeline = [
+            {"$match": match},
+            # the last mapping wins if src maps to the same page twice, like
+            # the {dst: score} dict of _find_man_page_queries
+            {
+                "$group": {
+                    "_id": {"src": "$src", "dst": "$dst"},
+                    "score": {"$last": "$score"},
+                }
+            },
+            {
+                "$lookup": {
+                    "from": "manpage",
+                    "localField": "_id.dst",
+                    "foreignField": "_id",
+                    "pipeline": project_name,
+                    "as": "page",
+                }
+            },
+            {"$set": {"page": {"$first": "$page"}}},
+            {"$set": {"found": {"$cond": [{"$ifNull": ["$page", False]}, 1, 0]}}},
+        ]
+
+        sort = {"_id.src": 1, "found": -1}
+        if section is not None:
+            regex = rf"\.{re.escape(section)}\.gz$"
+            pipeline.append(
+                {
+                    "$set": {
+                        "section_match": {
+                            "$regexMatch": {
+                                "input": {"$ifNull": ["$page.source", ""]},
+                                "regex": regex,
+                            }
+                        }
+                    }
+                }
+            )
+            sort["section_match"] = -1
+        # ties are broken by _id, which is roughly insertion order
+        sort.update({"score": -1, "_id.dst": 1})
+
+        pipeline += [
+            {"$sort": sort},
+            {
+                "$group": {
+                    "_id": "$_id.src",
+                    "mappings": {"$sum": 1},
+                    "candidates": {"$push": {"$ifNull": ["$page", None]}},
+                }
+            },
+            {"$set": {"winner": {"$first": "$candidates"}}},
+            {
+                "$lookup": {
+                    "from": "manpage",
+                    "localField": "winner._id",
+                    "foreignField": "_id",
+                    "pipeline": (
+                        [{"$set": {"paragraphs": _OPTION_PARAGRAPHS}}] if lazy else []
+                    ),
+                    "as": "page",
+                }
+            },
+        ]
+
+        if suggestions:
+            pipeline += [
+                {
+                    "$lookup": {
+                        "from": "mapping",
+                        "localField": "winner._id",
+                        "foreignField": "dst",
+                        "pipeline": [{"$project": {"src": 1}}],
+                        "as": "aliases",
+                    }
+                },
+                {
+                    "$lookup": {
+                        "from": "mapping",
+                        "localField": "aliases.src",
+                        "foreignField": "src",
+                        "pipeline": [{"$project": {"dst": 1}}],
+                        "as": "related",
+                    }
+                },
+                {
+                    "$lookup": {
+                        "from": "manpage",
+                        "localField": "related.dst",
+                        "foreignField": "_id",
+                        "pipeline": project_name,
+                        "as": "suggestions",
+                    }
+                },
+                {"$unset": ["aliases", "related"]},
+            ]
+
+        return pipeline
+
+    def _resolved(self, d, name, section, lazy=False):
+        """turn a document produced by _resolve_pipeline into the list returned
+        by find_man_page, `name` is the name that was looked up"""
+        candidates = [c for c in d["candidates"] if c]
+        if len(candidates) != d["mappings"]:
+            logger.error(
+                "%d of %d mappings for %r are missing in manpage collection",
+                d["mappings"] - len(candidates),
+                d["mappings"],
+                d["_id"],
+            )
+        if not candidates:
+            raise errors.ProgramDoesNotExist(name)
+
+        results = [
+            ManPage.from_store_name_only(c["name"], c["source"]) for c in candidates
+        ]
+        logger.info("got %s", results)
+        if section is not None:
+            if results[0].section != section:
+                raise errors.ProgramDoesNotExist(name)
+
+            skip = {c["_id"] for c in candidates}
+            results.extend(
+                ManPage.from_store_name_only(c["name"], c["source"])
+                for c in d["suggestions"]
+                if c["_id"] not in skip
+            )
+
+        page = d["page"][0]
+        load_paragraphs = None
+        if lazy:
+            load_paragraphs = functools.partial(self._load_paragraphs, page["_id"])
+        results[0] = ManPage.from_store(page, load_paragraphs)
+        return results
+
+    def _find_man_page_queries(self, name):
+        """find_man_page as it was before resolving names in a single
+        aggregation: it needs up to six round trips. it's what servers older
+        than AGGREGATION_MIN_VERSION use, and the reference the aggregation is
+        tested against"""
+        if name.endswith(".gz"):
+            return self._find_by_source(name)
+
+        orig_name = name
+        name, section = util.split_section(name)
 
         logger.info("looking up manpage in mapping with src %r", name)
         cursor = list(self.mapping.find({"src": name}))
@@ -427,35 +1011,121 @@ class Store:
         if not isinstance(dst, ObjectId):
             dst = dst.inserted_id
         self.mapping.insert_one({"src": src, "dst": dst, "score": score})
+        self._filter_add([src])
 
     def add_manpage(self, m):
         """add `m` into the store, if it exists first remove it and it's mappings
 
         each man page may have aliases besides the name determined by it's
         basename"""
-        d = self.manpage.find_one({"source": m.source})
-        if d:
-            logger.info("removing old manpage %s (%s)", m.source, d["_id"])
-            self.manpage.delete_one({"_id": d["_id"]})
-
-            # remove old mappings if there are any
-            c = self.mapping.count_documents({})
-            self.mapping.delete_one({"dst": d["_id"]})
-            c -= self.mapping.count_documents({})
-            logger.info("removed %d mappings for manpage %s", c, m.source)
+        result = self.add_manpages([m])[0]
+        if result.error:
+            raise pymongo.errors.OperationFailure(result.error)
+        return m
 
-        o = self.manpage.insert_one(m.to_store())
+    def add_manpages(
+        self, manpages, batch_size=config.INGEST_BATCH_SIZE, write_concern=None
+    ):
+        """add many man pages, replacing existing pages with the same source
+        along with their mappings
+
+        pages are written in batches of batch_size using unordered bulk
+        operations, so a page that fails to be written doesn't stop the rest
+        of its batch. write_concern is an optional pymongo.WriteConcern for
+        these writes.
+
+        returns an AddResult for every man page, in the order given"""
+        manpage, mapping = self.manpage, self.mapping
+        if write_concern is not None:
+            manpage = manpage.with_options(write_concern=write_concern)
+            mapping = mapping.with_options(write_concern=write_concern)
+
+        results = []
+        batch = []
+        for m in manpages:
+            # a source that repeats must replace the page written before it,
+            # so it goes in the next batch
+            if len(batch) == batch_size or any(b.source == m.source for b in batch):
+                results.extend(self._add_batch(batch, manpage, mapping))
+                batch = []
+            batch.append(m)
+        if batch:
+            results.extend(self._add_batch(batch, manpage, mapping))
+
+        if results:
+            self._bump_generation()
+        return results
 
-        for alias, score in m.aliases:
-            self.add_mapping(alias, o, score)
+    def _add_batch(self, batch, manpage, mapping):
+        sources = [m.source for m in batch]
+        old = {
+            d["source"]: d["_id"]
+            for d in manpage.find({"source": {"$in": sources}}, {"source": 1})
+        }
+        if old:
+            ids = list(old.values())
+            manpage.delete_many({"_id": {"$in": ids}})
+            r = mapping.delete_many({"dst": {"$in": ids}})
             logger.info(
-                "inserting mapping (alias) %s -> %s (%s) with score %d",
-                alias,
-                m.name,
-                o,
-                score,
+                "removed %d old manpages and %d of their mappings",
+                len(ids),
+                r.deleted_count,
             )
-        return m
+
+        docs = []
+        for m in batch:
+            d = m.to_store()
+            d["_id"] = ObjectId()
+            docs.append(d)
+
+        failed = {}
+        try:
+            manpage.bulk_write([pymongo.InsertOne(d) for d in docs], ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            for error in e.details["writeErrors"]:
+                failed[error["index"]] = error["errmsg"]
+
+        # remember which page each mapping belongs to, to report errors
+        owners = []
+        ops = []
+        srcs = []
+        for i, (m, d) in enumerate(zip(batch, docs)):
+            if i in failed:
+                continue
+            for alias, score in m.aliases:
+                owners.append(i)
+                srcs.append(alias)
+                ops.append(
+                    pymongo.InsertOne({"src": alias, "dst": d["_id"], "score": score})
+                )
+        # before writing, a src that failed to be written is only a false
+        # positive
+        self._filter_add(srcs)
+        if ops:
+            try:
+                mapping.bulk_write(ops, ordered=False)
+            except pymongo.errors.BulkWriteError as e:
+                for error in e.details["writeErrors"]:
+                    failed.setdefault(owners[error["index"]], error["errmsg"])
+
+        logger.info(
+            "inserted %d manpages and %d mappings (%d failed)",
+            len(batch) - len(failed),
+            len(ops),
+            len(failed),
+        )
+        for i, error in failed.items():
+            logger.error("failed to add manpage %s: %s", batch[i].source, error)
+
+        return [
+            AddResult(
+                m.source,
+                None if i in failed else d["_id"],
+                m.source in old,
+                failed.get(i),
+            )
+            for i, (m, d) in enumerate(zip(batch, docs))
+        ]
 
     def update_man_page(self, m):
         """update m and add new aliases if necessary
@@ -463,7 +1133,7 @@ class Store:
         change updated attribute so we don't overwrite this in the future"""
         logger.info("updating manpage %s", m.source)
         m.updated = True
-        self.manpage.update_one({"source": m.source}, m.to_store())
+        self.manpage.replace_one({"source": m.source}, m.to_store())
         _id = self.manpage.find_one({"source": m.source}, projection={"_id": 1})["_id"]
         for alias, score in m.aliases:
             if alias not in self:
@@ -479,31 +1149,92 @@ class Store:
                 logger.debug(
                     "mapping (alias) %s -> %s (%s) already exists", alias, m.name, _id
                 )
+        self._bump_generation()
         return m
 
+    def verify_report(self):
+        """check the integrity of the store, returns a VerifyReport
+
+        the checks run as aggregations so the server does the set differences
+        and only the problems found are sent back. the lookups join with
+        let and $expr rather than localField and a pipeline, which needs
+        AGGREGATION_MIN_VERSION, equality in $expr still uses the indexes"""
+        orphaned = self.manpage.aggregate(
+            [
+                {
+                    "$lookup": {
+                        "from": self.mapping.name,
+                        "let": {"id": "$_id"},
+                        "pipeline": [
+                            {"$match": {"$expr": {"$eq": ["$dst", "$$id"]}}},
+                            {"$limit": 1},
+                            {"$project": {"_id": 1}},
+                        ],
+                        "as": "mapped",
+                    }
+                },
+                {"$match": {"mapped": {"$size": 0}}},
+                {"$project": {"name": 1, "source": 1}},
+            ],
+            allowDiskUse=True,
+        )
+        dangling = self.mapping.aggregate(
+            [
+                {
+                    "$lookup": {
+                        "from": self.manpage.name,
+                        "let": {"dst": "$dst"},
+                        "pipeline": [
+                            {"$match": {"$expr": {"$eq": ["$_id", "$$dst"]}}},
+                            {"$project": {"_id": 1}},
+                        ],
+                        "as": "page",
+                    }
+                },
+                {"$match": {"page": {"$size": 0}}},
+                {"$project": {"src": 1, "dst": 1}},
+            ],
+            allowDiskUse=True,
+        )
+        duplicates = self.manpage.aggregate(
+            [
+                {"$group": {"_id": "$source", "ids": {"$push": "$_id"}}},
+                {"$match": {"ids.1": {"$exists": True}}},
+                {"$project": {"_id": 0, "source": "$_id", "ids": 1}},
+            ],
+            allowDiskUse=True,
+        )
+        return VerifyReport(list(dangling), list(orphaned), list(duplicates))
+
     def verify(self):
-        # check that everything in manpage is reachable
-        mappings = list(self.mapping.find())
-        reachable = {m["dst"] for m in mappings}
-        man_pages = {m["_id"] for m in self.manpage.find(projection={"_id": 1})}
+        """returns (ok, names of unreachable pages, ids of missing pages that
+        mappings point to), see verify_report for the full report"""
+        report = self.verify_report()
 
-        ok = True
-        unreachable = man_pages - reachable
+        unreachable = [d["name"] for d in report.orphaned_pages]
         if unreachable:
             logger.error(
                 "manpages %r are unreachable (nothing maps to them)", unreachable
             )
-            unreachable = [
-                self.manpage.find_one({"_id": u})["name"] for u in unreachable
-            ]
-            ok = False
 
-        notfound = reachable - man_pages
+        notfound = {d["dst"] for d in report.dangling_mappings}
         if notfound:
             logger.error("mappings to non-existing manpages: %r", notfound)
-            ok = False
 
-        return ok, unreachable, notfound
+        for d in report.duplicate_sources:
+            logger.error("source %r is stored %d times", d["source"], len(d["ids"]))
+
+        return report.ok, unreachable, notfound
+
+    def largest_sources(self, n):
+        """return the sources of the n man pages with the most paragraphs,
+        the most expensive to render"""
+        pipeline = [
+            {"$project": {"source": 1, "size": {"$size": "$paragraphs"}}},
+            {"$sort": {"size": -1, "source": 1}},
+            {"$limit": n},
+        ]
+        return [d["source"] for d in self.manpage.aggregate(pipeline)]
 
     def names(self):
         cursor = self.manpage.find({}, {"name": 1})
@@ -517,3 +1248,90 @@ class Store:
 
     def set_multi_cmd(self, manpage_id):
         self.manpage.update_one({"_id": manpage_id}, {"$set": {"multi_cmd": True}})
+        self._bump_generation()
+
+
+def _plan_stages(plan):
+    """yield the stage names found in an explain plan, depth first
+
+    >>> list(_plan_stages({'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}))
+    ['FETCH', 'IXSCAN']
+    >>> list(_plan_stages({'stage': 'OR', 'inputStages': [{'stage': 'COLLSCAN'}]}))
+    ['OR', 'COLLSCAN']
+    """
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for v in plan.values():
+            yield from _plan_stages(v)
+    elif isinstance(plan, list):
+        for v in plan:
+            yield from _plan_stages(v)
+
+
+# process wide stores, keyed by (db, host) or by the snapshot's path. see
+# get_store
+_stores = {}
+_stores_pid = os.getpid()
+_stores_lock = threading.Lock()
+
+
+def open_stores():
+    """the stores get_store returned in this process"""
+    if _stores_pid != os.getpid():
+        return []
+    return list(_stores.values())
+
+
+def get_store(db="explainshell", host=config.MONGO_URI, snapshot=True):
+    """return the `Store` shared by everything in this process for db/host,
+    creating it on first use
+
+    creating one doesn't talk to the server: the client connects on its
+    first query and the mapping filter is built when it's first needed. the
+    indexes are created by the manager (see Store.ensure_indexes), the web
+    tier doesn't need the privileges to do that
+
+    if config.SNAPSHOT_PATH is set and snapshot is true, a read only
+    snapshot.SnapshotStore serving that file is returned instead and mongodb
+    isn't used at all. anything that writes to the store (the manager) passes
+    snapshot=False to always get the mongodb one
+
+    a MongoClient is not fork safe: if we notice we're running in a different
+    process than the one that filled the registry (a worker forked by
+    uwsgi/gunicorn after the master touched a store), the inherited stores are
+    dropped without closing them, their sockets belong to the parent"""
+    global _stores_pid, _stores_lock
+
+    if _stores_pid != os.getpid():
+        _stores.clear()
+        _stores_pid = os.getpid()
+        # the lock might have been held by another thread at fork time
+        _stores_lock = threading.Lock()
+
+    use_snapshot = snapshot and config.SNAPSHOT_PATH
+    key = ("snapshot", config.SNAPSHOT_PATH) if use_snapshot else (db, host)
+    s = _stores.get(key)
+    if s is None:
+        with _stores_lock:
+            s = _stores.get(key)
+            if s is None:
+                if use_snapshot:
+                    from explainshell import snapshot
+
+                    s = snapshot.SnapshotStore(config.SNAPSHOT_PATH)
+                else:
+                    s = Store(db, host)
+                _stores[key] = s
+    return s
+
+
+@atexit.register
+def close_stores():
+    """close all stores created by get_store in this process"""
+    if _stores_pid != os.getpid():
+        return
+    with _stores_lock:
+        for s in _stores.values():
+            s.close()
+        _stores.clear()
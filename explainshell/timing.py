@@ -0,0 +1,83 @@
+"""
+per request timings of the phases of explaining a command
+"""
+
+import collections
+import contextlib
+import json
+import time
+
+
+class Timings:
+    """the time spent in each phase of a request and counters of the work done
+    in it (e.g. store calls)
+
+    phases can nest (a store lookup inside the matcher's visit), the time of
+    a nested phase is counted in its parent too
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self._clock = clock
+        self.start = clock()
+        self.phases = collections.OrderedDict()
+        self.counts = collections.Counter()
+
+    def __bool__(self):
+        return True
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + self._clock() - start
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    @property
+    def total(self):
+        return self._clock() - self.start
+
+    def server_timing(self):
+        """format the timings as the value of a Server-Timing header, in
+        milliseconds
+
+        >>> t = Timings(clock=iter([0, 0, 0.0015, 0.002]).__next__)
+        >>> with t.phase('parse'):
+        ...     t.count('store', 2)
+        >>> t.server_timing()
+        'parse;dur=1.5, store;desc="2", total;dur=2.0'
+        """
+        entries = [f"{name};dur={d * 1000:.1f}" for name, d in self.phases.items()]
+        entries += [f'{name};desc="{n}"' for name, n in self.counts.items()]
+        entries.append(f"total;dur={self.total * 1000:.1f}")
+        return ", ".join(entries)
+
+    def to_json(self, **extra):
+        """a single line json document of the timings (in milliseconds), for
+        structured logs"""
+        d = dict(extra)
+        d["total_ms"] = round(self.total * 1000, 3)
+        d["phases_ms"] = {k: round(v * 1000, 3) for k, v in self.phases.items()}
+        d["counts"] = dict(self.counts)
+        return json.dumps(d, separators=(",", ":"))
+
+
+class NullTimings:
+    """Timings that records nothing, used when timing is turned off"""
+
+    _phase = contextlib.nullcontext()
+
+    def __bool__(self):
+        return False
+
+    def phase(self, name):
+        return self._phase
+
+    def count(self, name, n=1):
+        pass
+
+
+NULL = NullTimings()
@@ -146,6 +146,26 @@ def name_section(path):
     return name, section
 
 
+def split_section(name):
+    """split the section off a name looked up in the store, everything after
+    the last dot is the section
+
+    >>> split_section('tar')
+    ('tar', None)
+    >>> split_section('node.8')
+    ('node', '8')
+    >>> split_section('.')
+    ('.', None)
+    """
+    # don't try to look for a section if it's . (source)
+    if name == ".":
+        return name, None
+    splitted = name.rsplit(".", 1)
+    if len(splitted) > 1:
+        return splitted[0], splitted[1]
+    return name, None
+
+
 class PropertyCache:
     def __init__(self, func):
         self.func = func
@@ -3,7 +3,9 @@ from flask import Flask
 app = Flask(__name__)
 
 from explainshell.web import views
-from explainshell import store, config
+from explainshell import store, config, metrics
+
+metrics.init_app(app)
 
 if config.DEBUG:
     from explainshell.web import debug_views
@@ -1,5 +1,7 @@
+import base64
 import logging
 
+import bson
 from flask import render_template, request, abort, redirect, url_for, json
 
 from explainshell import manager, config, store
@@ -8,21 +10,55 @@ from explainshell.web import app, helpers
 logger = logging.getLogger(__name__)
 
 
+# the number of man pages /debug lists per page, unless asked for another
+# number up to DEBUG_MAX_PAGE_SIZE
+DEBUG_PAGE_SIZE = 100
+DEBUG_MAX_PAGE_SIZE = 1000
+
+
+def _encode_cursor(after):
+    name, oid = after
+    data = json.dumps([name, str(oid)]).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        name, oid = json.loads(data)
+        return name, bson.ObjectId(oid)
+    except (ValueError, TypeError, bson.errors.InvalidId):
+        abort(400)
+
+
 @app.route("/debug")
 def debug():
-    s = store.Store("explainshell", config.MONGO_URI)
-    d = {"manpages": []}
-    for mp in s:
-        synopsis = ""
-        if mp.synopsis:
-            synopsis = mp.synopsis[:20]
-        dd = {"name": mp.name, "synopsis": synopsis}
-        o_list = []
-        for o in mp.options:
-            o_list.append(str(o))
-        dd["options"] = ", ".join(o_list)
-        d["manpages"].append(dd)
-    d["manpages"].sort(key=lambda d: d["name"].lower())
+    """list the man pages a page at a time, sorted by name
+
+    prefix - only list the man pages whose name starts with it
+    after - the cursor of the next page, taken from the previous one
+    limit - the number of man pages per page"""
+    s = store.get_store("explainshell", config.MONGO_URI)
+    prefix = request.args.get("prefix", "")
+    after = request.args.get("after")
+    if after:
+        after = _decode_cursor(after)
+    limit = request.args.get("limit", DEBUG_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, DEBUG_MAX_PAGE_SIZE))
+
+    entries, after = s.manpage_index(prefix, after or None, limit)
+    d = {"manpages": [], "prefix": prefix, "limit": limit, "next": None}
+    for entry in entries:
+        options = ", ".join("(" + ", ".join(flags) + ")" for flags in entry["options"])
+        d["manpages"].append(
+            {
+                "name": entry["name"],
+                "synopsis": entry["synopsis"][:20],
+                "options": options,
+            }
+        )
+    if after is not None:
+        d["next"] = _encode_cursor(after)
     return render_template("debug.html", d=d)
 
 
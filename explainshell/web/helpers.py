@@ -3,7 +3,8 @@ from explainshell import util
 
 def convert_paragraphs(manpage):
     for p in manpage.paragraphs:
-        p.text = p.text.decode("utf-8")
+        if isinstance(p.text, bytes):
+            p.text = p.text.decode("utf-8")
     return manpage
 
 
@@ -1,15 +1,113 @@
-import logging, itertools, urllib
+import bisect, collections, gzip, hashlib, json, logging, itertools, pickle, time, urllib
 import markupsafe
 
-from flask import render_template, request, redirect
+from flask import (
+    g,
+    render_template,
+    request,
+    redirect,
+    make_response,
+    stream_template,
+    stream_with_context,
+)
 
 import bashlex.errors
 
-from explainshell import matcher, errors, util, store, config
+from explainshell import (
+    cache,
+    matcher,
+    errors,
+    metrics,
+    script,
+    timing,
+    util,
+    store,
+    config,
+)
 from explainshell.web import app, helpers
 
 logger = logging.getLogger(__name__)
 
+# explained commands, see cached_explain_cmd
+results = cache.LRUCache(
+    config.EXPLAIN_CACHE_SIZE, maxcost=config.EXPLAIN_CACHE_MAXCOST
+)
+results_disk = None
+if config.EXPLAIN_CACHE_PATH:
+    results_disk = cache.DiskCache(
+        config.EXPLAIN_CACHE_PATH, config.EXPLAIN_CACHE_DISK_SIZE
+    )
+
+# rendered /explain/<program> pages, see cached_program_page
+pages = cache.LRUCache(config.PAGE_CACHE_SIZE, maxcost=config.PAGE_CACHE_MAXCOST)
+pages_disk = None
+if config.PAGE_CACHE_PATH:
+    pages_disk = cache.DiskCache(config.PAGE_CACHE_PATH, config.PAGE_CACHE_DISK_SIZE)
+
+# bump when the json of /api/explain or what the matcher makes of a command
+# changes: it's in the api's ETags and the result cache keys, so responses
+# and results from before a deploy aren't served after it
+API_VERSION = 1
+
+# the themes pages are rendered in (see the theme cookie in es.js), pages
+# asked for with any other theme aren't cached
+PAGE_THEMES = ("default", "dark")
+
+
+class RenderedPage(
+    collections.namedtuple("RenderedPage", "html gzipped etag last_modified")
+):
+    """a rendered page, its gzip compressed variant, the ETag of html (the
+    gzipped variant's adds -gz) and when it was rendered (seconds since the
+    epoch)"""
+
+
+# send this request header with the value 'bypass' to skip the result cache,
+# responses carry it too, telling if the result was a hit, miss or bypass
+CACHE_HEADER = "X-Explainshell-Cache"
+
+timing_logger = logging.getLogger("explainshell.timing")
+
+
+@metrics.REGISTRY.add_collector
+def cache_metrics():
+    caches = [("results", results), ("pages", pages)]
+    if results_disk is not None:
+        caches.append(("results_disk", results_disk))
+    if pages_disk is not None:
+        caches.append(("pages_disk", pages_disk))
+    for s in store.open_stores():
+        if getattr(s, "cache", None) is not None:
+            caches.append(("manpages", s.cache))
+
+    for name, c in caches:
+        yield "explainshell_cache_requests_total", {
+            "cache": name,
+            "result": "hit",
+        }, c.hits
+        yield "explainshell_cache_requests_total", {
+            "cache": name,
+            "result": "miss",
+        }, c.misses
+
+
+@app.before_request
+def start_timings():
+    g.timings = timing.Timings() if config.TIMING else timing.NULL
+
+
+@app.after_request
+def report_timings(response):
+    timings = g.get("timings", timing.NULL)
+    # a streamed response is still being generated, its timings are incomplete
+    if timings and not response.is_streamed:
+        response.headers["Server-Timing"] = timings.server_timing()
+        if config.TIMING_LOG:
+            timing_logger.info(
+                timings.to_json(path=request.path, status=response.status_code)
+            )
+    return response
+
 
 @app.route("/")
 def index():
@@ -21,23 +119,33 @@ def about():
     return render_template("about.html")
 
 
-@app.route("/explain")
+@app.route("/explain", methods=["GET", "POST"])
 def explain():
-    if "cmd" not in request.args or not request.args["cmd"].strip():
+    if "cmd" not in request.values or not request.values["cmd"].strip():
         return redirect("/")
-    command = request.args["cmd"].strip()
-    command = command[:1000]  # trim commands longer than 1000 characters
+    command = request.values["cmd"].strip()
     if "\n" in command:
-        return render_template(
-            "errors/error.html", title="parsing error!", message="no newlines please"
-        )
+        return explain_script(command[: config.SCRIPT_MAX_LENGTH])
+    command = command[:1000]  # trim commands longer than 1000 characters
 
-    s = store.Store("explainshell", config.MONGO_URI)
+    s = store.get_store("explainshell", config.MONGO_URI)
     try:
-        matches, helptext = explain_cmd(command, s)
-        return render_template(
-            "explain.html", matches=matches, helptext=helptext, getargs=command
+        bypass = request.headers.get(CACHE_HEADER, "").lower() == "bypass"
+        matches, helptext, truncated, _, status = cached_explain_cmd(
+            command, s, bypass, g.timings
         )
+        with g.timings.phase("render"):
+            response = make_response(
+                render_template(
+                    "explain.html",
+                    matches=matches,
+                    helptext=helptext,
+                    truncated=truncated,
+                    getargs=command,
+                )
+            )
+        response.headers[CACHE_HEADER] = status
+        return response
 
     except errors.ProgramDoesNotExist as error_msg:
         return render_template(
@@ -64,12 +172,234 @@ def explain():
         return render_template("errors/error.html", title="error!", message=msg)
 
 
+@app.route("/api/explain")
+def api_explain():
+    """explain a command as json, see api_document for the schema
+
+    the response carries a strong ETag made of API_VERSION, the command and
+    the store generation, so a conditional GET is answered with a 304 before the
+    command is explained or even looked up in the cache"""
+    command = request.args.get("cmd", "").strip()
+    if not command:
+        return _json_response(api_error_body("missing cmd parameter"), 400)
+    command = command[:1000]
+
+    s = store.get_store("explainshell", config.MONGO_URI)
+    etag = api_etag(command, s.generation)
+    headers = {
+        "ETag": f'"{etag}"',
+        "Cache-Control": f"public, max-age={config.API_CACHE_MAX_AGE}",
+    }
+    if etag in request.if_none_match:
+        return app.response_class(status=304, headers=headers)
+
+    status, body, cacheable = api_result(command, s, g.timings)
+    if not cacheable:
+        headers = {"Cache-Control": "no-store"}
+    return _json_response(body, status, headers)
+
+
+@app.route("/api/explain/batch", methods=["POST"])
+def api_explain_batch():
+    """explain many commands in one request
+
+    the body is a json array of commands, or ndjson: a command per line,
+    either a json string or an object with a cmd field. the response is
+    ndjson too, a line per command in the order they were sent, streamed as
+    they're explained:
+
+        {"index":0,"status":200,"result":<what /api/explain returns>}
+
+    errors are reported in the line of the command that caused them (with
+    the status /api/explain would respond with), the rest of the batch
+    carries on"""
+    s = store.get_store("explainshell", config.MONGO_URI)
+    if request.mimetype == "application/json":
+        commands = request.get_json(silent=True)
+        if not isinstance(commands, list):
+            body = api_error_body("expected a json array of commands")
+            return _json_response(body, 400)
+    else:
+        commands = _ndjson_commands(request.stream)
+
+    return app.response_class(
+        stream_with_context(_batch_lines(commands, s)),
+        mimetype="application/x-ndjson",
+    )
+
+
+def _ndjson_commands(stream):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            command = json.loads(line)
+        except ValueError:
+            # reported as the error of this item
+            yield None
+            continue
+        if isinstance(command, dict):
+            command = command.get("cmd")
+        yield command
+
+
+def _batch_lines(commands, store):
+    # identical commands in a batch are explained once, this doesn't grow
+    # beyond a bound on batches of any length
+    done = cache.LRUCache(config.API_BATCH_DEDUPE_SIZE)
+    for i, command in enumerate(commands):
+        if i == config.API_BATCH_MAX_ITEMS:
+            body = api_error_body(
+                f"batches are limited to {config.API_BATCH_MAX_ITEMS} commands"
+            )
+            yield f'{{"index":{i},"status":413,"result":{body}}}\n'
+            return
+
+        if not isinstance(command, str) or not command.strip():
+            status, body = 400, api_error_body("expected a command")
+        else:
+            command = command.strip()[:1000]
+            item = done.get(command)
+            if item is None:
+                item = api_result(command, store)[:2]
+                done.put(command, item)
+            status, body = item
+        yield f'{{"index":{i},"status":{status},"result":{body}}}\n'
+
+
+def api_result(command, store, timings=timing.NULL):
+    """explain command for the api, returns (status, body, cacheable):
+    the http status, the json document (or error) and whether it only
+    depends on the command and the store generation"""
+    try:
+        result = cached_explain_cmd(command, store, timings=timings)
+    except errors.ProgramDoesNotExist as e:
+        return 404, api_error_body(f"missing man page: {e}"), True
+    except bashlex.errors.ParsingError as e:
+        body = api_error_body(f"parsing error: {e.message}", position=e.position)
+        return 400, body, True
+    except NotImplementedError as e:
+        body = api_error_body(f"the parser doesn't support {e.args[0]} constructs")
+        return 400, body, True
+    except Exception:
+        logger.error("uncaught exception trying to explain %r", command, exc_info=True)
+        body = api_error_body(
+            "something went wrong... this was logged and will be checked"
+        )
+        return 500, body, False
+
+    matches, helptext, truncated, expansions, _ = result
+    body = api_document(
+        command, store.generation, matches, helptext, truncated, expansions
+    )
+    # another try may explain more of it
+    return 200, body, truncated != "seconds"
+
+
+def api_etag(command, generation):
+    key = f"{API_VERSION}:{generation}:{command}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def api_error_body(message, **extra):
+    return json.dumps(dict(error=message, **extra), separators=(",", ":"))
+
+
+def _json_response(body, status=200, headers=None):
+    return app.response_class(
+        body, status=status, mimetype="application/json", headers=headers
+    )
+
+
+def api_document(command, generation, matches, helptext, truncated, expansions):
+    """the compact json of an explained command:
+
+    - version: API_VERSION
+    - command, generation: what was explained, against which store generation
+    - truncated: the matcher budget that ran out, or null
+    - matches: a span per token, with the command group it belongs to, the id
+      of its help text (null if unknown) and, on the first token of a command,
+      the man page it was explained from
+    - helptext: the help texts (html) by id, every text appears once
+    - expansions: the spans of substitutions and parameters in command
+    """
+    spans = []
+    for m in matches:
+        classes = m["commandclass"].split()
+        span = {
+            "start": m["start"],
+            "end": m["end"],
+            "text": command[m["start"] : m["end"]],
+            "group": classes[0],
+            "help": m["helpclass"] or None,
+        }
+        if "name" in m:
+            span["program"] = {
+                "name": m["name"],
+                "section": m["section"],
+                "source": m["source"],
+                "suggestions": m["suggestions"],
+            }
+        spans.append(span)
+
+    return json.dumps(
+        {
+            "version": API_VERSION,
+            "command": command,
+            "generation": generation,
+            "truncated": truncated,
+            "matches": spans,
+            "helptext": [{"id": id_, "text": text} for text, id_ in helptext],
+            "expansions": [
+                {"start": e.start, "end": e.end, "kind": e.kind} for e in expansions
+            ],
+        },
+        separators=(",", ":"),
+    )
+
+
+def explain_script(text):
+    """explain every top level statement of a multi line script
+
+    each statement is explained (and cached) on its own, so after an edit
+    only the changed statements are explained again. the page is streamed,
+    every statement is sent as soon as it's explained"""
+    s = store.get_store("explainshell", config.MONGO_URI)
+    statements = script.split(text)[: config.SCRIPT_MAX_STATEMENTS]
+    sections = (explain_statement(statement, s) for statement in statements)
+    return app.response_class(
+        stream_template("script.html", sections=sections, count=len(statements))
+    )
+
+
+def explain_statement(statement, store):
+    """explain a statement of a script, errors are returned in the error field
+    rather than raised"""
+    section = {"statement": statement, "error": None}
+    try:
+        result = cached_explain_cmd(statement.text, store)
+        section["matches"], section["helptext"], section["truncated"] = result[:3]
+    except errors.ProgramDoesNotExist as e:
+        section["error"] = f"no man page found for {e}"
+    except bashlex.errors.ParsingError as e:
+        section["error"] = f"parsing error: {e.message}"
+    except NotImplementedError as e:
+        section["error"] = f"the parser doesn't support {e.args[0]} constructs"
+    except Exception:
+        logger.error(
+            "uncaught exception trying to explain %r", statement.text, exc_info=True
+        )
+        section["error"] = "something went wrong... this was logged and will be checked"
+    return section
+
+
 @app.route("/explain/<program>", defaults={"section": None})
 @app.route("/explain/<section>/<program>")
 def explain_old(section, program):
     logger.info("/explain section=%r program=%r", section, program)
 
-    s = store.Store("explainshell", config.MONGO_URI)
+    s = store.get_store("explainshell", config.MONGO_URI)
     if section is not None:
         program = f"{program}.{section}"
 
@@ -79,22 +409,70 @@ def explain_old(section, program):
         command = f"{program} {args}"
         return redirect(f"/explain?cmd={urllib.parse.quote_plus(command)}", 301)
     else:
+        theme = request.cookies.get("theme", "default")
         try:
-            mp, suggestions = explain_program(program, s)
-            return render_template("options.html", mp=mp, suggestions=suggestions)
+            if theme in PAGE_THEMES:
+                page = cached_program_page(program, s, theme)
+            else:
+                page = render_program_page(program, s)
         except errors.ProgramDoesNotExist as e:
             return render_template(
                 "errors/missingmanpage.html", title="missing man page", e=e
             )
+        return program_page_response(page)
+
+
+def cached_program_page(program, store, theme):
+    """render_program_page, cached by program, theme and store generation.
+    this renders the page in the current request context, which must have
+    the theme cookie set to theme"""
+    key = f"{store.generation}:{theme}:{program}"
+    page = pages.get(key)
+    if page is None:
+        data = pages_disk.get(key) if pages_disk is not None else None
+        if data is not None:
+            page = pickle.loads(data)
+        else:
+            page = render_program_page(program, store)
+            if pages_disk is not None:
+                pages_disk.put(key, pickle.dumps(page, pickle.HIGHEST_PROTOCOL))
+        pages.put(key, page, cost=len(page.html) + len(page.gzipped))
+    return page
+
+
+def render_program_page(program, store):
+    mp, suggestions = explain_program(program, store)
+    # outside of a request (manager.py --prewarm) there are no timings
+    with g.get("timings", timing.NULL).phase("render"):
+        html = render_template("options.html", mp=mp, suggestions=suggestions)
+    html = html.encode("utf-8")
+    return RenderedPage(
+        html, gzip.compress(html), hashlib.sha1(html).hexdigest(), int(time.time())
+    )
+
+
+def program_page_response(page):
+    """respond with page, compressed if the client takes gzip. a conditional
+    request that matches its ETag or Last-Modified gets a 304"""
+    compress = "gzip" in request.accept_encodings
+    response = app.response_class(
+        page.gzipped if compress else page.html, mimetype="text/html"
+    )
+    response.set_etag(page.etag + "-gz" if compress else page.etag)
+    response.last_modified = page.last_modified
+    response.vary.update(["Accept-Encoding", "Cookie"])
+    if compress:
+        response.content_encoding = "gzip"
+    return response.make_conditional(request)
 
 
 def explain_program(program, store):
-    mps = store.find_man_page(program)
+    mps = store.find_man_page(program, lazy=True)
     mp = mps.pop(0)
     program = mp.name_section
 
     synopsis = mp.synopsis
-    if synopsis:
+    if isinstance(synopsis, bytes):
         synopsis = synopsis.decode("utf-8")
 
     mp = {
@@ -102,7 +480,7 @@ def explain_program(program, store):
         "section": mp.section,
         "program": program,
         "synopsis": synopsis,
-        "options": [o.text.decode("utf-8") for o in mp.options],
+        "options": [o.text for o in mp.options],
     }
 
     suggestions = []
@@ -127,15 +505,80 @@ def _make_match(start, end, match, cmd_class, help_class):
     }
 
 
-def explain_cmd(command, store):
-    matcher_ = matcher.Matcher(command, store)
+def cached_explain_cmd(command, store, bypass=False, timings=timing.NULL):
+    """explain_cmd, cached by command and store generation, see
+    _cached_explain_cmd. the errors it raises are counted by type"""
+    try:
+        return _cached_explain_cmd(command, store, bypass, timings)
+    except Exception as e:
+        metrics.REGISTRY.inc("explainshell_explain_errors_total", type=type(e).__name__)
+        raise
+
+
+def _cached_explain_cmd(command, store, bypass, timings):
+    """explain_cmd, cached by command, store generation and API_VERSION
+
+    returns explain_cmd's tuple with status added at the end, one of hit,
+    miss or bypass. the results are shared between requests, don't
+    modify them.
+
+    a missing man page won't show up before the generation changes, so
+    ProgramDoesNotExist is cached too, other errors aren't. neither are
+    results cut short by the time budget, the next try may well finish"""
+    if bypass:
+        return explain_cmd(command, store, timings) + ("bypass",)
+
+    key = f"{API_VERSION}:{store.generation}:{command}"
+    status = "hit"
+    with timings.phase("cache"):
+        result = results.get(key)
+        data = None
+        if result is None and results_disk is not None:
+            data = results_disk.get(key)
+    if result is None:
+        status = "miss"
+        if data is not None:
+            result = pickle.loads(data)
+        else:
+            try:
+                result = explain_cmd(command, store, timings)
+            except errors.ProgramDoesNotExist as e:
+                result = e
+            if isinstance(result, tuple) and result[2] == "seconds":
+                return result + (status,)
+            data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+            if results_disk is not None:
+                results_disk.put(key, data)
+        results.put(key, result, cost=len(data))
+
+    if isinstance(result, errors.ProgramDoesNotExist):
+        raise errors.ProgramDoesNotExist(*result.args)
+    return result + (status,)
+
+
+def explain_cmd(command, store, timings=timing.NULL):
+    """explain command, returns (matches, helptext, truncated, expansions)
+    where truncated names the matcher budget that ran out before all of
+    command was matched, or is None"""
+    matcher_ = matcher.Matcher(command, store, timings)
     groups = matcher_.match()
-    expansions = matcher_.expansions
+    with timings.phase("format"):
+        matches, helptext = _format_groups(command, groups, matcher_.expansions)
+    return matches, helptext, matcher_.truncated, matcher_.expansions
+
 
+def _format_groups(command, groups, expansions):
+    """turn the groups returned by the matcher into (matches, helptext) for
+    the templates"""
     shell_group = groups[0]
     cmd_groups = groups[1:]
     matches = []
 
+    # the expansions of each result, in the order the results are formatted
+    # below
+    results = [m for group in groups for m in group.results]
+    expansions_of = iter(_assign_expansions(results, expansions))
+
     # save a mapping between the help text to its assigned id,
     # we're going to reuse ids that have the same text
     text_ids = {}
@@ -166,7 +609,7 @@ def explain_cmd(command, store):
             id_start_pos.setdefault(help_class, m.start)
 
         d = _make_match(m.start, m.end, m.match, cmd_class, help_class)
-        format_match(d, m, expansions)
+        format_match(d, m, next(expansions_of))
 
         ln.append(d)
     matches.append(ln)
@@ -192,7 +635,7 @@ def explain_cmd(command, store):
                 id_start_pos.setdefault(help_class, m.start)
 
             d = _make_match(m.start, m.end, m.match, cmd_class, help_class)
-            format_match(d, m, expansions)
+            format_match(d, m, next(expansions_of))
 
             ln.append(d)
 
@@ -226,21 +669,38 @@ def explain_cmd(command, store):
     return matches, helptext
 
 
+def _assign_expansions(results, expansions):
+    """return the expansions that start inside each of results (start <=
+    expansion start <= end), the only ones format_match looks at
+
+    the results are visited by their start and the sorted expansions are swept
+    along with them, so this is linear apart from the sorts"""
+    expansions = sorted(expansions)
+    assigned = [()] * len(results)
+    lo = 0
+    for i in sorted(range(len(results)), key=lambda i: results[i].start):
+        m = results[i]
+        while lo < len(expansions) and expansions[lo].start < m.start:
+            lo += 1
+        hi = lo
+        while hi < len(expansions) and expansions[hi].start <= m.end:
+            hi += 1
+        assigned[i] = expansions[lo:hi]
+    return assigned
+
+
 def format_match(d, m, expansions):
     """populate the match field in d by escaping m.match and generating
-    links to any command/process substitutions"""
+    links to any command/process substitutions
 
-    # save us some work later: do any expansions overlap
-    # the current match?
-    has_subs_in_match = False
+    expansions is sorted, expansions that start outside of m are ignored (see
+    _assign_expansions)"""
+    lo = bisect.bisect_left(expansions, m.start, key=lambda e: e.start)
+    hi = bisect.bisect_right(expansions, m.end, key=lambda e: e.start)
+    expansions = expansions[lo:hi]
 
-    for start, end, kind in expansions:
-        if m.start <= start and end <= m.end:
-            has_subs_in_match = True
-            break
-
-    # if not, just escape the current match
-    if not has_subs_in_match:
+    # if no expansion is inside the current match, just escape it
+    if not any(end <= m.end for _, end, _ in expansions):
         d["match"] = markupsafe.escape(m.match)
         return
 
@@ -249,22 +709,19 @@ def format_match(d, m, expansions):
 
     # go over the expansions, wrapping them with a link; leave everything else
     # untouched
-    expanded_match = ""
+    parts = []
     i = 0
     for start, end, kind in expansions:
-        if start >= m.end:
+        if start == m.end:
             break
         rel_start = start - m.start
         rel_end = end - m.start
 
         if i < rel_start:
-            for j in range(i, rel_start):
-                if m.match[j].isspace():
-                    expanded_match += markupsafe.Markup("&nbsp;")
-                else:
-                    expanded_match += markupsafe.escape(m.match[j])
+            parts.append(_escape_spaces(m.match[i:rel_start]))
+            # an expansion that runs past the match loses its first character
             i = rel_start + 1
-        if m.start <= start and end <= m.end:
+        if end <= m.end:
             s = m.match[rel_start:rel_end]
 
             if kind == "substitution":
@@ -272,16 +729,23 @@ def format_match(d, m, expansions):
             else:
                 content = s
 
-            expanded_match += markupsafe.Markup(
-                '<span class="expansion-{0}">{1}</span>'
-            ).format(kind, content)
+            parts.append(
+                markupsafe.Markup('<span class="expansion-{0}">{1}</span>').format(
+                    kind, content
+                )
+            )
             i = rel_end
 
     if i < len(m.match):
-        expanded_match += markupsafe.escape(m.match[i:])
+        parts.append(markupsafe.escape(m.match[i:]))
+
+    d["match"] = markupsafe.Markup("").join(parts)
+
 
-    assert expanded_match
-    d["match"] = expanded_match
+def _escape_spaces(s):
+    """escape s, replacing whitespace with &nbsp;"""
+    escaped = markupsafe.escape(s)
+    return markupsafe.Markup("".join("&nbsp;" if c.isspace() else c for c in escaped))
 
 
 def _substitution_markup(cmd):
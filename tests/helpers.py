@@ -1,7 +1,11 @@
+from bson import ObjectId
+
 from explainshell import help_constants, matcher, store, errors, options
 
 
 class MockStore:
+    generation = 0
+
     def __init__(self):
         sp = store.Paragraph
         so = store.Option
@@ -50,8 +54,11 @@ class MockStore:
             partial_match=True,
             nested_cmd=True,
         )
+        self.manpages["sudo"] = sm(
+            "sudo.8.gz", "sudo", "sudo synopsis", opts, [], nested_cmd=True
+        )
 
-    def find_man_page(self, x, section=None):
+    def find_man_page(self, x, section=None, lazy=False):
         try:
             if x == "dup":
                 return self.dup
@@ -59,5 +66,65 @@ class MockStore:
         except KeyError:
             raise errors.ProgramDoesNotExist(x)
 
+    def find_man_pages(self, names, lazy=False):
+        found = {}
+        for name in names:
+            try:
+                found[name] = self.find_man_page(name, lazy=lazy)
+            except errors.ProgramDoesNotExist:
+                pass
+        return found
+
+
+def _page_document(source, name, aliases, **kwargs):
+    d = {
+        "_id": ObjectId(),
+        "source": source,
+        "name": name,
+        "synopsis": f"{name} synopsis",
+        "paragraphs": [
+            {
+                "idx": 0,
+                "text": "-a desc",
+                "section": "OPTIONS",
+                "is_option": True,
+                "short": ["-a"],
+                "long": [],
+                "expectsarg": False,
+                "argument": None,
+                "nestedcmd": False,
+            },
+            {"idx": 1, "text": "prose", "section": "DESCRIPTION", "is_option": False},
+        ],
+        "aliases": aliases,
+        "updated": False,
+    }
+    d.update(kwargs)
+    return d
+
+
+def store_documents():
+    """return documents for the manpage and mapping collections, with a few
+    pages sharing names, sections and aliases"""
+    manpages = [
+        _page_document("tar.1.gz", "tar", [["tar", 10]]),
+        _page_document("bsdtar.1.gz", "bsdtar", [["bsdtar", 10], ["tar", 1]]),
+        _page_document("node.1.gz", "node", [["node", 10]]),
+        _page_document("node.8.gz", "node", [["node", 10], ["nodejs", 1]]),
+        _page_document("xargs.1.gz", "xargs", [["xargs", 10]]),
+        _page_document("xargs.1posix.gz", "xargs", [["xargs", 1]]),
+        _page_document("git.1.gz", "git", [["git", 10]], multi_cmd=True),
+        _page_document(
+            "git-rebase.1.gz", "git-rebase", [["git-rebase", 10], ["git rebase", 1]]
+        ),
+    ]
+    mappings = []
+    for d in manpages:
+        for src, score in d["aliases"]:
+            mappings.append(
+                {"_id": ObjectId(), "src": src, "dst": d["_id"], "score": score}
+            )
+    return manpages, mappings
+
 
 s = MockStore()
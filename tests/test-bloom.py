@@ -0,0 +1,36 @@
+import unittest
+
+from explainshell import bloom
+
+
+class test_bloom_filter(unittest.TestCase):
+    def test_no_false_negatives(self):
+        names = [f"prog{i}" for i in range(1000)]
+        f = bloom.BloomFilter.from_iterable(names, len(names))
+        for name in names:
+            self.assertIn(name, f)
+        self.assertEqual(len(f), 1000)
+
+    def test_false_positive_rate(self):
+        f = bloom.BloomFilter.from_iterable(
+            (f"prog{i}" for i in range(1000)), 1000, error_rate=0.01
+        )
+        self.assertAlmostEqual(f.false_positive_rate, 0.01, delta=0.002)
+
+        misses = [f"missing{i}" for i in range(10000)]
+        fp = sum(1 for name in misses if name in f) / len(misses)
+        self.assertLess(fp, 0.02)
+
+    def test_size(self):
+        f = bloom.BloomFilter(1000, error_rate=0.01)
+        # ~9.6 bits per item at 1%
+        self.assertEqual(f.nbits, 9586)
+        self.assertEqual(f.nbytes, 1199)
+        self.assertEqual(f.nhashes, 7)
+        self.assertEqual(f.false_positive_rate, 0)
+
+    def test_empty(self):
+        f = bloom.BloomFilter(0)
+        self.assertNotIn("tar", f)
+        f.add("tar")
+        self.assertIn("tar", f)
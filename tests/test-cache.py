@@ -0,0 +1,95 @@
+import os
+import tempfile
+import unittest
+
+from explainshell import cache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class test_lru_cache(unittest.TestCase):
+    def test_get_put(self):
+        c = cache.LRUCache(2)
+        self.assertIsNone(c.get("a"))
+        c.put("a", 1)
+        self.assertEqual(c.get("a"), 1)
+        self.assertEqual(c.get("b", 2), 2)
+        self.assertEqual(c.stats()["hits"], 1)
+        self.assertEqual(c.stats()["misses"], 2)
+
+    def test_lru_eviction(self):
+        c = cache.LRUCache(2)
+        c.put("a", 1)
+        c.put("b", 2)
+        # touch a so b is the least recently used
+        c.get("a")
+        c.put("c", 3)
+        self.assertIn("a", c)
+        self.assertNotIn("b", c)
+        self.assertIn("c", c)
+        self.assertEqual(len(c), 2)
+        self.assertEqual(c.stats()["evictions"], 1)
+
+    def test_ttl(self):
+        clock = FakeClock()
+        c = cache.LRUCache(2, ttl=10, clock=clock)
+        c.put("a", 1)
+        clock.now = 9
+        self.assertEqual(c.get("a"), 1)
+        clock.now = 10
+        self.assertIsNone(c.get("a"))
+        self.assertNotIn("a", c)
+        self.assertEqual(c.stats()["expirations"], 1)
+
+    def test_clear(self):
+        c = cache.LRUCache(2)
+        c.put("a", 1)
+        c.clear()
+        self.assertEqual(len(c), 0)
+
+    def test_cost(self):
+        c = cache.LRUCache(10, maxcost=10)
+        c.put("a", 1, cost=4)
+        c.put("b", 2, cost=4)
+        c.put("a", 3, cost=5)
+        self.assertEqual(c.stats()["cost"], 9)
+        # evicts b, the least recently used
+        c.put("c", 4, cost=5)
+        self.assertEqual(sorted(c._data), ["a", "c"])
+        self.assertEqual(c.stats()["cost"], 10)
+        # too big on its own
+        c.put("d", 5, cost=11)
+        self.assertNotIn("d", c)
+        self.assertEqual(len(c), 2)
+
+
+class test_disk_cache(unittest.TestCase):
+    def setUp(self):
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+        self.path = os.path.join(d.name, "cache.db")
+
+    def test_get_put(self):
+        c = cache.DiskCache(self.path)
+        self.assertIsNone(c.get("a"))
+        c.put("a", b"1")
+        self.assertEqual(c.get("a"), b"1")
+        # another process opening the same file sees it
+        self.assertEqual(cache.DiskCache(self.path).get("a"), b"1")
+        self.assertEqual(c.stats()["hits"], 1)
+        self.assertEqual(c.stats()["misses"], 1)
+
+    def test_maxsize(self):
+        c = cache.DiskCache(self.path, maxsize=2)
+        c.PRUNE_EVERY = 1
+        for k in "abc":
+            c.put(k, k.encode())
+        self.assertEqual(len(c), 2)
+        self.assertIsNone(c.get("a"))
+        self.assertEqual(c.get("c"), b"c")
@@ -0,0 +1,101 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import nltk
+
+from explainshell import store
+from explainshell.algo import classifier
+
+
+def _paragraphs():
+    paragraphs = []
+    for i in range(8):
+        paragraphs.append(
+            store.Paragraph(i, f"-{chr(97 + i)}, --opt{i}\n  does {i}", "OPTIONS", True)
+        )
+        paragraphs.append(
+            store.Paragraph(
+                i, f"some prose about the program, number {i} of many.", "NOTES", False
+            )
+        )
+    return paragraphs
+
+
+class TrainingStore:
+    def __init__(self):
+        self.hash = "a"
+
+    def training_set(self):
+        yield store.ClassifierManpage("prog", _paragraphs())
+
+    def training_set_fingerprint(self):
+        return self.hash
+
+
+class test_classifier(unittest.TestCase):
+    def setUp(self):
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+        self.path = os.path.join(d.name, "classifier.pickle")
+        self.store = TrainingStore()
+        classifier._models.clear()
+        self.addCleanup(classifier._models.clear)
+
+        patcher = mock.patch.object(
+            nltk.classify.NaiveBayesClassifier,
+            "train",
+            wraps=nltk.classify.NaiveBayesClassifier.train,
+        )
+        self.fit = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _classifier(self):
+        c = classifier.Classifier(self.store, "bayes", self.path)
+        c.train()
+        return c
+
+    def test_persisted(self):
+        c = self._classifier()
+        self.assertEqual(self.fit.call_count, 1)
+        self.assertTrue(os.path.exists(self.path))
+
+        # loaded from the process' models, then from the file
+        self._classifier()
+        classifier._models.clear()
+        loaded = self._classifier()
+        self.assertEqual(self.fit.call_count, 1)
+        self.assertEqual(len(loaded.test_feats), len(c.test_feats))
+
+        mp = store.ClassifierManpage("prog", _paragraphs())
+        self.assertEqual(
+            [p.idx for _, p in loaded.classify(mp)],
+            [
+                p.idx
+                for _, p in c.classify(store.ClassifierManpage("prog", _paragraphs()))
+            ],
+        )
+
+        # a new training set is trained on
+        self.store.hash = "b"
+        self._classifier()
+        self.assertEqual(self.fit.call_count, 2)
+
+        c.train(force=True)
+        self.assertEqual(self.fit.call_count, 3)
+
+    def test_corrupt(self):
+        with open(self.path, "wb") as f:
+            f.write(b"not a pickle")
+        self._classifier()
+        self.assertEqual(self.fit.call_count, 1)
+
+        classifier._models.clear()
+        self._classifier()
+        self.assertEqual(self.fit.call_count, 1)
+
+    def test_no_path(self):
+        c = classifier.Classifier(self.store, "bayes", "")
+        c.train()
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), [])
@@ -1,6 +1,8 @@
 import unittest, os
+from unittest import mock
 
-from explainshell import manager, config, store, errors
+from explainshell import manager, manpage, config, store, errors
+from explainshell.algo import classifier
 
 
 @unittest.skip("nltk usage is broken due to new version")
@@ -156,3 +158,134 @@ class test_manager(unittest.TestCase):
         mps = m.store.find_man_page("xargs.1posix")
         self.assertEqual(len(mps), 2)
         self.assertEqual(mps[0].section, "1posix")
+
+
+def _paragraphs(name):
+    return [
+        store.Paragraph(0, f"{name} does things, many of them.", "DESCRIPTION", False),
+        store.Paragraph(1, "-a, --all\n  do all the things", "OPTIONS", False),
+        store.Paragraph(2, "-b   do the b thing", "OPTIONS", False),
+    ]
+
+
+class IngestStore:
+    """the parts of a store Manager.run uses, in memory"""
+
+    def __init__(self):
+        self.pages = []
+        self.mappings_added = []
+        self.multi_cmds = []
+        self.indexed = False
+
+    def training_set(self):
+        for i in range(4):
+            paragraphs = _paragraphs(f"p{i}")
+            paragraphs[1].is_option = paragraphs[2].is_option = True
+            yield store.ClassifierManpage(f"p{i}", paragraphs)
+
+    def training_set_fingerprint(self):
+        return "training"
+
+    def ensure_indexes(self):
+        self.indexed = True
+
+    def find_man_page(self, name):
+        raise errors.ProgramDoesNotExist(name)
+
+    def add_manpage(self, m):
+        result = self.add_manpages([m])[0]
+        if result.error:
+            raise Exception(result.error)
+        return m
+
+    def add_manpages(self, manpages):
+        results = []
+        for m in manpages:
+            if m.name == "unwritable":
+                results.append(store.AddResult(m.source, None, False, "no space"))
+            else:
+                self.pages.append(m)
+                results.append(store.AddResult(m.source, len(self.pages), False, None))
+        return results
+
+    def names(self):
+        for i, m in enumerate(self.pages):
+            yield i + 1, m.name
+
+    def mappings(self):
+        return []
+
+    def add_mapping(self, src, dst, score):
+        self.mappings_added.append((src, dst))
+
+    def set_multi_cmd(self, _id):
+        self.multi_cmds.append(_id)
+
+
+def _parse(self):
+    if self.name == "broken":
+        raise ValueError("can't parse")
+    self.synopsis = f"{self.name} synopsis"
+    self.paragraphs = _paragraphs(self.name)
+
+
+class test_jobs(unittest.TestCase):
+    def setUp(self):
+        classifier._models.clear()
+        self.addCleanup(classifier._models.clear)
+        for patcher in [
+            mock.patch.object(config, "CLASSIFIER_MODEL_PATH", ""),
+            # workers are forked and inherit these
+            mock.patch.object(manpage.ManPage, "read", lambda self: None),
+            mock.patch.object(manpage.ManPage, "parse", _parse),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _run(self, names, jobs):
+        s = IngestStore()
+        paths = [f"/man/man1/{name}.1.gz" for name in names]
+        with mock.patch.object(store, "get_store", return_value=s) as get_store:
+            m = manager.Manager(
+                config.MONGO_URI, "explainshell_tests", paths, jobs=jobs
+            )
+        # the manager writes, it never gets the snapshot
+        get_store.assert_called_once_with(
+            "explainshell_tests", config.MONGO_URI, snapshot=False
+        )
+        added, exists = m.run()
+        self.assertEqual(exists, [])
+        self.assertTrue(s.indexed)
+        return s, added, m.failed
+
+    def _summary(self, s, added):
+        return (
+            [m.source for m in added],
+            [(m.name, m.synopsis, [str(o) for o in m.options]) for m in s.pages],
+            s.mappings_added,
+            s.multi_cmds,
+        )
+
+    def test_jobs(self):
+        names = ["tar", "git-rebase", "broken", "git", "zip", "git-log"]
+        serial = self._run(names, 1)
+        parallel = self._run(names, 2)
+
+        self.assertEqual(self._summary(*serial[:2]), self._summary(*parallel[:2]))
+        self.assertEqual(
+            [m.source for m in parallel[1]],
+            ["git-log.1.gz", "git-rebase.1.gz", "git.1.gz", "tar.1.gz", "zip.1.gz"],
+        )
+        self.assertEqual(
+            parallel[0].mappings_added, [("git log", 1), ("git rebase", 2)]
+        )
+        self.assertEqual(parallel[0].pages[0].options[0].opts, ["-a", "--all"])
+        self.assertEqual(serial[2], parallel[2])
+        self.assertEqual(
+            parallel[2], [("/man/man1/broken.1.gz", "ValueError: can't parse")]
+        )
+
+    def test_jobs_write_error(self):
+        s, added, failed = self._run(["unwritable", "zip"], 2)
+        self.assertEqual([m.source for m in added], ["zip.1.gz"])
+        self.assertEqual(failed, [("/man/man1/unwritable.1.gz", "no space")])
@@ -1,6 +1,7 @@
 import unittest
+from unittest import mock
 
-import bashlex.errors, bashlex.ast
+import bashlex.errors, bashlex.ast, bashlex.parser
 
 from explainshell import help_constants, matcher, errors
 from tests import helpers
@@ -787,3 +788,164 @@ class test_matcher(unittest.TestCase):
         self.assertEqual(len(groups), 2)
         self.assertEqual(groups[0].results, [])
         self.assertEqual(groups[1].results, matchresults)
+
+    def test_pipeline_groups(self):
+        cmd = "bar -a | nosuch x y | baz -a"
+
+        groups = matcher.Matcher(cmd, s).match()
+        self.assertEqual(
+            [g.name for g in groups], ["shell", "command0", "command1", "command2"]
+        )
+        self.assertEqual([r.match for r in groups[0].results], ["|", "|"])
+        # the unknown arguments are merged with the unknown program
+        self.assertEqual(groups[2].results, [(9, 19, None, "nosuch x y")])
+        self.assertEqual(
+            groups[3].results,
+            [(22, 25, "baz synopsis", "baz"), (26, 28, "-a desc", "-a")],
+        )
+
+    def test_prefetch(self):
+        store = mock.Mock(wraps=s)
+        cmd = "bar foo -a | baz | nosuch x | withargs -exec bar -a \\;"
+
+        groups = matcher.Matcher(cmd, store).match()
+        self.assertEqual(
+            [g.manpage.name if g.manpage else None for g in groups[1:]],
+            ["bar-foo", "baz", None, "withargs", "bar"],
+        )
+        # every name was resolved by a single call
+        store.find_man_pages.assert_called_once()
+        store.find_man_page.assert_not_called()
+
+        # only the words in command position, and their multi command pairs
+        ast = bashlex.parser.parsesingle(cmd)
+        unlimited = matcher.Budget(0, 0, 0, 0)
+        names, starts = matcher._CommandWords.collect(ast, unlimited)
+        self.assertEqual(
+            names,
+            [
+                "bar",
+                "bar foo",
+                "foo",
+                "baz",
+                "nosuch",
+                "nosuch x",
+                "x",
+                "withargs",
+                "withargs -exec",
+            ],
+        )
+        self.assertEqual(starts, ["bar", "baz", "nosuch", "withargs"])
+
+        # the walk stops where the visitor would
+        budget = matcher.Budget(nodes=8, depth=0, lookups=0, seconds=0)
+        self.assertEqual(
+            matcher._CommandWords.collect(ast, budget),
+            (["bar", "bar foo", "foo", "baz"], ["bar", "baz"]),
+        )
+        budget = matcher.Budget(nodes=0, depth=3, lookups=0, seconds=0)
+        ast = bashlex.parser.parsesingle("bar; (((baz)))")
+        self.assertEqual(matcher._CommandWords.collect(ast, budget), (["bar"], ["bar"]))
+
+        # a command nested in another is resolved with it
+        store.reset_mock()
+        groups = matcher.Matcher("sudo bar -a", store).match()
+        self.assertEqual([g.manpage.name for g in groups[1:]], ["sudo", "bar"])
+        store.find_man_pages.assert_called_once()
+        store.find_man_page.assert_not_called()
+
+    def test_budget(self):
+        cmd = "bar -a; baz; bar -b"
+        budget = matcher.Budget(nodes=4, depth=0, lookups=0, seconds=0)
+        m = matcher.Matcher(cmd, s, budget=budget)
+        groups = m.match()
+        self.assertEqual(m.truncated, "nodes")
+        self.assertEqual(groups[1].manpage.name, "bar")
+        # whatever wasn't matched is unknown
+        self.assertEqual(
+            groups[0].results[-1], matcher.MatchResult(8, 19, None, "baz; bar -b")
+        )
+
+        budget = matcher.Budget(nodes=0, depth=3, lookups=0, seconds=0)
+        m = matcher.Matcher("(((((bar -a)))))", s, budget=budget)
+        m.match()
+        self.assertEqual(m.truncated, "depth")
+
+        # baz is nested in withargs, it's looked up after the prefetch
+        budget = matcher.Budget(nodes=0, depth=0, lookups=1, seconds=0)
+        m = matcher.Matcher(r"withargs -exec baz -a \;", s, budget=budget)
+        m.match()
+        self.assertEqual(m.truncated, "lookups")
+
+        # prefetched names count when they're used: bar, bar -a, nosuch, baz,
+        # bar and bar -b
+        cmd2 = "bar -a | nosuch x | baz abc | bar -b z"
+        for k, commands in enumerate([0, 1, 2, 3, 3, 4], 1):
+            budget = matcher.Budget(nodes=0, depth=0, lookups=k, seconds=0)
+            m = matcher.Matcher(cmd2, s, budget=budget)
+            groups = m.match()
+            self.assertEqual(m.truncated, "lookups" if k < 6 else None, k)
+            self.assertEqual(len(groups) - 1, commands, k)
+
+        budget = matcher.Budget(nodes=0, depth=0, lookups=0, seconds=1)
+        with mock.patch("time.monotonic", side_effect=[0, 0, 0, 5]):
+            m = matcher.Matcher(cmd, s, budget=budget)
+            m.match()
+        self.assertEqual(m.truncated, "seconds")
+
+        m = matcher.Matcher(cmd, s, budget=matcher.Budget(1, 0, 0, 0))
+        m.match()
+        self.assertEqual(m.truncated, "nodes")
+
+        m = matcher.Matcher(cmd, s)
+        m.match()
+        self.assertIsNone(m.truncated)
+
+    def test_concurrent_prefetch(self):
+        class SectionStore(helpers.MockStore):
+            def find_man_page(self, x, section=None, lazy=False):
+                if x == "baz.1":
+                    x = "baz"
+                return super().find_man_page(x, section, lazy)
+
+        def describe(m, groups):
+            return [
+                (
+                    g.name,
+                    getattr(g, "manpage", None),
+                    str(getattr(g, "error", "")),
+                    g.results,
+                )
+                for g in groups
+            ] + [m.expansions]
+
+        store = SectionStore()
+        cmds = [
+            "bar.1 -a | baz.1 abc --a; nosuch.8 x && bar foo -a",
+            r"withargs -exec baz.1 -a \; | bar.1 -b",
+            "baz.1 $(bar -a) <(nosuch.1)",
+        ]
+        for cmd in cmds:
+            serial = matcher.Matcher(cmd, store, concurrency=0)
+            expected = describe(serial, serial.match())
+            concurrent = matcher.Matcher(cmd, store, concurrency=2)
+            self.assertEqual(describe(concurrent, concurrent.match()), expected)
+            self.assertNotIn("baz.1", serial._man_pages)
+
+        # the commands starting with a section were resolved up front
+        self.assertEqual(
+            [n for n in concurrent._man_pages if "." in n], ["baz.1", "nosuch.1"]
+        )
+
+        # both modes run out of lookups at the same point
+        for cmd in cmds + ["baz.1; bar.1 -a; nosuch.8"]:
+            for k in range(1, 6):
+                budget = matcher.Budget(nodes=0, depth=0, lookups=k, seconds=0)
+                serial = matcher.Matcher(cmd, store, budget=budget, concurrency=0)
+                expected = describe(serial, serial.match()) + [serial.truncated]
+                concurrent = matcher.Matcher(cmd, store, budget=budget, concurrency=2)
+                self.assertEqual(
+                    describe(concurrent, concurrent.match()) + [concurrent.truncated],
+                    expected,
+                    (cmd, k),
+                )
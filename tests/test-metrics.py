@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+
+from explainshell import metrics
+
+
+class test_metrics(unittest.TestCase):
+    def test_exposition(self):
+        r = metrics.Registry()
+        r.inc("explainshell_requests_total", endpoint="/explain", status="200")
+        r.inc("explainshell_requests_total", 2, endpoint="/explain", status="200")
+        r.observe("explainshell_request_duration_seconds", 0.02, endpoint="/")
+        r.observe("explainshell_request_duration_seconds", 20, endpoint="/")
+        r.add_collector(lambda: [("explainshell_store_calls_total", {}, 5)])
+
+        lines = r.exposition().splitlines()
+        self.assertIn("# TYPE explainshell_requests_total counter", lines)
+        self.assertIn(
+            'explainshell_requests_total{endpoint="/explain",status="200"} 3', lines
+        )
+        self.assertIn("explainshell_store_calls_total 5", lines)
+        self.assertIn("# TYPE explainshell_request_duration_seconds histogram", lines)
+        buckets = [
+            l for l in lines if l.startswith("explainshell_request_duration_seconds_")
+        ]
+        self.assertEqual(
+            buckets[:4],
+            [
+                'explainshell_request_duration_seconds_bucket{endpoint="/",le="0.005"} 0',
+                'explainshell_request_duration_seconds_bucket{endpoint="/",le="0.01"} 0',
+                'explainshell_request_duration_seconds_bucket{endpoint="/",le="0.025"} 1',
+                'explainshell_request_duration_seconds_bucket{endpoint="/",le="0.05"} 1',
+            ],
+        )
+        self.assertEqual(
+            buckets[-3:],
+            [
+                'explainshell_request_duration_seconds_bucket{endpoint="/",le="+Inf"} 2',
+                'explainshell_request_duration_seconds_sum{endpoint="/"} 20.02',
+                'explainshell_request_duration_seconds_count{endpoint="/"} 2',
+            ],
+        )
+
+    def test_processes(self):
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+
+        clock = iter(range(100)).__next__
+        other = metrics.Registry(d.name, interval=10, clock=clock)
+        other.inc("explainshell_store_calls_total")
+        other.observe("explainshell_request_duration_seconds", 1, endpoint="/")
+        other.flush()
+        # flushes are throttled
+        other.inc("explainshell_store_calls_total")
+        other.flush()
+
+        r = metrics.Registry(d.name)
+        r.inc("explainshell_store_calls_total", 2)
+        r.observe("explainshell_request_duration_seconds", 1, endpoint="/")
+        counters, histograms = r.collect()
+        self.assertEqual(counters["explainshell_store_calls_total", ()], 3)
+        h = histograms["explainshell_request_duration_seconds", (("endpoint", "/"),)]
+        self.assertEqual(h[-1], 2)
+        self.assertEqual(len(os.listdir(d.name)), 2)
+
+        # a process with a new pid writes a file of its own
+        r._pid = -1
+        r.flush()
+        self.assertEqual(len(os.listdir(d.name)), 3)
+
+    def test_doctest(self):
+        import doctest
+
+        self.assertEqual(doctest.testmod(metrics).failed, 0)
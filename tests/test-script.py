@@ -0,0 +1,55 @@
+import unittest
+
+from explainshell import script
+
+
+class test_script(unittest.TestCase):
+    def assertStatements(self, text, expected):
+        self.assertEqual([(s.line, s.text) for s in script.split(text)], expected)
+
+    def test_split(self):
+        text = (
+            "#!/bin/sh\n"
+            "set -e\n"
+            "# comment\n"
+            "apt-get update && \\\n"
+            "  apt-get install -y curl\n"
+            "\n"
+            "for f in *.txt; do\n"
+            "  echo $f\n"
+            "done\n"
+            "cat <<EOF\n"
+            "hello\n"
+            "EOF\n"
+            "tar xzf a.tgz # trailing\n"
+        )
+        self.assertStatements(
+            text,
+            [
+                (2, "set -e"),
+                (4, "apt-get update && \\\n  apt-get install -y curl"),
+                (7, "for f in *.txt; do\n  echo $f\ndone"),
+                (10, "cat <<EOF\nhello\nEOF"),
+                (13, "tar xzf a.tgz"),
+            ],
+        )
+
+    def test_parsing_error(self):
+        # only the broken statement is split by lines
+        self.assertStatements(
+            "echo a\nfor f in a; do\n  echo $f\ndone\nbar )\nif x; then\n  y\nfi",
+            [
+                (1, "echo a"),
+                (2, "for f in a; do\n  echo $f\ndone"),
+                (5, "bar )"),
+                (6, "if x; then\n  y\nfi"),
+            ],
+        )
+        self.assertStatements(
+            "for f in a; do\n  echo\n", [(1, "for f in a; do"), (2, "echo")]
+        )
+
+    def test_empty(self):
+        self.assertStatements("", [])
+        self.assertStatements("\n# comment\n\n", [])
+        self.assertStatements("echo a\r\necho b", [(1, "echo a"), (2, "echo b")])
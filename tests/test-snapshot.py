@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import bson
+
+from explainshell import snapshot, errors
+from tests import helpers
+
+
+class test_snapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "explainshell.snapshot")
+        self.manpages, self.mappings = helpers.store_documents()
+        snapshot.write_snapshot(self.path, self.manpages, self.mappings, 7)
+        self.store = snapshot.SnapshotStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _sources(self, name):
+        return [mp.source for mp in self.store.find_man_page(name)]
+
+    def test_find_man_page(self):
+        self.assertEqual(self._sources("tar"), ["tar.1.gz", "bsdtar.1.gz"])
+        self.assertEqual(self._sources("node"), ["node.1.gz", "node.8.gz"])
+        self.assertEqual(self._sources("node.8"), ["node.8.gz", "node.1.gz"])
+        self.assertEqual(
+            self._sources("xargs.1posix"), ["xargs.1posix.gz", "xargs.1.gz"]
+        )
+        self.assertEqual(self._sources("git rebase"), ["git-rebase.1.gz"])
+        self.assertEqual(self._sources("tar.1.gz"), ["tar.1.gz"])
+
+        mp = self.store.find_man_page("git")[0]
+        self.assertEqual(mp.name, "git")
+        self.assertTrue(mp.multi_cmd)
+        self.assertEqual(len(mp.paragraphs), 2)
+        self.assertTrue(mp.find_option("-a"))
+
+        for name in ("missing", "tar.2", "missing.1.gz"):
+            self.assertRaises(
+                errors.ProgramDoesNotExist, self.store.find_man_page, name
+            )
+
+    def test_suggestions(self):
+        # nodejs is an alias of node.8, which shares the node alias with node.1
+        self.assertEqual(self._sources("nodejs.8"), ["node.8.gz", "node.1.gz"])
+
+    def test_iteration(self):
+        self.assertEqual(self.store.generation, 7)
+        self.assertTrue("git rebase" in self.store)
+        self.assertFalse("rebase" in self.store)
+        self.assertEqual(
+            [mp.source for mp in self.store], [d["source"] for d in self.manpages]
+        )
+        self.assertEqual(
+            list(self.store.names()), [(d["_id"], d["name"]) for d in self.manpages]
+        )
+        self.assertEqual(
+            list(self.store.mappings()), [(d["src"], d["_id"]) for d in self.mappings]
+        )
+
+    def test_mapped(self):
+        # the lookup tables stay in the mapped file
+        for v in vars(self.store).values():
+            self.assertNotIsInstance(v, (dict, set))
+            if isinstance(v, list):
+                self.assertTrue(all(isinstance(x, memoryview) for x in v))
+
+    def test_missing_dst(self):
+        self.store.close()
+        missing = dict(self.mappings[0], _id=bson.ObjectId(), dst=bson.ObjectId())
+        snapshot.write_snapshot(self.path, self.manpages, self.mappings + [missing])
+        self.store = snapshot.SnapshotStore(self.path)
+        self.assertEqual(self._sources(missing["src"]), ["tar.1.gz", "bsdtar.1.gz"])
+        self.assertEqual(self._sources("nodejs.8"), ["node.8.gz", "node.1.gz"])
+
+    def test_not_a_snapshot(self):
+        with open(self.path, "wb") as f:
+            f.write(b"\0" * 64)
+        self.assertRaises(ValueError, snapshot.SnapshotStore, self.path)
+
+    def test_manpage_index(self):
+        pages, after = [], None
+        while True:
+            entries, after = self.store.manpage_index(after=after, limit=3)
+            pages.append([e["name"] for e in entries])
+            if after is None:
+                break
+        self.assertEqual(
+            pages,
+            [
+                ["bsdtar", "git", "git-rebase"],
+                ["node", "node", "tar"],
+                ["xargs", "xargs"],
+            ],
+        )
+
+        entries, after = self.store.manpage_index("node")
+        self.assertIsNone(after)
+        self.assertEqual(
+            entries,
+            [{"name": "node", "synopsis": "node synopsis", "options": [["-a"]]}] * 2,
+        )
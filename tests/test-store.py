@@ -0,0 +1,443 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import pymongo
+import pymongo.errors
+
+from explainshell import store, config, errors, snapshot
+from tests import helpers
+
+
+def _mongo_available():
+    try:
+        c = pymongo.MongoClient(config.MONGO_URI, serverSelectionTimeoutMS=500)
+        c.admin.command("ping")
+        return True
+    except pymongo.errors.PyMongoError:
+        return False
+
+
+class test_manpage(unittest.TestCase):
+    def _manpage(self):
+        p = store.Paragraph(0, "-a desc", "OPTIONS", True)
+        a = store.Option(p, ["-a"], ["--all"], False)
+        a2 = store.Option(store.Paragraph(1, "-a again", "", True), ["-a"], [], False)
+        f1 = store.Option(store.Paragraph(2, "file 1", "", True), [], [], False, "FILE")
+        f2 = store.Option(store.Paragraph(3, "file 2", "", True), [], [], False, "FILE")
+        text = store.Paragraph(4, "text", "", False)
+        return store.ManPage("foo.1.gz", "foo", "", [a, text, a2, f1, f2], [])
+
+    def test_find_option(self):
+        mp = self._manpage()
+        self.assertIs(mp.find_option("-a"), mp.paragraphs[0])
+        self.assertIs(mp.find_option("--all"), mp.paragraphs[0])
+        self.assertIsNone(mp.find_option("-b"))
+        self.assertEqual([o.idx for o in mp.options], [0, 1, 2, 3])
+        self.assertEqual(mp.arguments, {"FILE": "file 1\n\nfile 2"})
+
+    def test_invalidate(self):
+        mp = self._manpage()
+        self.assertEqual(len(mp.options), 4)
+
+        b = store.Option(store.Paragraph(5, "-b desc", "", True), ["-b"], [], False)
+        mp.paragraphs.append(b)
+        self.assertIsNone(mp.find_option("-b"))
+        mp.invalidate()
+        self.assertIs(mp.find_option("-b"), b)
+
+        mp.paragraphs = mp.paragraphs[:1]
+        self.assertIsNone(mp.find_option("-b"))
+        self.assertEqual(mp.arguments, {})
+
+
+class test_store_registry(unittest.TestCase):
+    def setUp(self):
+        # creating indexes and the mapping filter needs a server
+        patcher = mock.patch.object(store.Store, "ensure_indexes")
+        self.ensure_indexes = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(config, "MAPPING_FILTER_ERROR_RATE", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        store.close_stores()
+
+    def test_shared(self):
+        a = store.get_store("explainshell_tests", "mongodb://localhost")
+        b = store.get_store("explainshell_tests", "mongodb://localhost")
+        self.assertIs(a, b)
+
+        c = store.get_store("explainshell_tests2", "mongodb://localhost")
+        self.assertIsNot(a, c)
+
+    def test_lazy(self):
+        # nothing is sent to the server until the store is used, the indexes
+        # are the manager's to create
+        with (
+            mock.patch.object(config, "MAPPING_FILTER_ERROR_RATE", 0.01),
+            mock.patch.object(store.Store, "_build_filter") as build_filter,
+        ):
+            s = store.get_store("explainshell_tests", "mongodb://localhost")
+        self.ensure_indexes.assert_not_called()
+        build_filter.assert_not_called()
+        self.assertEqual(s.connection.nodes, frozenset())
+
+    def test_snapshot(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "explainshell.snapshot")
+        snapshot.write_snapshot(path, *helpers.store_documents())
+
+        with mock.patch.object(config, "SNAPSHOT_PATH", path):
+            a = store.get_store("explainshell_tests", "mongodb://localhost")
+            self.assertIsInstance(a, snapshot.SnapshotStore)
+            self.assertIs(a, store.get_store("explainshell_tests2", "mongodb://x"))
+
+            # writers always get mongodb
+            b = store.get_store(
+                "explainshell_tests", "mongodb://localhost", snapshot=False
+            )
+            self.assertIsInstance(b, store.Store)
+            self.assertIs(
+                b,
+                store.get_store(
+                    "explainshell_tests", "mongodb://localhost", snapshot=False
+                ),
+            )
+
+    def test_pool_size(self):
+        s = store.Store("explainshell_tests", "mongodb://localhost", max_pool_size=3)
+        self.assertEqual(s.connection.options.pool_options.max_pool_size, 3)
+        s.close()
+
+    def test_fork(self):
+        a = store.get_store("explainshell_tests", "mongodb://localhost")
+        with mock.patch("os.getpid", return_value=store._stores_pid + 1):
+            b = store.get_store("explainshell_tests", "mongodb://localhost")
+        self.assertIsNot(a, b)
+        # the parent's store was dropped, not closed
+        self.assertIsNotNone(a.db)
+        a.close()
+
+    def test_close(self):
+        a = store.get_store("explainshell_tests", "mongodb://localhost")
+        store.close_stores()
+        self.assertIsNone(a.db)
+        self.assertIsNot(
+            a, store.get_store("explainshell_tests", "mongodb://localhost")
+        )
+
+
+class test_server_version(unittest.TestCase):
+    def setUp(self):
+        for patcher in [
+            mock.patch.object(config, "MAPPING_FILTER_ERROR_RATE", 0),
+            mock.patch.object(
+                store.Store, "generation", new_callable=mock.PropertyMock
+            ),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _store(self, version):
+        s = store.Store("explainshell_tests", "mongodb://localhost")
+        self.addCleanup(s.close)
+        patcher = mock.patch.object(
+            s.connection, "server_info", return_value={"versionArray": version}
+        )
+        self.server_info = patcher.start()
+        self.addCleanup(patcher.stop)
+        s.mapping = mock.Mock()
+        s.mapping.aggregate.return_value = iter([])
+        s._find_man_page_queries = mock.Mock(
+            side_effect=lambda name: [store.ManPage(f"{name}.1.gz", name, "", [], [])]
+        )
+        return s
+
+    def test_fallback(self):
+        s = self._store([4, 4, 29, 0])
+        self.assertEqual(s.find_man_page("tar")[0].source, "tar.1.gz")
+        found = s.find_man_pages(["tar", "node", "xargs.1"])
+        self.assertEqual(sorted(found), ["node", "tar", "xargs.1"])
+        self.assertCountEqual(
+            [c.args for c in s._find_man_page_queries.call_args_list],
+            [("tar",), ("node",), ("xargs.1",)],
+        )
+        s.mapping.aggregate.assert_not_called()
+        self.server_info.assert_called_once()
+
+    def test_single_aggregation(self):
+        s = self._store([5, 0, 0, 0])
+        self.assertRaises(errors.ProgramDoesNotExist, s.find_man_page, "tar")
+        self.assertEqual(s.find_man_pages(["tar", "node"]), {})
+        self.assertEqual(s.mapping.aggregate.call_count, 2)
+        s._find_man_page_queries.assert_not_called()
+
+    def test_verify_lookups(self):
+        # test_verify runs it against every server CI has, this catches the
+        # $lookup forms older servers reject without one
+        s = self._store([4, 4, 29, 0])
+        s.manpage = mock.Mock()
+        s.manpage.aggregate.return_value = iter([])
+        s.mapping.aggregate.return_value = iter([])
+        s.verify_report()
+        pipelines = [
+            c.args[0]
+            for c in s.manpage.aggregate.call_args_list
+            + s.mapping.aggregate.call_args_list
+        ]
+        lookups = [st["$lookup"] for p in pipelines for st in p if "$lookup" in st]
+        self.assertEqual(len(lookups), 2)
+        for lookup in lookups:
+            self.assertFalse("localField" in lookup and "pipeline" in lookup)
+
+
+# CI provides a mongodb, don't let these quietly skip there
+@unittest.skipUnless(_mongo_available() or os.getenv("CI"), "needs a running mongodb")
+class test_store(unittest.TestCase):
+    def setUp(self):
+        self.store = store.Store("explainshell_tests")
+        self.store.drop(True)
+        self.store.ensure_indexes()
+        manpages, mappings = helpers.store_documents()
+        self.store.manpage.insert_many(manpages)
+        self.store.mapping.insert_many(mappings)
+
+    def tearDown(self):
+        self.store.close()
+
+    def _resolve(self, f, name):
+        try:
+            mps = f(name)
+        except errors.ProgramDoesNotExist as e:
+            return e.args
+        return [(mp.source, mp.name) for mp in mps], mps[0].to_store()
+
+    def test_find_man_page_compat(self):
+        names = [
+            "tar",
+            "tar.1",
+            "tar.2",
+            "node",
+            "node.8",
+            "nodejs.8",
+            "xargs",
+            "xargs.1posix",
+            "git rebase",
+            "git-rebase.1",
+            "missing",
+            "missing.1",
+            "tar.1.gz",
+            "missing.1.gz",
+            ".",
+        ]
+        for name in names:
+            self.assertEqual(
+                self._resolve(self.store.find_man_page, name),
+                self._resolve(self.store._find_man_page_queries, name),
+                name,
+            )
+
+    def test_find_man_pages(self):
+        names = ["tar", "node", "git rebase", "missing", "tar.1", "tar.2", "tar"]
+        found = self.store.find_man_pages(names, lazy=True)
+        self.assertEqual(sorted(found), ["git rebase", "node", "tar", "tar.1"])
+        for name, mps in found.items():
+            self.assertEqual(
+                self._resolve(lambda n: mps, name),
+                self._resolve(self.store._find_man_page_queries, name),
+            )
+        # the results are cached like find_man_page's
+        self.assertIs(self.store.find_man_page("tar", lazy=True)[0], found["tar"][0])
+
+    def test_find_man_page_fallback(self):
+        # what servers older than AGGREGATION_MIN_VERSION do
+        self.store._single_aggregation = False
+        found = self.store.find_man_pages(["tar", "node.8", "missing"])
+        self.assertEqual(sorted(found), ["node.8", "tar"])
+        for name, mps in found.items():
+            self.assertEqual(
+                self._resolve(lambda n: mps, name),
+                self._resolve(self.store._find_man_page_queries, name),
+            )
+
+    def test_explain_queries(self):
+        for description, stages, covered in self.store.explain_queries():
+            self.assertTrue(covered, f"{description}: {stages}")
+
+    def test_cache(self):
+        mp = self.store.find_man_page("tar")[0]
+        self.assertIs(self.store.find_man_page("tar")[0], mp)
+        self.assertFalse(mp.multi_cmd)
+
+        generation = self.store.generation
+        _id = self.store.manpage.find_one({"source": "tar.1.gz"})["_id"]
+        self.store.set_multi_cmd(_id)
+        self.assertEqual(self.store.generation, generation + 1)
+        self.assertIsNot(self.store.find_man_page("tar")[0], mp)
+        self.assertTrue(self.store.find_man_page("tar")[0].multi_cmd)
+
+    def test_add_manpages(self):
+        p = store.Paragraph(0, "-b desc", "OPTIONS", True)
+        foo = store.ManPage(
+            "foo.1.gz",
+            "foo",
+            "foo synopsis",
+            [store.Option(p, ["-b"], [], False)],
+            [("foo", 10), ("tar", 1)],
+        )
+        tar = store.ManPage("tar.1.gz", "tar", "new tar synopsis", [p], [("tar", 10)])
+
+        results = self.store.add_manpages([foo, tar], batch_size=1)
+        self.assertEqual([r.source for r in results], ["foo.1.gz", "tar.1.gz"])
+        self.assertEqual([r.replaced for r in results], [False, True])
+        self.assertEqual([r.error for r in results], [None, None])
+
+        mps = self.store.find_man_page("tar")
+        self.assertEqual(
+            [mp.source for mp in mps], ["tar.1.gz", "bsdtar.1.gz", "foo.1.gz"]
+        )
+        self.assertEqual(mps[0].synopsis, b"new tar synopsis")
+        self.assertTrue(self.store.find_man_page("foo")[0].find_option("-b"))
+        # the old tar page and its mapping are gone
+        self.assertEqual(self.store.manpage.count_documents({"source": "tar.1.gz"}), 1)
+        self.assertEqual(self.store.mapping.count_documents({"dst": results[1].id}), 1)
+
+    def test_lazy(self):
+        mp = self.store.find_man_page("tar", lazy=True)[0]
+        self.assertEqual(len(mp._paragraphs), 1)
+        self.assertTrue(mp.find_option("-a"))
+        self.assertEqual(len(mp._paragraphs), 1)
+
+        # accessing paragraphs fetches the rest
+        self.assertEqual(
+            [p.text for p in mp.paragraphs],
+            [p.text for p in self.store.find_man_page("tar")[0].paragraphs],
+        )
+        self.assertEqual(len(mp._paragraphs), 2)
+
+    def test_verify(self):
+        self.assertEqual(self.store.verify_report(), ([], [], []))
+
+        tar = self.store.manpage.find_one({"source": "tar.1.gz"})
+        self.store.mapping.delete_many({"dst": tar["_id"]})
+        missing = helpers.ObjectId()
+        self.store.add_mapping("foo", missing, 1)
+        dup = dict(tar, _id=helpers.ObjectId())
+        self.store.manpage.insert_one(dup)
+        self.store.mapping.insert_one({"src": "tar", "dst": dup["_id"], "score": 1})
+
+        report = self.store.verify_report()
+        self.assertFalse(report.ok)
+        self.assertEqual(
+            [(d["src"], d["dst"]) for d in report.dangling_mappings],
+            [("foo", missing)],
+        )
+        self.assertEqual(
+            [(d["name"], d["source"]) for d in report.orphaned_pages],
+            [("tar", "tar.1.gz")],
+        )
+        self.assertEqual(
+            report.duplicate_sources,
+            [{"source": "tar.1.gz", "ids": [tar["_id"], dup["_id"]]}],
+        )
+        self.assertEqual(self.store.verify(), (False, ["tar"], {missing}))
+
+    def test_mapping_filter(self):
+        self.assertIn("tar", self.store.mapping_filter)
+        with mock.patch.object(self.store, "_resolve") as resolve:
+            self.assertRaises(
+                errors.ProgramDoesNotExist, self.store.find_man_page, "missing.1"
+            )
+            self.assertNotIn("missing", self.store)
+        resolve.assert_not_called()
+
+        self.store.add_mapping("missing", helpers.ObjectId(), 1)
+        self.assertIn("missing", self.store.mapping_filter)
+
+        with mock.patch.object(config, "MAPPING_FILTER_ERROR_RATE", 0):
+            self.assertIsNone(self.store.mapping_filter)
+
+    def test_mapping_filter_ingest(self):
+        p = store.Paragraph(0, "-b desc", "OPTIONS", True)
+        pages = [
+            store.ManPage(f"p{i}.1.gz", f"p{i}", "", [p], [(f"p{i}", 10)])
+            for i in range(200)
+        ]
+        self.store.mapping_filter
+        with mock.patch.object(
+            self.store, "_build_filter", wraps=self.store._build_filter
+        ) as build:
+            # the way manager.py ingests: a lookup, then a write, page by page
+            for m in pages[:100]:
+                self.assertRaises(
+                    errors.ProgramDoesNotExist, self.store.find_man_page, m.name
+                )
+                self.store.add_manpage(m)
+            self.store.add_manpages(pages[100:], batch_size=3)
+            for m in pages:
+                self.assertIn(m.name, self.store.mapping_filter)
+            # only rebuilt to grow it, about once per doubling of the names
+            builds = build.call_count
+            self.assertLessEqual(builds, 6)
+
+            # another process wrote to the store
+            self.store.meta.update_one({"_id": "generation"}, {"$inc": {"value": 1}})
+            self.store._generation_read = None
+            self.store.mapping_filter
+            self.assertEqual(build.call_count, builds + 1)
+
+    def test_largest_sources(self):
+        self.store.manpage.update_one(
+            {"source": "git.1.gz"},
+            {"$push": {"paragraphs": {"idx": 2, "text": "more", "is_option": False}}},
+        )
+        self.assertEqual(self.store.largest_sources(2), ["git.1.gz", "bsdtar.1.gz"])
+
+    def test_manpage_index(self):
+        pages, after = [], None
+        while True:
+            entries, after = self.store.manpage_index(after=after, limit=3)
+            pages.append([e["name"] for e in entries])
+            if after is None:
+                break
+        self.assertEqual(
+            pages,
+            [
+                ["bsdtar", "git", "git-rebase"],
+                ["node", "node", "tar"],
+                ["xargs", "xargs"],
+            ],
+        )
+
+        entries, after = self.store.manpage_index("node")
+        self.assertIsNone(after)
+        self.assertEqual(
+            entries,
+            [{"name": "node", "synopsis": "node synopsis", "options": [["-a"]]}] * 2,
+        )
+
+    def test_training_set_fingerprint(self):
+        self.store.classifier.delete_many({})
+        empty = self.store.training_set_fingerprint()
+        self.assertEqual(empty, self.store.training_set_fingerprint())
+
+        self.store.classifier.insert_one({"name": "bar", "paragraphs": []})
+        f = self.store.training_set_fingerprint()
+        self.assertNotEqual(f, empty)
+        self.assertEqual(f, self.store.training_set_fingerprint())
+
+        # only _ids are read to compute it, not the training set
+        classifier = self.store.classifier
+        with mock.patch.object(classifier, "find", wraps=classifier.find) as find:
+            self.store.training_set_fingerprint()
+        for c in find.call_args_list:
+            self.assertEqual(c.args[1], {"_id": 1})
+
+        self.store.classifier.insert_one({"name": "baz", "paragraphs": []})
+        self.store.classifier.delete_one({"name": "bar"})
+        self.assertNotIn(self.store.training_set_fingerprint(), (empty, f))
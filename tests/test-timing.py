@@ -0,0 +1,40 @@
+import doctest
+import json
+import unittest
+
+from explainshell import timing
+
+
+class test_timing(unittest.TestCase):
+    def test_timings(self):
+        t = timing.Timings(clock=iter([0, 1, 2, 3, 5, 6]).__next__)
+        with t.phase("a"):
+            pass
+        with t.phase("a"):
+            t.count("store")
+            t.count("store", 2)
+        d = json.loads(t.to_json(path="/explain"))
+        self.assertEqual(
+            d,
+            {
+                "path": "/explain",
+                "total_ms": 6000,
+                "phases_ms": {"a": 3000},
+                "counts": {"store": 3},
+            },
+        )
+
+    def test_phase_raises(self):
+        t = timing.Timings(clock=iter([0, 1, 3]).__next__)
+        with self.assertRaises(ValueError):
+            with t.phase("a"):
+                raise ValueError
+        self.assertEqual(t.phases, {"a": 2})
+
+    def test_null(self):
+        self.assertFalse(timing.NULL)
+        with timing.NULL.phase("a"):
+            timing.NULL.count("b")
+
+    def test_doctest(self):
+        self.assertEqual(doctest.testmod(timing).failed, 0)
@@ -0,0 +1,419 @@
+import gzip
+import json
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+import bson
+import markupsafe
+
+from explainshell import cache, matcher
+from explainshell.web import app, debug_views, views
+from tests import helpers
+
+
+def reference_format_match(d, m, expansions):
+    """views.format_match before it was rewritten as a sweep, the rewrite must
+    produce exactly the same markup"""
+
+    # save us some work later: do any expansions overlap
+    # the current match?
+    has_subs_in_match = False
+
+    for start, end, kind in expansions:
+        if m.start <= start and end <= m.end:
+            has_subs_in_match = True
+            break
+
+    # if not, just escape the current match
+    if not has_subs_in_match:
+        d["match"] = markupsafe.escape(m.match)
+        return
+
+    # used in es.js
+    d["commandclass"] += " hasexpansion"
+
+    # go over the expansions, wrapping them with a link; leave everything else
+    # untouched
+    expanded_match = ""
+    i = 0
+    for start, end, kind in expansions:
+        if start >= m.end:
+            break
+        rel_start = start - m.start
+        rel_end = end - m.start
+
+        if i < rel_start:
+            for j in range(i, rel_start):
+                if m.match[j].isspace():
+                    expanded_match += markupsafe.Markup("&nbsp;")
+                else:
+                    expanded_match += markupsafe.escape(m.match[j])
+            i = rel_start + 1
+        if m.start <= start and end <= m.end:
+            s = m.match[rel_start:rel_end]
+
+            if kind == "substitution":
+                content = markupsafe.Markup(views._substitution_markup(s))
+            else:
+                content = s
+
+            expanded_match += markupsafe.Markup(
+                '<span class="expansion-{0}">{1}</span>'
+            ).format(kind, content)
+            i = rel_end
+
+    if i < len(m.match):
+        expanded_match += markupsafe.escape(m.match[i:])
+
+    assert expanded_match
+    d["match"] = expanded_match
+
+
+# tokens the format_match corpus is generated from, heavy on expansions
+CORPUS_TOKENS = [
+    "bar",
+    "baz",
+    "-a",
+    "$x",
+    "${y}",
+    '"$z w"',
+    "$(bar -a)",
+    "`baz`",
+    "<(bar)",
+    ">(baz x)",
+    "'<&>'",
+    "a\\ b",
+    "$((1+2))",
+    "~",
+    "$1",
+    '"$(bar $x)"',
+    "x=$y",
+    "é$x",
+    "--a=$x",
+    "2>&1",
+    "$x$y",
+    "$(bar)$(baz)",
+]
+
+
+class test_views(unittest.TestCase):
+    def setUp(self):
+        self.store = helpers.MockStore()
+        patcher = mock.patch("explainshell.store.get_store", return_value=self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        views.results.clear()
+        self.client = app.test_client()
+
+    def test_result_cache(self):
+        with mock.patch.object(views, "explain_cmd", wraps=views.explain_cmd) as e:
+            r = self.client.get("/explain?cmd=bar+-a")
+            self.assertEqual(r.headers[views.CACHE_HEADER], "miss")
+            r2 = self.client.get("/explain?cmd=bar -a  ")
+            self.assertEqual(r2.headers[views.CACHE_HEADER], "hit")
+            self.assertEqual(r.data, r2.data)
+            self.assertEqual(e.call_count, 1)
+
+            r = self.client.get(
+                "/explain?cmd=bar+-a", headers={views.CACHE_HEADER: "bypass"}
+            )
+            self.assertEqual(r.headers[views.CACHE_HEADER], "bypass")
+            self.assertEqual(e.call_count, 2)
+
+            # a new generation misses
+            self.store.generation = 1
+            r = self.client.get("/explain?cmd=bar+-a")
+            self.assertEqual(r.headers[views.CACHE_HEADER], "miss")
+            self.assertEqual(e.call_count, 3)
+
+        self.assertGreater(views.results.stats()["cost"], 0)
+
+    def test_result_cache_disk(self):
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+        disk = cache.DiskCache(os.path.join(d.name, "results.db"))
+
+        with mock.patch.object(views, "results_disk", disk):
+            r = self.client.get("/explain?cmd=bar+-a")
+            # as if the worker restarted
+            views.results.clear()
+            with mock.patch.object(views, "explain_cmd") as e:
+                r2 = self.client.get("/explain?cmd=bar+-a")
+            e.assert_not_called()
+        self.assertEqual(r.data, r2.data)
+        self.assertEqual(disk.stats()["hits"], 1)
+
+    def test_script(self):
+        text = "#!/bin/sh\nbar -a\nnosuch x\nfor f in a; do\n  baz $f\ndone\n"
+        r = self.client.post("/explain", data={"cmd": text})
+        self.assertTrue(r.is_streamed)
+        body = r.get_data(as_text=True)
+        self.assertIn("3 statements", body)
+        self.assertIn("no man page found for nosuch", body)
+        self.assertIn('id="s3-help-1">baz synopsis', body)
+
+        # statements are cached on their own
+        with mock.patch.object(views, "explain_cmd") as e:
+            r = self.client.post("/explain", data={"cmd": text.replace("-a", "-b")})
+            r.get_data()
+        self.assertEqual([c.args[0] for c in e.call_args_list], ["bar -b"])
+
+    def test_server_timing(self):
+        r = self.client.get("/explain?cmd=bar+-a")
+        phases = [e.split(";")[0] for e in r.headers["Server-Timing"].split(", ")]
+        for name in ["cache", "parse", "prefetch", "visit", "merge", "format"]:
+            self.assertIn(name, phases)
+        self.assertIn("store;desc=", r.headers["Server-Timing"])
+
+        r = self.client.get("/explain?cmd=bar+-a")
+        self.assertNotIn("parse", r.headers["Server-Timing"])
+
+        with mock.patch("explainshell.config.TIMING", False):
+            r = self.client.get("/explain?cmd=bar+-a")
+        self.assertNotIn("Server-Timing", r.headers)
+
+    def test_truncated(self):
+        with mock.patch("explainshell.config.MATCH_MAX_NODES", 4):
+            r = self.client.get("/explain?cmd=bar+-a;+baz")
+        self.assertIn(b"too complex to explain in full", r.data)
+
+        # running out of time isn't cached, the next request may finish
+        with mock.patch("explainshell.config.MATCH_MAX_SECONDS", 1), mock.patch(
+            "time.monotonic", side_effect=[0, 5]
+        ):
+            r = self.client.get("/explain?cmd=baz")
+        self.assertIn(b"too complex to explain in full", r.data)
+        r = self.client.get("/explain?cmd=baz")
+        self.assertEqual(r.headers[views.CACHE_HEADER], "miss")
+        self.assertNotIn(b"too complex to explain in full", r.data)
+
+    def test_truncated_budgets(self):
+        cmds = [
+            "nosuch a b | bar",
+            "bar -a && $(baz) x; nosuch.8 -b",
+            "(bar -a | baz) > $x; withargs -exec bar -a \\; ",
+            "for x in a b; do bar $x | baz.1 -a; done",
+            "$x -a | bar $(nosuch x) <(baz)",
+        ]
+        budgets = [("MATCH_MAX_NODES", n) for n in range(1, 40)]
+        budgets += [("MATCH_MAX_DEPTH", n) for n in range(1, 8)]
+        budgets += [("MATCH_MAX_LOOKUPS", n) for n in range(1, 6)]
+        for name, value in budgets:
+            with mock.patch(f"explainshell.config.{name}", value):
+                for cmd in cmds:
+                    r = self.client.get(
+                        "/explain",
+                        query_string={"cmd": cmd},
+                        headers={views.CACHE_HEADER: "bypass"},
+                    )
+                    self.assertEqual(r.status_code, 200, (name, value, cmd))
+                    self.assertNotIn(
+                        b"something went wrong", r.data, (name, value, cmd)
+                    )
+
+    def test_api_explain(self):
+        r = self.client.get("/api/explain?cmd=bar+-a+$(baz)")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.mimetype, "application/json")
+        self.assertIn("max-age=", r.headers["Cache-Control"])
+        d = r.get_json()
+        self.assertEqual(d["command"], "bar -a $(baz)")
+        self.assertIsNone(d["truncated"])
+        self.assertEqual(
+            [(m["text"], m["group"]) for m in d["matches"]],
+            [("bar", "command0"), ("-a", "command0"), ("$(baz)", "command0")],
+        )
+        self.assertEqual(d["matches"][0]["program"]["name"], "bar")
+        self.assertNotIn("program", d["matches"][1])
+        self.assertEqual(
+            d["helptext"][1], {"id": d["matches"][1]["help"], "text": "-a desc"}
+        )
+        self.assertEqual(
+            d["expansions"], [{"start": 9, "end": 12, "kind": "substitution"}]
+        )
+
+        # the etag is known before explaining anything
+        etag = r.headers["ETag"]
+        with mock.patch.object(views, "cached_explain_cmd") as e:
+            r = self.client.get(
+                "/api/explain?cmd=bar+-a+$(baz)", headers={"If-None-Match": etag}
+            )
+        e.assert_not_called()
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.headers["ETag"], etag)
+
+        self.store.generation = 1
+        r = self.client.get(
+            "/api/explain?cmd=bar+-a+$(baz)", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertNotEqual(r.headers["ETag"], etag)
+        self.assertEqual(r.get_json()["version"], views.API_VERSION)
+
+        # a deploy that changes the response changes the etag too
+        etag = r.headers["ETag"]
+        with mock.patch.object(views, "API_VERSION", views.API_VERSION + 1):
+            r = self.client.get(
+                "/api/explain?cmd=bar+-a+$(baz)", headers={"If-None-Match": etag}
+            )
+        self.assertEqual(r.status_code, 200)
+        self.assertNotEqual(r.headers["ETag"], etag)
+        self.assertEqual(r.get_json()["version"], views.API_VERSION + 1)
+
+    def test_api_explain_errors(self):
+        r = self.client.get("/api/explain")
+        self.assertEqual(r.status_code, 400)
+        r = self.client.get("/api/explain?cmd=nosuch")
+        self.assertEqual(r.status_code, 404)
+        self.assertEqual(r.get_json(), {"error": "missing man page: nosuch"})
+        r = self.client.get("/api/explain?cmd=bar+(")
+        self.assertEqual(r.status_code, 400)
+        self.assertIn("position", r.get_json())
+
+    def test_api_explain_batch(self):
+        commands = ["bar -a", "nosuch", "bar -a", "bar (", "", "baz"]
+        with mock.patch.object(
+            views, "cached_explain_cmd", wraps=views.cached_explain_cmd
+        ) as e:
+            r = self.client.post("/api/explain/batch", json=commands)
+            self.assertTrue(r.is_streamed)
+            body = r.get_data(as_text=True)
+        self.assertEqual(r.mimetype, "application/x-ndjson")
+        lines = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual([d["index"] for d in lines], list(range(len(commands))))
+        self.assertEqual([d["status"] for d in lines], [200, 404, 200, 400, 400, 200])
+        self.assertEqual(lines[0], lines[2] | {"index": 0})
+        self.assertEqual(lines[1]["result"], {"error": "missing man page: nosuch"})
+        self.assertEqual(lines[5]["result"]["command"], "baz")
+        # the repeated command was explained once
+        self.assertEqual(e.call_count, 4)
+
+        body = '"bar -a"\n\n{"cmd": "baz"}\nnot json\n'
+        r = self.client.post(
+            "/api/explain/batch", data=body, content_type="application/x-ndjson"
+        )
+        lines = [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+        self.assertEqual([d["status"] for d in lines], [200, 200, 400])
+        self.assertEqual(lines[1]["result"]["command"], "baz")
+
+        with mock.patch("explainshell.config.API_BATCH_MAX_ITEMS", 1):
+            r = self.client.post("/api/explain/batch", json=commands)
+            lines = r.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line)["status"] for line in lines], [200, 413])
+
+        r = self.client.post("/api/explain/batch", json={"cmd": "bar"})
+        self.assertEqual(r.status_code, 400)
+
+    def test_program_page_cache(self):
+        views.pages.clear()
+        with mock.patch.object(
+            views, "explain_program", wraps=views.explain_program
+        ) as e:
+            r = self.client.get("/explain/bar", headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(r.headers["Content-Encoding"], "gzip")
+            html = gzip.decompress(r.data)
+            self.assertIn(b"bar synopsis", html)
+
+            r2 = self.client.get("/explain/bar")
+            self.assertNotIn("Content-Encoding", r2.headers)
+            self.assertEqual(r2.data, html)
+            self.assertNotEqual(r.headers["ETag"], r2.headers["ETag"])
+            self.assertEqual(e.call_count, 1)
+
+            # conditional requests get a 304
+            r = self.client.get(
+                "/explain/bar", headers={"If-None-Match": r2.headers["ETag"]}
+            )
+            self.assertEqual(r.status_code, 304)
+            r = self.client.get(
+                "/explain/bar",
+                headers={"If-Modified-Since": r2.headers["Last-Modified"]},
+            )
+            self.assertEqual(r.status_code, 304)
+            self.assertEqual(e.call_count, 1)
+
+            # every theme has its own page, unknown ones aren't cached
+            self.client.set_cookie("theme", "dark")
+            r = self.client.get("/explain/bar")
+            self.assertIn(b"data-theme=dark", r.data)
+            self.client.set_cookie("theme", "other")
+            self.client.get("/explain/bar")
+            self.client.get("/explain/bar")
+            self.assertEqual(e.call_count, 4)
+        self.assertEqual(len(views.pages), 2)
+
+        r = self.client.get("/explain/nosuch")
+        self.assertIn(b"missing man page", r.data)
+
+    def test_format_match_corpus(self):
+        rng = random.Random(0)
+        checked = expanded = 0
+        for _ in range(1000):
+            words = rng.choices(CORPUS_TOKENS, k=rng.randint(1, 8))
+            cmd = " ".join(words)
+            if rng.random() < 0.3:
+                cmd += " | " + " ".join(rng.choices(CORPUS_TOKENS, k=3))
+            m_ = matcher.Matcher(cmd, self.store)
+            try:
+                groups = m_.match()
+            except Exception:
+                continue
+
+            results = [m for group in groups for m in group.results]
+            assigned = views._assign_expansions(results, m_.expansions)
+            for m, expansions in zip(results, assigned):
+                expected = views._make_match(m.start, m.end, m.match, "c", "h")
+                d = dict(expected)
+                reference_format_match(expected, m, m_.expansions)
+                views.format_match(d, m, expansions)
+                self.assertEqual(d, expected, cmd)
+                self.assertIsInstance(d["match"], markupsafe.Markup)
+                checked += 1
+                expanded += "hasexpansion" in d["commandclass"]
+        self.assertGreater(expanded, 500)
+        self.assertGreater(checked, 1500)
+
+    def test_metrics(self):
+        self.client.get("/explain?cmd=bar+-a")
+        self.client.get("/explain?cmd=bar+-a")
+        self.client.get("/explain?cmd=nosuch")
+        self.client.get("/explain?cmd=bar+(")
+
+        r = self.client.get("/metrics")
+        self.assertTrue(r.content_type.startswith("text/plain; version=0.0.4"))
+        text = r.get_data(as_text=True)
+        for line in [
+            'explainshell_requests_total{endpoint="/explain",status="200"}',
+            'explainshell_request_duration_seconds_count{endpoint="/explain"}',
+            'explainshell_cache_requests_total{cache="results",result="hit"}',
+            'explainshell_explain_errors_total{type="ProgramDoesNotExist"}',
+            'explainshell_explain_errors_total{type="ParsingError"}',
+            "explainshell_store_calls_total",
+        ]:
+            self.assertIn(line, text)
+
+    def test_debug_index(self):
+        oid = bson.ObjectId()
+        entries = [{"name": "bar", "synopsis": "bar synopsis", "options": [["-a"]]}]
+        with mock.patch.object(
+            self.store,
+            "manpage_index",
+            create=True,
+            return_value=(entries, ("bar", oid)),
+        ) as index:
+            r = self.client.get("/debug?prefix=b&limit=1")
+            self.assertEqual(r.status_code, 200)
+            index.assert_called_once_with("b", None, 1)
+            text = r.get_data(as_text=True)
+            self.assertIn("(-a)", text)
+
+            cursor = debug_views._encode_cursor(("bar", oid))
+            self.assertIn(f"after={cursor}", text)
+            self.client.get(f"/debug?prefix=b&after={cursor}&limit=5000")
+            index.assert_called_with("b", ("bar", oid), debug_views.DEBUG_MAX_PAGE_SIZE)
+
+        r = self.client.get("/debug?after=nope")
+        self.assertEqual(r.status_code, 400)
@@ -0,0 +1,131 @@
+"""
+time Matcher.match over generated pipelines of increasing length
+
+the man pages come from the mock store used by the tests, so no database is
+needed. besides the whole of match(), the post-processing done after the
+AST was visited (_fix_groups, and _mark_unparsed_unknown and _merge_adjacent
+within it) is timed on its own, apart from parsing and store lookups. run
+from the repository root:
+
+    python -m tools.benchmatcher [--sizes 250,500,1000,2000] [--repeat 5]
+
+or as python tools/benchmatcher.py
+"""
+
+import argparse
+import collections
+import os
+import random
+import statistics
+import sys
+import time
+
+if __package__ in (None, ""):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from explainshell import matcher, timing  # noqa: E402
+from tests import helpers  # noqa: E402
+
+COMMANDS = [
+    "bar -a -b arg",
+    "baz abc --a",
+    "bar foo -a -c=one",
+    "withargs -a FILE1 FILE2",
+    r"withargs -exec bar -a \;",
+    "nosuch arg1 arg2",
+    "dup -? $(bar -a)",
+    "baz <(bar -b x) 2>&1",
+]
+
+# the columns printed for each size, in ms: name -> what it's taken from
+COLUMNS = collections.OrderedDict(
+    [
+        ("total", "all of match()"),
+        ("parse", "bashlex parsing"),
+        ("lookup", "store lookups, prefetched or not"),
+        ("visit", "visiting the AST, lookups excluded"),
+        ("fix_groups", "post-processing, all of it"),
+        ("unparsed", "_mark_unparsed_unknown"),
+        ("merge_adj", "_merge_adjacent, every group"),
+    ]
+)
+
+
+class TimedMatcher(matcher.Matcher):
+    """a Matcher that times the parts of its post-processing"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.spent = collections.Counter()
+
+    def _timed(self, name, f, *args):
+        start = time.perf_counter()
+        try:
+            return f(*args)
+        finally:
+            self.spent[name] += time.perf_counter() - start
+
+    def _fix_groups(self):
+        return self._timed("fix_groups", super()._fix_groups)
+
+    def _mark_unparsed_unknown(self):
+        return self._timed("unparsed", super()._mark_unparsed_unknown)
+
+    def _merge_adjacent(self, *args):
+        return self._timed("merge_adj", super()._merge_adjacent, *args)
+
+
+def pipeline(size, rng):
+    """return a pipeline of random commands that is at least size chars long"""
+    parts = []
+    length = 0
+    while length < size:
+        parts.append(rng.choice(COMMANDS))
+        length += len(parts[-1]) + 3
+    return " | ".join(parts) + " # done"
+
+
+def bench(size, repeat, store, seed=0):
+    """return the length of the pipeline matched and the median of each
+    column, in seconds"""
+    s = pipeline(size, random.Random(seed))
+    samples = collections.defaultdict(list)
+    for _ in range(repeat):
+        t = timing.Timings()
+        m = TimedMatcher(s, store, timings=t)
+        start = time.perf_counter()
+        m.match()
+        samples["total"].append(time.perf_counter() - start)
+
+        lookup = t.phases.get("prefetch", 0) + t.phases.get("lookup", 0)
+        samples["parse"].append(t.phases.get("parse", 0))
+        samples["lookup"].append(lookup)
+        samples["visit"].append(t.phases.get("visit", 0) - t.phases.get("lookup", 0))
+        for name in ("fix_groups", "unparsed", "merge_adj"):
+            samples[name].append(m.spent[name])
+    return len(s), {name: statistics.median(v) for name, v in samples.items()}
+
+
+def main(sizes, repeat):
+    store = helpers.MockStore()
+    for name, description in COLUMNS.items():
+        print(f"{name:>10}: {description}")
+    print()
+    print(f"{'chars':>8}" + "".join(f" {name:>10}" for name in COLUMNS))
+    for size in sizes:
+        length, medians = bench(size, repeat, store)
+        row = "".join(f" {medians[name] * 1000:>10.2f}" for name in COLUMNS)
+        print(f"{length:>8}{row}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        default="250,500,1000,2000",
+        type=lambda s: [int(x) for x in s.split(",")],
+        help="comma separated pipeline lengths, in chars",
+    )
+    parser.add_argument("--repeat", default=5, type=int)
+    args = parser.parse_args()
+    main(args.sizes, args.repeat)